@@ -0,0 +1,49 @@
+"""
+Compares a benchmark result JSON against a stored baseline and flags regressions.
+
+    python -m benchmarks.compare baseline.json bench.json --tolerance 0.1
+
+Exits with status 1 if the p50 latency or peak RSS of any benchmark grew by
+more than the tolerance.
+"""
+import argparse
+import json
+import sys
+
+METRICS = ('p50_ms', 'p90_ms', 'peak_rss_mb')
+
+
+def compare(baseline, current, tolerance, metrics=METRICS):
+    """Returns a list of (benchmark, metric, baseline value, current value, relative change, regressed)."""
+    rows = []
+    for name, stats in current['benchmarks'].items():
+        if name not in baseline['benchmarks']:
+            continue
+        for metric in metrics:
+            before, after = baseline['benchmarks'][name][metric], stats[metric]
+            change = (after - before) / before if before else 0.0
+            rows.append((name, metric, before, after, change, change > tolerance))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Flag benchmark regressions against a baseline')
+    parser.add_argument('baseline', type=str)
+    parser.add_argument('current', type=str)
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='allowed relative increase (0.1 = 10%%)')
+    args = parser.parse_args()
+
+    with open(args.baseline) as baseline_handle, open(args.current) as current_handle:
+        rows = compare(json.load(baseline_handle), json.load(current_handle), args.tolerance)
+
+    for name, metric, before, after, change, regressed in rows:
+        print('{:<16} {:<12} {:>12.2f} -> {:>12.2f}  {:>+7.1%}{}'.format(
+            name, metric, before, after, change, '  REGRESSION' if regressed else ''))
+
+    if any(row[-1] for row in rows):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
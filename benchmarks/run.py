@@ -0,0 +1,265 @@
+"""
+Performance benchmarks on synthetic meetings.
+
+Measures ``AMIDataset.__getitem__``, the encoder forward pass, a single decoder
+step, a single beam search bookkeeping step (with the bytes it allocates, which
+should be 0), a full ``Predictor.inference``, ROUGE scoring, a training forward and
+backward pass (with the size of the loss logits), an optimizer step (with
+the bytes it reads and writes) and checkpoint loading
+(full ``.pth`` and memory-mapped ``.weights``) separately, and writes latency
+percentiles, throughput and peak RSS to JSON.
+
+    python -m benchmarks.run --output bench.json
+    python -m benchmarks.run --num_turns 300 --turn_length 400 --set encoder_attention_window=32
+    python -m benchmarks.run --set autocast_dtype=bfloat16 --output bench_bf16.json
+    python -m benchmarks.compare baseline.json bench.json
+"""
+import argparse
+import ast
+import collections
+import json
+import os
+import platform
+import resource
+import shutil
+import tempfile
+import time
+import warnings
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from benchmarks.synthetic import write_corpora
+from config.hparams import PARAMS
+from data.dataset import AMIDataset
+from models.model import SummarizationModel
+from predictor import Predictor
+from utils.beam_search import BeamSearch
+from utils.checkpointing import load_checkpoint, export_weights, load_weights
+from utils.optim import build_optimizer, optimizer_step_bytes
+from utils.utils import compute_rouge_scores, autocast
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def summarize(times, items_per_call=1):
+    """Latency percentiles (ms), throughput (items/s) and current peak RSS of a list of durations (s)."""
+    times_ms = np.array(times) * 1e3
+    return {
+        'n': len(times),
+        'mean_ms': float(times_ms.mean()),
+        'p50_ms': float(np.percentile(times_ms, 50)),
+        'p90_ms': float(np.percentile(times_ms, 90)),
+        'p99_ms': float(np.percentile(times_ms, 99)),
+        'throughput_per_s': float(items_per_call * len(times) / max(sum(times), 1e-12)),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def timed(fn, repeats, warmup=1):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def allocated_bytes(fn, calls):
+    """Bytes of CPU memory allocated per call of fn, from the profiler memory events."""
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as profiler:
+        for _ in range(calls):
+            fn()
+    return sum(max(event.self_cpu_memory_usage, 0) for event in profiler.events()) / calls
+
+
+def build_hparams(args, data_dir):
+    hparams = dict(PARAMS)
+    hparams.update(device=args.device, data_dir=data_dir, save_dirpath=data_dir, workers=0,
+                   beam_size=args.beam_size, gen_max_length=args.gen_max_length,
+                   min_length=min(PARAMS['min_length'], args.gen_max_length // 2),
+                   max_length=max(PARAMS['max_length'], args.turn_length + 2, args.gen_max_length + 1))
+    for assignment in args.set:
+        key, value = assignment.split('=', 1)
+        if key not in hparams:
+            raise ValueError('Unknown hparam: {}'.format(key))
+        try:
+            value = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            pass
+        hparams[key] = value
+    return collections.namedtuple('HParams', sorted(hparams.keys()))(**hparams)
+
+
+def to_device(batch, device):
+    return {key: value.to(device) for key, value in batch.items() if isinstance(value, torch.Tensor)}
+
+
+def run(args):
+    data_dir = tempfile.mkdtemp(prefix='hmnet_bench_') + '/'
+    try:
+        return run_benchmarks(args, data_dir)
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def run_benchmarks(args, data_dir):
+    torch.manual_seed(args.seed)
+    write_corpora(data_dir, args.num_meetings, args.num_turns, args.turn_length, args.vocab_size,
+                  args.summary_length, seed=args.seed)
+    hparams = build_hparams(args, data_dir)
+
+    results = collections.OrderedDict()
+    dataset = AMIDataset(hparams, type='test')
+    vocab_word, vocab_role, vocab_pos = dataset.vocab_word, dataset.vocab_role, dataset.vocab_pos
+
+    index = iter(range(10 ** 9))
+    results['dataset_getitem'] = summarize(timed(lambda: dataset[next(index) % len(dataset)], args.repeats))
+
+    # checkpoint != None skips loading GloVe vectors from spaCy
+    model = SummarizationModel(hparams=hparams, vocab_word=vocab_word, vocab_role=vocab_role,
+                               vocab_pos=vocab_pos, checkpoint='synthetic',
+                               word_counts=dataset.word_counts()).to(hparams.device)
+    model.eval()
+    predictor = Predictor(hparams, model=model, vocab_word=vocab_word, vocab_role=vocab_role, vocab_pos=vocab_pos)
+
+    batches = [to_device(batch, hparams.device) for batch in DataLoader(dataset, batch_size=1)]
+    batch = batches[0]
+    num_words = int(batch['dialogues_lens'].sum())
+
+    with torch.no_grad():
+        # The model cases run under autocast with --set autocast_dtype=bfloat16, as in training and decoding
+        def encode():
+            with autocast(hparams):
+                return model.encode(batch['dialogues_ids'], batch['src_masks'], role_ids=batch['role_ids'],
+                                    pos_ids=batch['pos_ids'], dialogues_lens=batch['dialogues_lens'])
+        results['encoder_forward'] = summarize(timed(encode, args.repeats), items_per_call=num_words)
+
+        word_level_outputs, turn_level_outputs = encode()
+        # Shared by all beams, as in Predictor.inference
+        word_memory, turn_memory = word_level_outputs, turn_level_outputs
+        tokens = torch.full([hparams.beam_size, 1], vocab_word.token2id['<BEGIN>'], dtype=torch.long,
+                            device=hparams.device)
+
+        state = model.decoder.init_decoder_state()
+        step = iter(range(10 ** 9))
+
+        def decoder_step():
+            current = next(step) % hparams.gen_max_length
+            if current == 0:
+                state._init_cache(model.decoder.num_layers, hparams.gen_max_length)
+            with autocast(hparams):
+                decoder_outputs, _ = model.decoder(inputs=(model.embedding_word(tokens), word_memory, turn_memory),
+                                                   state=state, step=current, word_turns=model.word_turns)
+                predictor.generator(decoder_outputs)
+        results['decoder_step'] = summarize(timed(decoder_step, args.repeats * 10),
+                                            items_per_call=hparams.beam_size)
+
+        # Beam bookkeeping alone, on fixed log-probabilities (advance modifies them in place)
+        num_beam_steps = args.repeats * 20 + 1
+        beam = BeamSearch(1, hparams.beam_size, num_beam_steps, vocab_word.token2id['<BEGIN>'],
+                          vocab_word.token2id['<END>'], min_length=hparams.min_length,
+                          block_trigram=hparams.blook_trigram, device=hparams.device)
+        fixed_log_probs = torch.randn(hparams.beam_size, len(vocab_word), device=hparams.device).log_softmax(-1)
+        log_probs = torch.empty_like(fixed_log_probs)
+        beam_steps = iter(range(num_beam_steps))
+
+        def beam_step():
+            beam.advance(next(beam_steps), log_probs.copy_(fixed_log_probs))
+        results['beam_step'] = summarize(timed(beam_step, args.repeats * 10), items_per_call=hparams.beam_size)
+        results['beam_step']['allocated_bytes_per_step'] = allocated_bytes(beam_step, args.repeats * 10)
+
+        summaries = []
+
+        def inference():
+            meeting = batches[len(summaries) % len(batches)]
+            summaries.append(predictor.inference(meeting['dialogues_ids'], meeting['src_masks'],
+                                                 role_ids=meeting['role_ids'], pos_ids=meeting['pos_ids'],
+                                                 dialogues_lens=meeting['dialogues_lens']))
+        results['inference'] = summarize(timed(inference, args.repeats, warmup=0))
+
+    references = [predictor.get_summaries(meeting['labels_ids'][0]) for meeting in batches]
+    candidates = [summaries[idx % len(summaries)] or 'empty' for idx in range(len(references))]
+    results['rouge'] = summarize(timed(lambda: compute_rouge_scores(candidates, references), args.repeats),
+                                 items_per_call=len(references))
+
+    # Forward and backward of a training meeting, full or sampled softmax (--set softmax_samples=N)
+    criterion = torch.nn.CrossEntropyLoss()
+    labels_ids = batch['labels_ids']
+    logits_bytes = []
+
+    def train_step():
+        sampled_labels = labels_ids[:, 1:] if hparams.softmax_samples > 0 else None
+        with autocast(hparams):
+            logits = model(inputs=batch['dialogues_ids'], targets=labels_ids[:, :-1], src_masks=batch['src_masks'],
+                           dialogues_lens=batch['dialogues_lens'], sampled_labels=sampled_labels)
+        targets = labels_ids[:, 1:].reshape(-1)
+        if sampled_labels is not None:
+            targets = torch.zeros_like(targets)
+        criterion(logits.float(), targets).backward()
+        logits_bytes.append(logits.numel() * logits.element_size())
+    results['train_step'] = summarize(timed(train_step, args.repeats), items_per_call=labels_ids.numel() - 1)
+    results['train_step']['logits_mb'] = logits_bytes[-1] / 1024 ** 2
+
+    checkpoint_path = os.path.join(data_dir, 'checkpoint_0.pth')
+    optimizer = build_optimizer(model, hparams)
+    # Gradients of one training step. Adam, or the row-wise LazyAdam with
+    # --set sparse_word_embedding=True --set softmax_samples=N
+    model.zero_grad(set_to_none=True)
+    train_step()
+    results['optimizer_step'] = summarize(timed(optimizer.step, args.repeats))
+    results['optimizer_step']['step_mb'] = optimizer_step_bytes(optimizer) / 1024 ** 2
+    torch.save({'model': model.state_dict(), 'optimizer': optimizer.state_dict()}, checkpoint_path)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        results['checkpoint_load'] = summarize(timed(lambda: load_checkpoint(checkpoint_path), args.repeats))
+
+    weights_path = os.path.join(data_dir, 'checkpoint_0.weights')
+    export_weights(model.state_dict(), weights_path)
+    results['weights_load'] = summarize(timed(lambda: load_weights(weights_path), args.repeats))
+
+    return {
+        'config': {key: value for key, value in vars(args).items() if key != 'output'},
+        'environment': {
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'cpu_count': os.cpu_count(),
+            'threads': torch.get_num_threads(),
+        },
+        'benchmarks': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='HMNet performance benchmarks on synthetic meetings')
+    parser.add_argument('--output', type=str, default='bench_results.json')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--num_meetings', type=int, default=4)
+    parser.add_argument('--num_turns', type=int, default=100)
+    parser.add_argument('--turn_length', type=int, default=40)
+    parser.add_argument('--vocab_size', type=int, default=5000)
+    parser.add_argument('--summary_length', type=int, default=100)
+    parser.add_argument('--beam_size', type=int, default=PARAMS['beam_size'])
+    parser.add_argument('--gen_max_length', type=int, default=50)
+    parser.add_argument('--set', type=str, action='append', default=[],
+                        help='hparam override, e.g. --set encoder_attention_window=32 (repeatable)')
+    args = parser.parse_args()
+
+    report = run(args)
+    with open(args.output, 'w') as output_handle:
+        json.dump(report, output_handle, indent=2)
+
+    for name, stats in report['benchmarks'].items():
+        print('{:<16} p50 {:>10.2f} ms  p90 {:>10.2f} ms  {:>10.1f}/s  peak RSS {:>8.1f} MB'.format(
+            name, stats['p50_ms'], stats['p90_ms'], stats['throughput_per_s'], stats['peak_rss_mb']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+Scaling of multi-process (torch.distributed, gloo) training on CPU.
+
+Trains on synthetic meetings with 1, 2, 4, ... processes through the same
+``Summarization.train`` path as ``main.py --world_size N`` and reports the
+training throughput, the speedup over one process and the scaling efficiency
+(speedup / number of processes). Every run uses all the cores of the machine,
+split evenly between its ranks.
+
+    python -m benchmarks.scaling --world_sizes 1 2 4 --output scaling.json
+"""
+import argparse
+import collections
+import json
+import os
+import shutil
+import tempfile
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from benchmarks.run import build_hparams
+from benchmarks.synthetic import write_corpora
+from models.model import SummarizationModel
+from train import Summarization, setup_distributed
+
+
+class SyntheticSummarization(Summarization):
+    def create_model(self):
+        # checkpoint != None skips loading GloVe vectors from spaCy
+        return SummarizationModel(hparams=self.hparams, vocab_word=self.vocab_word,
+                                  vocab_role=self.vocab_role, vocab_pos=self.vocab_pos, checkpoint='synthetic')
+
+
+def worker(rank, hparams_dict, results):
+    hparams = collections.namedtuple('HParams', sorted(hparams_dict.keys()))(**hparams_dict)
+    if hparams.world_size > 1:
+        setup_distributed(rank, hparams)
+    try:
+        stats = SyntheticSummarization(hparams, mode='train', rank=rank).train()
+    finally:
+        if hparams.world_size > 1:
+            dist.destroy_process_group()
+    if rank == 0:
+        results.put(stats)
+
+
+def run(args):
+    data_dir = tempfile.mkdtemp(prefix='hmnet_scaling_') + '/'
+    try:
+        write_corpora(data_dir, args.num_meetings, args.num_turns, args.turn_length, args.vocab_size,
+                      args.summary_length, seed=args.seed)
+        results = collections.OrderedDict()
+        for world_size in args.world_sizes:
+            hparams = build_hparams(args, data_dir)
+            hparams = hparams._replace(world_size=world_size, dist_port=args.port + world_size,
+                                       num_epochs=args.epochs, start_eval_epoch=10 ** 9,
+                                       save_dirpath=os.path.join(data_dir, 'run_{}'.format(world_size)) + '/')
+            queue = mp.get_context('spawn').SimpleQueue()
+            # One process even for world_size 1, so that every run pays the same start-up costs
+            mp.spawn(worker, args=(hparams._asdict(), queue), nprocs=world_size, join=True)
+            results[world_size] = queue.get()
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    base = results[args.world_sizes[0]]['meetings_per_sec'] / args.world_sizes[0]
+    for world_size, stats in results.items():
+        stats['speedup'] = stats['meetings_per_sec'] / base
+        stats['efficiency'] = stats['speedup'] / world_size
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='HMNet multi-process training scaling on synthetic meetings')
+    parser.add_argument('--output', type=str, default='scaling_results.json')
+    parser.add_argument('--world_sizes', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--epochs', type=int, default=1)
+    parser.add_argument('--port', type=int, default=29500)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--num_meetings', type=int, default=32)
+    parser.add_argument('--num_turns', type=int, default=50)
+    parser.add_argument('--turn_length', type=int, default=30)
+    parser.add_argument('--vocab_size', type=int, default=5000)
+    parser.add_argument('--summary_length', type=int, default=60)
+    parser.add_argument('--set', type=str, action='append', default=[],
+                        help='hparam override, e.g. --set gradient_accumulation_steps=4 (repeatable)')
+    args = parser.parse_args()
+    # build_hparams options that only matter for decoding
+    args.device, args.beam_size, args.gen_max_length = 'cpu', 1, args.summary_length
+
+    results = run(args)
+    report = {'config': {key: value for key, value in vars(args).items() if key != 'output'},
+              'cpu_count': os.cpu_count(), 'torch': torch.__version__,
+              'results': {str(world_size): stats for world_size, stats in results.items()}}
+    with open(args.output, 'w') as output_handle:
+        json.dump(report, output_handle, indent=2)
+
+    for world_size, stats in results.items():
+        print('world_size {:>3}  {:>8.2f} meetings/s  speedup {:>5.2f}  efficiency {:>6.1%}'.format(
+            world_size, stats['meetings_per_sec'], stats['speedup'], stats['efficiency']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""
+Synthetic meetings in the format of the AMI corpus pickles (``data/*_corpus``),
+so that ``AMIDataset`` and the model can be benchmarked without the AMI data.
+
+A corpus is a dict ``{meeting_id: {'texts': [(index, role, 'word/POS ...'), ...],
+'labels': 'summary text'}}``. Words are drawn from a Zipf distribution over a
+synthetic vocabulary, and every turn contains at least two sentences so that it
+passes the filtering in ``AMIDataset.__getitem__``.
+"""
+import os
+import random
+
+import torch
+
+ROLES = ['PM', 'ME', 'UI', 'ID']
+POS_TAGS = ['NN', 'VB', 'DT', 'IN', 'PRP', 'JJ', 'RB']
+
+
+def _zipf_words(rng, vocab_size, count):
+    weights = [1.0 / rank for rank in range(1, vocab_size + 1)]
+    return ['w{}'.format(index) for index in rng.choices(range(vocab_size), weights=weights, k=count)]
+
+
+def make_meeting(rng, num_turns, turn_length, vocab_size, summary_length):
+    texts = []
+    for turn_idx in range(num_turns):
+        words = _zipf_words(rng, vocab_size, max(turn_length - 2, 2))
+        # two sentence ends per turn
+        middle = len(words) // 2
+        words = words[:middle] + ['.'] + words[middle:] + ['.']
+        tagged = ' '.join('{}/{}'.format(word, 'PUNCT' if word == '.' else rng.choice(POS_TAGS)) for word in words)
+        texts.append((turn_idx, ROLES[turn_idx % len(ROLES)], tagged))
+
+    labels = ' '.join(_zipf_words(rng, vocab_size, summary_length))
+    return {'texts': texts, 'labels': labels}
+
+
+def make_corpus(num_meetings, num_turns, turn_length, vocab_size, summary_length, seed=0):
+    """Returns a corpus dict of num_meetings meetings with num_turns turns of turn_length tokens."""
+    rng = random.Random(seed)
+    return {'SYN{:04d}'.format(idx): make_meeting(rng, num_turns, turn_length, vocab_size, summary_length)
+            for idx in range(num_meetings)}
+
+
+def write_corpora(data_dir, num_meetings, num_turns, turn_length, vocab_size, summary_length, seed=0):
+    """Writes train/dev/test corpora to data_dir, which can be used as ``hparams.data_dir``."""
+    os.makedirs(data_dir, exist_ok=True)
+    for offset, split in enumerate(['train', 'dev', 'test']):
+        corpus = make_corpus(num_meetings, num_turns, turn_length, vocab_size, summary_length, seed=seed + offset)
+        torch.save(corpus, os.path.join(data_dir, split + '_corpus'))
+    return data_dir
@@ -9,9 +9,20 @@ PARAMS = defaultdict(
     # Environment
     device='cuda',
     # device='cpu',
-    workers=24,
+    # DataLoader workers for training and evaluation, -1 picks min(prefetch_depth, cores per process - 1)
+    workers=-1,
+    # Number of training batches built ahead of the training loop
+    prefetch_depth=4,
     gpu_ids=[0],
+    # Multi-process data-parallel training on CPU (torch.distributed), one process per rank
+    world_size=1,
+    dist_backend='gloo',
+    dist_port=29500,
+    # Ranks wait at a barrier while rank 0 checkpoints and evaluates
+    dist_timeout_minutes=360,
     data_dir='data/',
+    # Record per-module wall time with forward hooks (see utils/profiler.py)
+    profile=False,
     save_dirpath='',
     use_role=False,
     use_pos=False,
@@ -21,13 +32,29 @@ PARAMS = defaultdict(
     batch_size=1,
     num_epochs=100,
     start_eval_epoch=20,
+    # Evaluate checkpoints in a separate process instead of pausing training,
+    # with eval_num_threads CPU threads (0: PyTorch default)
+    async_eval=True,
+    eval_num_threads=0,
     fintune_word_embedding=True,
+    # Sparse word embedding gradients with a row-wise lazy Adam (utils/optim.py): only the rows of the tokens of
+    # each batch are updated. Requires softmax_samples > 0, so that the tied output projection only gets gradients
+    # for the rows of the labels and the sampled negatives.
+    sparse_word_embedding=False,
+    # Number of meetings whose gradients are accumulated before each optimizer step
+    gradient_accumulation_steps=1,
+    # Recompute encoder/decoder layer activations in backward instead of storing them
+    gradient_checkpointing=False,
+    # Mixed precision (autocast), e.g. 'bfloat16' on CPU. '' keeps everything in fp32.
+    autocast_dtype='',
     # Transformer
     embedding_size_word=300,
     embedding_size_role=20,
     embedding_size_pos=12,
     num_heads=2,
     num_hidden_layers=2,
+    # Decoder layers, 0 uses num_hidden_layers
+    num_decoder_layers=0,
     hidden_size=300,
     min_length=280,
     max_length=800,
@@ -36,12 +63,66 @@ PARAMS = defaultdict(
     attention_value_channels=0,
     filter_size=64,
     dropout=0.2,
+    # Chunked (online-softmax) attention over blocks of keys, used when the attention weights
+    # [batch, heads, queries, keys] would exceed attention_chunk_threshold elements. 0 disables it.
+    attention_chunk_size=1024,
+    attention_chunk_threshold=2 ** 24,
+    # Hierarchical attention: each decoding position only attends to the words of the
+    # top-k turns by turn-level attention score. 0 attends to the words of all turns.
+    hierarchical_top_k_turns=0,
+    # Sliding-window self-attention in the word-level encoder: every token attends to the tokens at most
+    # encoder_attention_window positions away, plus the first encoder_global_tokens tokens (<BOS>, whose
+    # output is the turn representation) which attend to the whole turn. 0 keeps dense attention.
+    encoder_attention_window=0,
+    encoder_global_tokens=1,
+    # Encode the turns of a meeting in chunks whose word-level encoder activations fit in this
+    # many MB. 0 encodes all turns at once.
+    encoder_memory_budget_mb=0,
     optimizer_adam_beta1=0.9,
     optimizer_adam_beta2=0.999,
+    # Sampled softmax training objective: the loss of every summary token is computed over the token and
+    # softmax_samples negatives drawn from the word frequencies (counts ** 0.75) instead of the whole vocabulary.
+    # 0 trains with the full softmax. Decoding and the dev loss always use the full softmax.
+    softmax_samples=0,
+    # Knowledge distillation (main.py --mode distill): a student with student_num_heads heads, student_hidden_size
+    # hidden units (also its word embedding size, initialized from the teacher's embedding by PCA) and
+    # student_num_decoder_layers decoder layers is trained on the outputs of the teacher checkpoint
+    # distill_teacher_path. The loss is (1 - distill_alpha) * cross-entropy + distill_alpha * distill_temperature^2 *
+    # KL(teacher || student) of the temperature-scaled distributions. With distill_sequence_level the targets are the
+    # teacher's beam search summaries of the training meetings (decoded once and stored) instead of the references.
+    distill_teacher_path='',
+    distill_alpha=0.5,
+    distill_temperature=2.0,
+    distill_sequence_level=False,
+    student_num_heads=1,
+    student_hidden_size=128,
+    student_num_decoder_layers=1,
     # Optimizier
     learning_rate=5e-4,
     max_gradient_norm=2,
+    # Training metrics (loss, throughput, data-loading wait, gradient norms) are
+    # accumulated on the device and written to TensorBoard every log_every_steps optimizer steps
+    log_every_steps=50,
+    # Checkpoint retention: the last checkpoint_keep_last checkpoints, the checkpoint_keep_best best by
+    # checkpoint_metric (dev_loss/dev_perplexity of the validation after every epoch, or a ROUGE score of
+    # Predictor.evaluate such as 'rouge_l_f_score' with checkpoint_metric_mode='max') and every
+    # checkpoint_keep_every-th epoch are kept, all others are deleted. All 0 keeps every checkpoint.
+    checkpoint_keep_last=3,
+    checkpoint_keep_best=3,
+    checkpoint_keep_every=0,
+    checkpoint_metric='dev_loss',
+    checkpoint_metric_mode='min',
+    # Stop when the dev loss has not improved by early_stopping_min_delta for early_stopping_patience
+    # epochs (0 disables). ROUGE is decoded, from start_eval_epoch on, for the epochs improving the dev loss.
+    early_stopping_patience=10,
+    early_stopping_min_delta=0.0,
+    # Generated summaries are stored per (weights hash, meeting, decode config) in this JSONL file and
+    # not decoded again, '' uses <save_dirpath>/results.jsonl
+    eval_results_path='',
     # Decoding
     beam_size=12,
+    # Storage of the word/turn-attention keys and values cached during decoding: '' keeps the compute dtype,
+    # 'bfloat16' halves and 'int8' (per head and position scales) quarters their memory
+    decoder_cache_dtype='',
     blook_trigram=True
 )
\ No newline at end of file
@@ -3,6 +3,7 @@ from torch.utils.data import Dataset
 from models.transformer.layers import _gen_seq_bias_mask
 from collections import Counter
 from tqdm import tqdm
+from data.vocab import Vocab
 
 # For input dialogues
 PAD = 0
@@ -25,9 +26,15 @@ class AttrDict(dict):
 
 class AMIDataset(Dataset):
     def __init__(self, hparams, type='', vocab_word=None,
-                 vocab_role=None, vocab_pos=None, max_vocab_size=50000):
+                 vocab_role=None, vocab_pos=None, max_vocab_size=50000,
+                 return_text=True, shared_memory=False):
         super().__init__()
         self.hparams = hparams
+        # return_text=False leaves the raw dialogues and labels out of the items, they are not needed for training
+        # and are expensive to send from DataLoader workers. shared_memory=True allocates the item tensors in
+        # shared memory so that they are sent to the main process without being copied.
+        self.return_text = return_text
+        self.shared_memory = shared_memory
 
         self.input_examples = torch.load(hparams.data_dir + type + '_corpus')
 
@@ -45,10 +52,13 @@ class AMIDataset(Dataset):
                 pos_sentence = ' '.join(word_pos.split('/')[1] for word_pos in each[2].split())
                 pos_sentence = pos_sentence.strip().lower()
                 dialogues.append({'role': role, 'sentence': sentence, 'pos_sentence': pos_sentence})
-            self.data_list.append({'labels': labels, 'dialogues': dialogues})
+            self.data_list.append({'meeting_id': key, 'labels': labels, 'dialogues': dialogues})
 
+        # Word frequencies of the corpora the vocabulary was built from, None for a given vocabulary
+        self.word_counter = None
         if (vocab_word == None) and (vocab_role == None):
             counter, role_counter, pos_counter = self.build_counter()
+            self.word_counter = counter
             self.vocab_word = self.build_vocab(counter, max_vocab_size, type='word')
             self.vocab_role = self.build_vocab(role_counter, max_vocab_size, type='role')
             self.vocab_pos = self.build_vocab(pos_counter, max_vocab_size, type='pos')
@@ -78,7 +88,7 @@ class AMIDataset(Dataset):
 
         label_tokens = self.tokenize(labels)
 
-        labels_ids = self.tokens2ids(label_tokens, self.vocab_word.token2id,
+        labels_ids = self.tokens2ids(label_tokens, self.vocab_word,
                                      is_reference=True) #(seq_len)
 
         for turn_idx, dialogue in enumerate(dialogues):
@@ -99,9 +109,9 @@ class AMIDataset(Dataset):
                 tokens = tokens[:self.hparams.max_length - 2]
                 pos_tokens = pos_tokens[:self.hparams.max_length - 2]
 
-            token_ids = self.tokens2ids(tokens, self.vocab_word.token2id)
-            pos_token_ids = self.tokens2ids(pos_tokens, self.vocab_pos.token2id)
-            role_token_ids = self.tokens2ids(role_tokens, self.vocab_role.token2id, is_role=True)
+            token_ids = self.tokens2ids(tokens, self.vocab_word)
+            pos_token_ids = self.tokens2ids(pos_tokens, self.vocab_pos)
+            role_token_ids = self.tokens2ids(role_tokens, self.vocab_role, is_role=True)
 
             dialogues_ids.append(token_ids)
             pos_ids.append(pos_token_ids)
@@ -111,8 +121,10 @@ class AMIDataset(Dataset):
         padded_pos_ids, _, _ = self.pad_sequence(pos_ids)
 
         data = dict()
-        data['dialogues'] = dialogues
-        data['labels'] = labels
+        data['meeting_id'] = self.data_list[index]['meeting_id']
+        if self.return_text:
+            data['dialogues'] = dialogues
+            data['labels'] = labels
         data['dialogues_ids'] = padded_dialogues
         data['pos_ids'] = padded_pos_ids
         data['dialogues_lens'] = torch.tensor(dialogues_lens).long()
@@ -121,18 +133,31 @@ class AMIDataset(Dataset):
         data['labels_ids'] = torch.tensor(labels_ids).long()
         return data
 
+    def empty(self, *size, dtype=torch.float):
+        tensor = torch.empty(*size, dtype=dtype)
+        if self.shared_memory:
+            # Shared before the data is written, so the item is built in place in shared memory
+            tensor.share_memory_()
+        return tensor
+
     def pad_sequence(self, seqs):
         lens = [len(seq) for seq in seqs]
         max_seq_length = max(lens)
-        padded_seqs = torch.zeros(len(seqs), max_seq_length).long()
+        padded_seqs = self.empty(len(seqs), max_seq_length, dtype=torch.long).fill_(PAD)
         for i, seq in enumerate(seqs):
             end_idx = lens[i]
             padded_seqs[i, :end_idx] = torch.LongTensor(seq[:end_idx])
 
-        src_masks = _gen_seq_bias_mask(lens, max_seq_length)
+        src_masks = _gen_seq_bias_mask(lens, max_seq_length,
+                                       out=self.empty(len(seqs), 1, max_seq_length, max_seq_length))
 
         return padded_seqs, lens, src_masks
 
+    def word_counts(self):
+        """Count of every word of vocab_word (0 for the special tokens), in id order."""
+        return torch.tensor([self.word_counter[token] for token in self.vocab_word.decode(range(len(self.vocab_word)))],
+                            dtype=torch.float)
+
     def tokenize(self, sentence):
         return sentence.split()
 
@@ -187,7 +212,6 @@ class AMIDataset(Dataset):
         return counter, role_counter, pos_counter
 
     def build_vocab(self, counter, max_vocab_size, type='word'):
-        vocab = AttrDict()
         if type == 'word':
             print("\n===== Building [Word Vocab] =========")
         elif type == 'role':
@@ -195,31 +219,25 @@ class AMIDataset(Dataset):
         elif type == 'pos':
             print("\n===== Building [POS Vocab] =========")
 
-        vocab.token2id = {'<PAD>': PAD, '<BOS>': BOS, '<EOS>': EOS,
-                          '<UNK>': UNK, '<BEGIN>': BEGIN, '<END>': END}
-        preset_vocab_size = len(vocab.token2id)
+        token2id = {'<PAD>': PAD, '<BOS>': BOS, '<EOS>': EOS,
+                    '<UNK>': UNK, '<BEGIN>': BEGIN, '<END>': END}
+        preset_vocab_size = len(token2id)
         print('preset_vocab_size: ', preset_vocab_size)
-        vocab.token2id.update(
+        token2id.update(
             {token: _id + preset_vocab_size for _id, (token, count) in
              tqdm(enumerate(counter.most_common(max_vocab_size)))})
-        vocab.id2token = {v: k for k, v in tqdm(vocab.token2id.items())}
-        print('Vocab size: ', len(vocab.token2id))
+        vocab = Vocab.from_token2id(token2id)
+        print('Vocab size: ', len(vocab))
         print('==========================================')
         return vocab
 
-    def tokens2ids(self, tokens, token2id, is_reference=False, is_role=False):
-        seq = []
-        if is_reference is False and is_role is False:
-            # For input dialogues.
-            seq.append(BOS)
-            seq.extend([token2id.get(token, UNK) for token in tokens])
-            seq.append(EOS)
-        elif is_reference:
-            # For target summaries.
-            seq.append(BEGIN)
-            seq.extend([token2id.get(token, UNK) for token in tokens])
-            seq.append(END)
-
+    def tokens2ids(self, tokens, vocab, is_reference=False, is_role=False):
+        # One batched lookup per sequence, unknown tokens are UNK
+        ids = vocab.encode(tokens).tolist()
         if is_role:
-            seq.extend([token2id.get(token, UNK) for token in tokens])
-        return seq
+            return ids
+        if is_reference:
+            # For target summaries.
+            return [BEGIN] + ids + [END]
+        # For input dialogues.
+        return [BOS] + ids + [EOS]
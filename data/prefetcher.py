@@ -0,0 +1,162 @@
+"""
+Prefetching input pipeline for training.
+
+DataLoader workers build meetings in shared memory (``AMIDataset(shared_memory=True)``),
+``collate_meetings`` batches single meetings without copying them, and a
+background thread keeps up to ``depth`` batches ready, so the training loop
+only moves tensors to the device. The loader reports the time the training
+loop waited for data, how busy the workers were, and how full the prefetch
+queue was.
+"""
+import os
+import queue
+import threading
+import time
+
+import torch
+from torch.utils.data import Dataset
+from torch.utils.data.dataloader import default_collate
+
+
+def auto_num_workers(depth, world_size=1):
+    """
+    Number of DataLoader workers: no more than the batches kept ready (more would only build items
+    that wait in the queue), and at least one core per training process left for the model.
+    """
+    cores_per_rank = (os.cpu_count() or 1) // max(1, world_size)
+    return max(0, min(depth, cores_per_rank - 1))
+
+
+def collate_meetings(batch):
+    """
+    default_collate, except that a batch of a single meeting is a view of the item (unsqueeze)
+    instead of a stacked copy, so tensors built in shared memory are sent as they are.
+    """
+    if len(batch) != 1:
+        return default_collate(batch)
+    return {key: value.unsqueeze(0) if torch.is_tensor(value) else default_collate([value])
+            for key, value in batch[0].items()}
+
+
+class TimedDataset(Dataset):
+    """Adds the time spent building each item (``build_time``, seconds) to the item."""
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        begin = time.perf_counter()
+        item = self.dataset[index]
+        item['build_time'] = time.perf_counter() - begin
+        return item
+
+
+class _Failure(object):
+    def __init__(self, exception):
+        self.exception = exception
+
+
+_END = object()
+
+
+class PrefetchLoader(object):
+    """Iterates a DataLoader on a background thread, keeping up to ``depth`` batches ready.
+
+    Parameters
+    ----------
+    dataloader: DataLoader
+        Loader over a ``TimedDataset`` (or any dataset), iterated once per epoch.
+    depth: int, optional (default=4)
+        Number of batches kept ready.
+
+    Example
+    --------
+    >>> dataset = TimedDataset(AMIDataset(hparams, type='train', return_text=False, shared_memory=True))
+    >>> loader = PrefetchLoader(DataLoader(dataset, num_workers=4, collate_fn=collate_meetings), depth=4)
+    >>> for batch in loader:
+    ...     inputs = batch['dialogues_ids'].to(device)
+    >>> loader.pop_stats()
+    """
+
+    def __init__(self, dataloader, depth=4):
+        self.dataloader = dataloader
+        self.depth = max(1, depth)
+        self.num_workers = dataloader.num_workers
+        self._reset_stats()
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    @property
+    def sampler(self):
+        return self.dataloader.sampler
+
+    def _reset_stats(self):
+        self.stats_begin = time.time()
+        self.wait_time = 0.
+        self.build_time = 0.
+        self.batches = 0
+        self.queue_fill = 0
+
+    def _produce(self, batches, stop):
+        try:
+            for batch in self.dataloader:
+                while not stop.is_set():
+                    try:
+                        batches.put(batch, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                if stop.is_set():
+                    return
+            batches.put(_END)
+        except Exception as exception:
+            batches.put(_Failure(exception))
+
+    def __iter__(self):
+        batches = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(batches, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                self.queue_fill += batches.qsize()
+                begin = time.time()
+                batch = batches.get()
+                self.wait_time += time.time() - begin
+
+                if batch is _END:
+                    return
+                if isinstance(batch, _Failure):
+                    raise batch.exception
+
+                self.batches += 1
+                if 'build_time' in batch:
+                    self.build_time += float(batch.pop('build_time').sum())
+                yield batch
+        finally:
+            # Also stops the thread when the loop is left early
+            stop.set()
+
+    def pop_stats(self):
+        """Statistics since the last call.
+
+        Returns
+        -------
+        dict
+            wait_time: seconds the consumer waited per batch.
+            worker_utilization: fraction of the worker (or main thread) time spent building items.
+            queue_fill: mean fraction of ``depth`` batches ready when a batch was requested.
+        """
+        elapsed = max(time.time() - self.stats_begin, 1e-9)
+        batches = max(1, self.batches)
+        stats = {
+            'wait_time': self.wait_time / batches,
+            'worker_utilization': self.build_time / (elapsed * max(1, self.num_workers)),
+            'queue_fill': self.queue_fill / (batches * self.depth),
+        }
+        self._reset_stats()
+        return stats
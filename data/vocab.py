@@ -0,0 +1,144 @@
+"""
+Array-backed vocabulary.
+
+A ``Vocab`` keeps its tokens in id order in a NumPy object array (decoding is
+a fancy-index of the id array) and in a sorted string array with the matching
+ids (encoding is a ``np.searchsorted`` over the whole token list). Pickles
+hold a single UTF-8 buffer and the token offsets, so vocabularies are small
+on disk and cheap to send to DataLoader and evaluation worker processes.
+
+``token2id`` and ``id2token`` are read-only mappings over the arrays, so code
+written for the ``AttrDict`` vocabularies of earlier runs keeps working, and
+``load_vocab`` converts ``vocab_word`` files written by those runs.
+"""
+from collections.abc import Mapping
+
+import numpy as np
+import torch
+
+
+class _Token2Id(Mapping):
+    def __init__(self, vocab):
+        self._vocab = vocab
+
+    def __getitem__(self, token):
+        token_id = self._vocab.lookup(token)
+        if token_id is None:
+            raise KeyError(token)
+        return token_id
+
+    def __contains__(self, token):
+        return self._vocab.lookup(token) is not None
+
+    def __iter__(self):
+        return iter(self._vocab.tokens)
+
+    def __len__(self):
+        return len(self._vocab)
+
+
+class _Id2Token(Mapping):
+    def __init__(self, vocab):
+        self._vocab = vocab
+
+    def __getitem__(self, token_id):
+        token_id = int(token_id)
+        if not 0 <= token_id < len(self._vocab):
+            raise KeyError(token_id)
+        return self._vocab.tokens[token_id]
+
+    def __iter__(self):
+        return iter(range(len(self._vocab)))
+
+    def __len__(self):
+        return len(self._vocab)
+
+
+class Vocab(object):
+    """Token <-> id table with batch ``encode``/``decode`` on id arrays.
+
+    Parameters
+    ----------
+    tokens: list of str
+        Tokens in id order, token ``i`` has id ``i``.
+    unk_token: str, optional (default='<UNK>')
+        Unknown tokens are encoded as the id of this token.
+
+    Example
+    --------
+    >>> vocab = Vocab(['<PAD>', '<BOS>', '<EOS>', '<UNK>', 'hello', 'world'])
+    >>> vocab.encode(['hello', 'there'])
+    array([4, 3])
+    >>> vocab.decode_text(torch.tensor([4, 5]))
+    'hello world'
+    """
+
+    def __init__(self, tokens, unk_token='<UNK>'):
+        self.unk_token = unk_token
+        self._build(list(tokens))
+
+    def _build(self, tokens):
+        if len(set(tokens)) != len(tokens):
+            raise ValueError('Vocabulary tokens must be unique')
+        self.tokens = np.empty(len(tokens), dtype=object)
+        self.tokens[:] = tokens
+        # Sorted token table for the binary-search lookup, and the id of each sorted token
+        self._sorted_ids = np.argsort(np.array(tokens, dtype=str), kind='stable')
+        self._sorted_tokens = np.array(tokens, dtype=str)[self._sorted_ids]
+        self.token2id = _Token2Id(self)
+        self.id2token = _Id2Token(self)
+        self.unk_id = self.lookup(self.unk_token)
+
+    @classmethod
+    def from_token2id(cls, token2id, unk_token='<UNK>'):
+        """Converts a ``{token: id}`` dict with the ids 0..len-1, e.g. of an ``AttrDict`` vocabulary."""
+        tokens = [None] * len(token2id)
+        for token, token_id in token2id.items():
+            if not 0 <= token_id < len(tokens) or tokens[token_id] is not None:
+                raise ValueError('Vocabulary ids must be 0..{} without gaps'.format(len(tokens) - 1))
+            tokens[token_id] = token
+        return cls(tokens, unk_token=unk_token)
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def lookup(self, token):
+        """Id of a single token, None if it is not in the vocabulary."""
+        pos = int(np.searchsorted(self._sorted_tokens, token))
+        if pos < len(self._sorted_tokens) and self._sorted_tokens[pos] == token:
+            return int(self._sorted_ids[pos])
+        return None
+
+    def encode(self, tokens):
+        """Ids (int64 array) of a list of tokens, unknown tokens map to the id of unk_token."""
+        if len(tokens) == 0:
+            return np.empty(0, dtype=np.int64)
+        tokens = np.asarray(tokens, dtype=str)
+        pos = np.searchsorted(self._sorted_tokens, tokens)
+        pos = np.minimum(pos, len(self._sorted_tokens) - 1)
+        found = self._sorted_tokens[pos] == tokens
+        if self.unk_id is None:
+            if not found.all():
+                raise KeyError(tokens[~found][0])
+            return self._sorted_ids[pos].astype(np.int64)
+        return np.where(found, self._sorted_ids[pos], self.unk_id).astype(np.int64)
+
+    def decode(self, ids):
+        """Tokens of an id tensor, array or list."""
+        if torch.is_tensor(ids):
+            ids = ids.detach().cpu().numpy()
+        return self.tokens[np.asarray(ids, dtype=np.int64).reshape(-1)].tolist()
+
+    def decode_text(self, ids):
+        """Tokens of ids joined by spaces."""
+        return ' '.join(self.decode(ids))
+
+    def __getstate__(self):
+        encoded = [token.encode('utf-8') for token in self.tokens]
+        offsets = np.cumsum([0] + [len(token) for token in encoded]).astype(np.int64)
+        return {'buffer': b''.join(encoded), 'offsets': offsets, 'unk_token': self.unk_token}
+
+    def __setstate__(self, state):
+        buffer, offsets = state['buffer'], state['offsets']
+        self.unk_token = state['unk_token']
+        self._build([buffer[start:end].decode('utf-8') for start, end in zip(offsets[:-1], offsets[1:])])
@@ -1,11 +1,20 @@
 import argparse
 import os
+import json
 import logging
 import collections
 from datetime import datetime
 from config.hparams import *
-from train import Summarization
+from train import Summarization, train_worker, build_trainer
+from utils.checkpointing import load_checkpoint, load_vocab, export_weights, restore_model_hparams
+from utils.results_store import ResultsStore
+from utils.vocab_pruning import select_token_ids, prune_checkpoint, vocab_coverage
+from utils.distillation import speed_quality_report
+from predictor import Predictor
+from data.dataset import AMIDataset
+import numpy as np
 import torch
+import torch.multiprocessing as mp
 from torch.utils.tensorboard import SummaryWriter
 
 
@@ -38,6 +47,31 @@ def init_logger(path):
   return logger
 
 
+def replace_runtime_options(hparams, args):
+    if args.device != '':
+        hparams = hparams._replace(device=args.device)
+    if args.autocast_dtype != '':
+        hparams = hparams._replace(autocast_dtype=args.autocast_dtype)
+    if args.decoder_cache_dtype != '':
+        hparams = hparams._replace(decoder_cache_dtype=args.decoder_cache_dtype)
+    if args.profile:
+        hparams = hparams._replace(profile=True)
+    if args.world_size > 0:
+        hparams = hparams._replace(world_size=args.world_size)
+    if args.results_path != '':
+        hparams = hparams._replace(eval_results_path=args.results_path)
+    return hparams
+
+
+def launch_training(hparams):
+    """Trains in this process, or in hparams.world_size processes (one per rank) with torch.distributed."""
+    if hparams.world_size <= 1:
+        return build_trainer(hparams).train()
+
+    # The HParams namedtuple class is not importable by the spawned processes, send the fields instead
+    mp.spawn(train_worker, args=(hparams._asdict(),), nprocs=hparams.world_size, join=True)
+
+
 def train_model(args):
     hparams = PARAMS
     hparams = collections.namedtuple("HParams", sorted(hparams.keys()))(**hparams)
@@ -49,10 +83,14 @@ def train_model(args):
     hparams = hparams._replace(save_dirpath=save_path)
     hparams = hparams._replace(use_role=args.use_role)
     hparams = hparams._replace(use_role=args.use_pos)
+    hparams = replace_runtime_options(hparams, args)
+    if args.mode == 'distill':
+        if args.teacher_path == '':
+            raise ValueError('Must provide teacher_path !')
+        hparams = hparams._replace(distill_teacher_path=args.teacher_path)
 
     print('hparams.save_dirpath: ', hparams.save_dirpath)
-    summarization = Summarization(hparams, mode='train')
-    summarization.train()
+    launch_training(hparams)
 
 
 def evaluate_model(args):
@@ -65,6 +103,8 @@ def evaluate_model(args):
     save_dirpath =  '/'.join(model_path.split('/')[:-1])
     save_dirpath = save_dirpath + '/'
     hparams = hparams._replace(save_dirpath=save_dirpath)
+    # Model sizes of the training run (e.g. of a distilled student)
+    hparams = restore_model_hparams(hparams, save_dirpath)
 
     # gen_max_length
     gen_max_length = args.gen_max_length
@@ -72,12 +112,29 @@ def evaluate_model(args):
     hparams = hparams._replace(gen_max_length=gen_max_length)
     hparams = hparams._replace(use_role=args.use_role)
     hparams = hparams._replace(use_role=args.use_pos)
+    hparams = replace_runtime_options(hparams, args)
 
     epoch = hparams.start_eval_epoch
+    epochs = range(int(epoch), 100)
+
+    # Only decode the best checkpoints by the metric recorded during training (e.g. dev loss)
+    manifest_path = os.path.join(save_dirpath, 'checkpoints.json')
+    if os.path.exists(manifest_path) and not args.all_checkpoints:
+        with open(manifest_path) as manifest_handle:
+            scored = [entry for entry in json.load(manifest_handle)['checkpoints'] if entry['metric'] is not None]
+        scored.sort(key=lambda entry: entry['metric'], reverse=hparams.checkpoint_metric_mode == 'max')
+        epochs = sorted(entry['epoch'] for entry in scored[:max(1, hparams.checkpoint_keep_best)])
+        print('Best checkpoints by {}: {}'.format(hparams.checkpoint_metric, epochs))
 
     print('\n ========= [Evaluation Start Epoch: ', epoch, ']================== ')
-    for i in range(int(epoch), 100):
+    for i in epochs:
         load_pthpath = '/'.join(model_path.split('/')[:-1]) + '/checkpoint_' + str(i) + '.pth'
+        # Prefer the weights-only export of the checkpoint
+        if os.path.exists(load_pthpath[:-len('.pth')] + '.weights'):
+            load_pthpath = load_pthpath[:-len('.pth')] + '.weights'
+        # Checkpoints removed by the retention policy
+        if not os.path.exists(load_pthpath):
+            continue
         hparams= hparams._replace(load_pthpath=load_pthpath)
         print('hparams.load_pthpath: ', hparams.load_pthpath)
         summarization = Summarization(hparams, mode='eval')
@@ -87,10 +144,110 @@ def evaluate_model(args):
     print('\n')
 
 
+def export_model(args):
+    """Writes <checkpoint>.weights: the model weights of a training checkpoint without the optimizer
+    state, with the word vocabulary of the training run in the header."""
+    model_path = args.model_path
+    if model_path == '':
+        raise ValueError('Must provide model_path !')
+
+    model_state_dict, _ = load_checkpoint(model_path)
+    metadata = {}
+    vocab_path = os.path.join(os.path.dirname(model_path), 'vocab_word')
+    if os.path.exists(vocab_path):
+        vocab_word = load_vocab(vocab_path)
+        metadata['vocab_word'] = vocab_word.decode(range(len(vocab_word)))
+
+    weights_path = os.path.splitext(model_path)[0] + '.weights'
+    export_weights(model_state_dict, weights_path, metadata=metadata)
+    print('Exported weights to: ', weights_path)
+
+
+def prune_model(args):
+    """Writes <save_path>/<checkpoint>.pth and <save_path>/vocab_word: the checkpoint restricted to the words
+    kept by --prune_min_count/--prune_coverage/--prune_vocab_size (counted in train+dev)."""
+    hparams = PARAMS
+    hparams = collections.namedtuple("HParams", sorted(hparams.keys()))(**hparams)
+
+    model_path = args.model_path
+    if model_path == '':
+        raise ValueError('Must provide model_path !')
+    if args.save_path == '':
+        raise ValueError('Must provide save_path !')
+
+    vocab_word = load_vocab(os.path.join(os.path.dirname(model_path), 'vocab_word'))
+    # Word counts of the corpora the vocabulary was built from
+    word_counter = AMIDataset(hparams, type='train').word_counter
+    counts = [word_counter[token] for token in vocab_word.decode(range(len(vocab_word)))]
+
+    keep_ids = select_token_ids(counts, min_count=args.prune_min_count, coverage=args.prune_coverage,
+                                max_size=args.prune_vocab_size)
+    model_state_dict, optimizer_state_dict = load_checkpoint(model_path)
+    output_path = os.path.join(args.save_path, os.path.basename(model_path))
+    prune_checkpoint(model_state_dict, optimizer_state_dict, vocab_word, keep_ids, output_path)
+
+    total = sum(word_counter.values())
+    print('Vocab size: {} -> {}, coverage of train+dev words: {:.4f} -> {:.4f}'.format(
+        len(vocab_word), len(keep_ids), vocab_coverage(counts, np.arange(len(counts)), total=total),
+        vocab_coverage(counts, keep_ids, total=total)))
+    print('Pruned checkpoint written to: ', output_path)
+
+
+def distillation_report(args):
+    """Decodes the test set with the teacher and the distilled student, writes their decoding time, size and
+    ROUGE scores to distillation_report.json next to the student checkpoint."""
+    hparams = PARAMS
+    hparams = collections.namedtuple("HParams", sorted(hparams.keys()))(**hparams)
+
+    model_path, teacher_path = args.model_path, args.teacher_path
+    if model_path == '' or teacher_path == '':
+        raise ValueError('Must provide model_path and teacher_path !')
+    hparams = hparams._replace(gen_max_length=args.gen_max_length)
+    hparams = replace_runtime_options(hparams, args)
+    student_dirpath = os.path.dirname(model_path)
+    student_hparams = restore_model_hparams(hparams._replace(save_dirpath=student_dirpath + '/',
+                                                             load_pthpath=model_path), student_dirpath)
+    teacher_hparams = restore_model_hparams(hparams._replace(load_pthpath=teacher_path), os.path.dirname(teacher_path))
+
+    # Test set encoded with the vocabulary of the student (the teacher's)
+    summarization = Summarization(student_hparams, mode='eval')
+    teacher = Predictor(teacher_hparams, vocab_word=summarization.vocab_word, vocab_role=summarization.vocab_role,
+                        vocab_pos=summarization.vocab_pos, checkpoint=teacher_path)
+    report = speed_quality_report({'teacher': teacher, 'student': summarization.predictor},
+                                  summarization.test_dataloader, device=hparams.device)
+    report['teacher']['checkpoint'], report['student']['checkpoint'] = teacher_path, model_path
+
+    report_path = os.path.join(student_dirpath, 'distillation_report.json')
+    with open(report_path, 'w') as report_handle:
+        json.dump(report, report_handle, indent=2)
+    print(json.dumps(report, indent=2))
+    print('Report written to: ', report_path)
+
+
+def rouge_from_results(args):
+    """ROUGE of every (checkpoint, decode config) in a results store, without decoding."""
+    results_path = args.results_path
+    if results_path == '':
+        raise ValueError('Must provide results_path !')
+
+    results_store = ResultsStore(results_path)
+    for (checkpoint, decode_key), entries in sorted(results_store.runs().items()):
+        epochs = sorted(set(entry['epoch'] for entry in entries if entry.get('epoch') is not None))
+        print('[checkpoint {} epoch {} decode {}] {} meetings, decode config: {}'.format(
+            checkpoint[:12], epochs, decode_key, len(entries), entries[0]['decode']))
+        print('[ROUGE]: ', results_store.rouge(checkpoint, decode_key))
+        decode_seconds = [entry['decode_seconds'] for entry in entries if 'decode_seconds' in entry]
+        if decode_seconds:
+            num_tokens = sum(len(entry['summary'].split()) for entry in entries if 'decode_seconds' in entry)
+            print('[Decoding]: {:.2f} s per meeting, {:.1f} tokens/s'.format(
+                sum(decode_seconds) / len(decode_seconds), num_tokens / max(sum(decode_seconds), 1e-9)))
+    results_store.close()
+
+
 if __name__ == '__main__':
     arg_parser = argparse.ArgumentParser(description="End-to-End Meeting Summarization (PyTorch)")
     arg_parser.add_argument("--mode", dest="mode", type=str, default="",
-                            help="(train/eval)")
+                            help="(train/distill/eval/export/prune/distill_report/rouge)")
     arg_parser.add_argument("--model_path", dest="model_path", type=str, default="",
                             help="trained model path")
     arg_parser.add_argument("--save_path", dest="save_path", type=str, default="",
@@ -101,14 +258,44 @@ if __name__ == '__main__':
                             default=False)
     arg_parser.add_argument("--use_pos", dest="use_pos", type=bool,
                             default=False)
+    arg_parser.add_argument("--device", dest="device", type=str, default="",
+                            help="(cuda/cpu), overrides hparams.device")
+    arg_parser.add_argument("--autocast_dtype", dest="autocast_dtype", type=str, default="",
+                            help="run training/inference under autocast with this dtype (e.g. bfloat16)")
+    arg_parser.add_argument("--decoder_cache_dtype", dest="decoder_cache_dtype", type=str, default="",
+                            help="storage of the cached encoder keys/values while decoding (bfloat16/int8)")
+    arg_parser.add_argument("--all_checkpoints", dest="all_checkpoints", action="store_true",
+                            help="evaluate every checkpoint from start_eval_epoch, not only the best in checkpoints.json")
+    arg_parser.add_argument("--world_size", dest="world_size", type=int, default=0,
+                            help="number of training processes (torch.distributed on CPU), overrides hparams.world_size")
+    arg_parser.add_argument("--results_path", dest="results_path", type=str, default="",
+                            help="JSONL store of generated summaries, overrides hparams.eval_results_path")
+    arg_parser.add_argument("--teacher_path", dest="teacher_path", type=str, default="",
+                            help="distill/distill_report: teacher checkpoint, overrides hparams.distill_teacher_path")
+    arg_parser.add_argument("--prune_min_count", dest="prune_min_count", type=int, default=0,
+                            help="prune: drop the words seen fewer times in train+dev")
+    arg_parser.add_argument("--prune_coverage", dest="prune_coverage", type=float, default=1.0,
+                            help="prune: keep the most frequent words covering this fraction of the train+dev words")
+    arg_parser.add_argument("--prune_vocab_size", dest="prune_vocab_size", type=int, default=0,
+                            help="prune: maximum vocabulary size, special tokens included")
+    arg_parser.add_argument("--profile", dest="profile", action="store_true",
+                            help="record per-module timings to <save_path>/profile (Chrome trace + summary)")
 
 
     args = arg_parser.parse_args()
     mode = args.mode
 
-    if mode == 'train':
+    if mode in ('train', 'distill'):
         train_model(args)
     elif mode == 'eval':
         evaluate_model(args)
+    elif mode == 'export':
+        export_model(args)
+    elif mode == 'prune':
+        prune_model(args)
+    elif mode == 'distill_report':
+        distillation_report(args)
+    elif mode == 'rouge':
+        rouge_from_results(args)
 
 
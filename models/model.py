@@ -2,11 +2,30 @@ import spacy
 from utils.utils import load_spacy_glove_embedding
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from models import transformer
 
 
+def compact_word_memory(word_level_outputs, lengths):
+    """
+    Removes the padding positions of the word-level encoder outputs.
+
+    :param
+    word_level_outputs: [num_turns, padded_seq_len, hidden_size]
+    lengths: [num_turns] number of real tokens of every turn
+
+    :return:
+    [num_words, hidden_size] outputs of the real tokens, in turn order
+    [num_words, 2] LongTensor with the (turn, position) of every row
+    """
+    positions = torch.arange(word_level_outputs.shape[1], device=word_level_outputs.device)
+    valid = positions.unsqueeze(0) < lengths.to(word_level_outputs.device).unsqueeze(1) # [num_turns, padded_seq_len]
+    return word_level_outputs[valid], valid.nonzero()
+
+
 class SummarizationModel(nn.Module):
-    def __init__(self, hparams=None, vocab_word=None, vocab_role=None, vocab_pos=None, checkpoint=None):
+    def __init__(self, hparams=None, vocab_word=None, vocab_role=None, vocab_pos=None, checkpoint=None,
+                 word_counts=None, embedding_weight=None):
         super(SummarizationModel, self).__init__()
         self.hparams = hparams
 
@@ -14,8 +33,9 @@ class SummarizationModel(nn.Module):
         torch.manual_seed(seed_value)
         torch.backends.cudnn.deterministic = True
 
-        torch.cuda.set_device(0)
-        torch.cuda.manual_seed(seed_value)
+        if torch.cuda.is_available():
+            torch.cuda.set_device(0)
+            torch.cuda.manual_seed(seed_value)
 
         torch.manual_seed(seed_value)
         torch.backends.cudnn.deterministic = True
@@ -33,16 +53,24 @@ class SummarizationModel(nn.Module):
         if hparams.use_pos and self.vocab_role is None:
             raise ValueError('Must provide vocab_role !')
 
+        if hparams.sparse_word_embedding and hparams.softmax_samples <= 0:
+            # The full softmax gives the (tied) output projection a dense gradient over the whole vocabulary
+            raise ValueError('sparse_word_embedding requires the sampled softmax (softmax_samples > 0) !')
+
         self.vocab_size = len(self.vocab_word.token2id)
         self.vocab_role_size = len(self.vocab_role.token2id)
         self.vocab_pos_size = len(self.vocab_pos.token2id)
-        self.embedding_word = nn.Embedding(self.vocab_size, hparams.embedding_size_word)
+        # Sparse gradients hold only the rows of the tokens of the batch, see utils/optim.py
+        self.embedding_word = nn.Embedding(self.vocab_size, hparams.embedding_size_word,
+                                           sparse=hparams.sparse_word_embedding)
 
         if checkpoint is None:
-            # Load glove embeddings from spacy library
-            nlp = spacy.load('en_core_web_lg')
-            glove_embedding = load_spacy_glove_embedding(nlp, self.vocab_word)
-            self.embedding_word.weight.data.copy_(glove_embedding)
+            if embedding_weight is None:
+                # Load glove embeddings from spacy library
+                nlp = spacy.load('en_core_web_lg')
+                embedding_weight = load_spacy_glove_embedding(nlp, self.vocab_word)
+            # Otherwise a given initialization, e.g. the teacher embedding of a distilled student
+            self.embedding_word.weight.data.copy_(embedding_weight)
             self.embedding_word.weight.requires_grad = hparams.fintune_word_embedding
 
         if self.hparams.use_pos:
@@ -65,7 +93,12 @@ class SummarizationModel(nn.Module):
             hparams.dropout,
             hparams.dropout,
             hparams.dropout,
-            use_mask=False
+            use_mask=False,
+            use_checkpoint=hparams.gradient_checkpointing,
+            attention_chunk_size=hparams.attention_chunk_size,
+            attention_chunk_threshold=hparams.attention_chunk_threshold,
+            attention_window=hparams.encoder_attention_window,
+            num_global_tokens=hparams.encoder_global_tokens
         )
 
         self.turn_level_encoder = transformer.Encoder(
@@ -81,14 +114,17 @@ class SummarizationModel(nn.Module):
             hparams.dropout,
             hparams.dropout,
             hparams.dropout,
-            use_mask=False
+            use_mask=False,
+            use_checkpoint=hparams.gradient_checkpointing,
+            attention_chunk_size=hparams.attention_chunk_size,
+            attention_chunk_threshold=hparams.attention_chunk_threshold
         )
 
         # Define Decoder
         self.decoder = transformer.Decoder(
             hparams.embedding_size_word,
             hparams.hidden_size,
-            hparams.num_hidden_layers,
+            hparams.num_decoder_layers or hparams.num_hidden_layers,
             hparams.num_heads,
             hparams.attention_key_channels,
             hparams.attention_value_channels,
@@ -98,24 +134,46 @@ class SummarizationModel(nn.Module):
             hparams.dropout,
             hparams.dropout,
             hparams.dropout,
-            use_mask=True
+            use_mask=True,
+            use_checkpoint=hparams.gradient_checkpointing,
+            attention_chunk_size=hparams.attention_chunk_size,
+            attention_chunk_threshold=hparams.attention_chunk_threshold,
+            top_k_turns=hparams.hierarchical_top_k_turns,
+            cache_dtype=hparams.decoder_cache_dtype
         )
 
         # Reuse the weight of embedding matrix D, to decode v_{k-1} into a probability distribution
         self.final_linear = nn.Linear(self.embedding_word.embedding_dim, self.embedding_word.num_embeddings) # [300, vocab_size]
-        if checkpoint is None:
-            self.final_linear.weight = self.embedding_word.weight
-
-    def forward(self, inputs, targets, src_masks=None, role_ids=None, pos_ids=None):
+        # Also tied when the weights are loaded from a checkpoint, so that the model (and a .weights export of
+        # it) holds a single [vocab_size, 300] matrix
+        self.final_linear.weight = self.embedding_word.weight
+
+        # Sampled softmax (training only): negatives are drawn from the unigram distribution (counts ** 0.75)
+        # of the training words, not saved in checkpoints
+        self.softmax_samples = hparams.softmax_samples
+        self.register_buffer('sampling_probs', None, persistent=False)
+        if self.softmax_samples > 0 and word_counts is not None:
+            sampling_probs = torch.as_tensor(word_counts, dtype=torch.float).clamp(min=1.) ** 0.75
+            self.sampling_probs = sampling_probs / sampling_probs.sum()
+
+        # (turn, position) of every row of the last encoded word memory, kept for analysis, and the turn of every
+        # row (hierarchical attention), None when the memory keeps the padded [num_turns x seq_len] layout
+        self.word_memory_index = None
+        self.word_turns = None
+
+    def encode(self, inputs, src_masks, role_ids=None, pos_ids=None, dialogues_lens=None):
         """
+        Runs the word-level and turn-level encoders.
 
         :param
 
         inputs: [batch_size, num_turns, padded_seq_len]
-        targets: [batch_size, seq_len]
-        src_mask: [num_turns, batch_size, padded_seq_len]
+        src_mask: [batch_size, num_turns, 1, padded_seq_len, padded_seq_len]
+        dialogues_lens: [batch_size, num_turns], if given the padding positions are removed from the word memory
 
         :return:
+        word_level_outputs: [1, num_words, 300] decoder word memory
+        turn_level_outputs: [1, num_turns, 300]
         """
 
         src_masks = src_masks.squeeze(0) # [num_turns, batch_size, padded_seq_len, padded_seq_len]
@@ -130,8 +188,7 @@ class SummarizationModel(nn.Module):
             inputs_word_emb = torch.cat((inputs_word_emb, inputs_pos_emb), -1)
 
         # Word-level Attention
-        word_level_outputs = self.word_level_encoder(inputs=inputs_word_emb,
-                                                     src_masks=src_masks, role_inputs=None) # [num_turns, seq_len, 300]
+        word_level_outputs = self.encode_words(inputs_word_emb, src_masks) # [num_turns, seq_len, 300]
 
         # Turn-level Attention
         turn_level_inputs = word_level_outputs[:, 0] # [num_turns, 300]
@@ -147,15 +204,125 @@ class SummarizationModel(nn.Module):
                                                          src_masks=None,
                                                          role_inputs=None)  # [1, num_turns, 300]
 
+        # word_level_outputs = word_level_outputs[:, 1:]
+        if dialogues_lens is not None:
+            word_level_outputs, self.word_memory_index = compact_word_memory(word_level_outputs,
+                                                                             dialogues_lens.view(-1)) # [num_words, 300]
+            self.word_turns = self.word_memory_index[:, 0]
+        else:
+            word_level_shape = word_level_outputs.shape
+            word_level_outputs = word_level_outputs.reshape(word_level_shape[0] * word_level_shape[1],
+                                                            word_level_shape[-1])
+            self.word_memory_index = None
+            self.word_turns = None
+        word_level_outputs = word_level_outputs.unsqueeze(0) # [1, num_words, 300]
+
+        return word_level_outputs, turn_level_outputs
+
+    def encode_words(self, inputs_word_emb, src_masks):
+        """
+        Runs the word-level encoder over chunks of turns, so that the activations of one chunk
+        stay within hparams.encoder_memory_budget_mb. Turns are encoded independently, so the
+        outputs are the same as encoding all turns at once.
+
+        :param
+        inputs_word_emb: [num_turns, seq_len, word_dim]
+        src_masks: [num_turns, 1, seq_len, seq_len]
+
+        :return:
+        [num_turns, seq_len, 300]
+        """
+        num_turns, seq_len = inputs_word_emb.shape[:2]
+        turns_per_chunk = num_turns
+        if self.hparams.encoder_memory_budget_mb > 0:
+            budget = self.hparams.encoder_memory_budget_mb * 1024 ** 2
+            turns_per_chunk = max(1, int(budget // self.turn_encoding_bytes(seq_len)))
+
+        if turns_per_chunk >= num_turns:
+            return self.word_level_encoder(inputs=inputs_word_emb, src_masks=src_masks, role_inputs=None)
+
+        word_level_outputs = []
+        for start in range(0, num_turns, turns_per_chunk):
+            end = start + turns_per_chunk
+            word_level_outputs.append(self.word_level_encoder(inputs=inputs_word_emb[start:end],
+                                                              src_masks=src_masks[start:end], role_inputs=None))
+        return torch.cat(word_level_outputs, 0)
+
+    def turn_encoding_bytes(self, seq_len):
+        """
+        Estimated peak activation memory (bytes) of the word-level encoder for one turn of seq_len tokens:
+        attention logits, weights and dropout mask per head, plus the hidden and filter activations.
+        All layers are counted when activations are kept for backward.
+        """
+        hparams = self.hparams
+        attended = seq_len
+        if hparams.encoder_attention_window > 0:
+            attended = min(seq_len, 3 * hparams.encoder_attention_window + hparams.encoder_global_tokens)
+        layer_elements = 3 * hparams.num_heads * seq_len * attended + \
+                         seq_len * (10 * hparams.hidden_size + 2 * hparams.filter_size)
+        num_layers = hparams.num_hidden_layers if (self.training and torch.is_grad_enabled()) else 1
+        return 4 * layer_elements * num_layers
+
+    def sampled_logits(self, decoder_outputs, labels):
+        """
+        Logits of the sampled softmax: the label and softmax_samples negatives shared by all positions, corrected
+        by the log of their expected number of samples. Negatives equal to the label are masked.
+
+        :param
+        decoder_outputs: [batch_size, seq_len, hidden_size]
+        labels: [batch_size, seq_len]
+
+        :return:
+        [batch_size x seq_len, 1 + softmax_samples], the label is class 0
+        """
+        if self.sampling_probs is None:
+            raise ValueError('Must provide word_counts and softmax_samples > 0 for the sampled softmax !')
+        hidden = decoder_outputs.reshape(-1, decoder_outputs.shape[-1])
+        labels = labels.reshape(-1)
+        num_labels = labels.shape[0]
+        negatives = torch.multinomial(self.sampling_probs, self.softmax_samples, replacement=True)
+
+        ids = torch.cat((labels, negatives))
+        # With sparse_word_embedding the gathered rows of the (tied) weight get a sparse gradient, like the embedding
+        weight = F.embedding(ids, self.final_linear.weight, sparse=self.embedding_word.sparse)
+        bias = self.final_linear.bias[ids]
+        label_logits = (hidden * weight[:num_labels]).sum(-1, keepdim=True) + bias[:num_labels].unsqueeze(1)
+        negative_logits = torch.matmul(hidden, weight[num_labels:].t()) + bias[num_labels:]
+
+        # Computed in fp32 under autocast
+        log_expected_counts = torch.log(self.softmax_samples * self.sampling_probs[ids])
+        label_logits = label_logits.float() - log_expected_counts[:num_labels].unsqueeze(1)
+        negative_logits = negative_logits.float() - log_expected_counts[num_labels:].unsqueeze(0)
+        negative_logits = negative_logits.masked_fill(labels.unsqueeze(1) == negatives.unsqueeze(0), float('-inf'))
+        return torch.cat((label_logits, negative_logits), dim=1)
+
+    def forward(self, inputs, targets, src_masks=None, role_ids=None, pos_ids=None, dialogues_lens=None,
+                sampled_labels=None):
+        """
+
+        :param
+
+        inputs: [batch_size, num_turns, padded_seq_len]
+        targets: [batch_size, seq_len]
+        src_mask: [num_turns, batch_size, padded_seq_len]
+        dialogues_lens: [batch_size, num_turns]
+        sampled_labels (optional): [batch_size, seq_len] next tokens, returns the logits of the sampled softmax
+                                   (see sampled_logits) instead of the full vocabulary
+
+        :return:
+        """
+
+        word_level_outputs, turn_level_outputs = self.encode(inputs, src_masks, role_ids=role_ids, pos_ids=pos_ids,
+                                                             dialogues_lens=dialogues_lens)
+
         # Target Self-Attention
         targets_word_emb = self.embedding_word(targets) # [1, tgt_seq_len, 300]
 
-        # word_level_outputs = word_level_outputs[:, 1:]
-        word_level_shape = word_level_outputs.shape
-        word_level_outputs = word_level_outputs.reshape(word_level_shape[0] * word_level_shape[1], 300)
-        word_level_outputs = word_level_outputs.unsqueeze(0) # [1, num_turns x seq_len, 300]
+        decoder_outputs, state = self.decoder((targets_word_emb, word_level_outputs, turn_level_outputs),
+                                              word_turns=self.word_turns) # [1, tgt_seq_len, 300]
 
-        decoder_outputs, state = self.decoder((targets_word_emb, word_level_outputs, turn_level_outputs)) # [1, tgt_seq_len, 300]
+        if sampled_labels is not None:
+            return self.sampled_logits(decoder_outputs, sampled_labels)
 
         logits = self.final_linear(decoder_outputs)
 
@@ -163,5 +330,3 @@ class SummarizationModel(nn.Module):
         logits = logits.view(shape[0]*shape[1], shape[-1]) # [beam_size x tgt_seq_len, vocab_size]
 
         return logits
-
-
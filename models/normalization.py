@@ -15,6 +15,9 @@ class LayerNorm(nn.Module):
         self.eps = eps
 
     def forward(self, x):
-        mean = x.mean(-1, keepdim=True)
-        std = x.std(-1, keepdim=True)
-        return self.gamma * (x - mean) / (std + self.eps) + self.beta
\ No newline at end of file
+        # Statistics are always computed in fp32, also under bf16/fp16 autocast.
+        x_float = x.float()
+        mean = x_float.mean(-1, keepdim=True)
+        std = x_float.std(-1, keepdim=True)
+        outputs = self.gamma * (x_float - mean) / (std + self.eps) + self.beta
+        return outputs.type_as(x)
@@ -4,13 +4,14 @@ from __future__ import print_function
 
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 
 import numpy as np
 import math
+import inspect
 from .sublayers import MultiHeadAttention, PositionwiseFeedForward
 from ..normalization import LayerNorm
 from collections import defaultdict
-import time
 
 
 def tile(a, dim, n_tile):
@@ -22,6 +23,15 @@ def tile(a, dim, n_tile):
     return torch.index_select(a, dim, order_index)
 
 
+def _checkpoint(function, *args):
+    """
+    Activation checkpointing of function(*args), using the non-reentrant variant where available
+    """
+    if 'use_reentrant' in inspect.signature(checkpoint).parameters:
+        return checkpoint(function, *args, use_reentrant=False)
+    return checkpoint(function, *args)
+
+
 def _gen_bias_mask(max_length):
     """
     Generates bias values (-Inf) to mask future timesteps during attention
@@ -32,17 +42,24 @@ def _gen_bias_mask(max_length):
     return torch_mask.unsqueeze(0).unsqueeze(1) # [1, num_heads, max_length, max_length]
 
 
-def _gen_seq_bias_mask(valid_length_list, max_seq_length):
-    seq_mask = np.full([len(valid_length_list), max_seq_length, max_seq_length], 0)
-    for idx, length in enumerate(valid_length_list):
-        seq_mask[idx, :, length:] = -np.inf
-
-    for idx, length in enumerate(valid_length_list):
-        seq_mask[idx, length:] = -np.inf
+def _gen_seq_bias_mask(valid_length_list, max_seq_length, out=None):
+    """
+    Generates bias values masking the padding positions (rows and columns) of every turn.
+    A large finite value (int64 min) is used instead of -Inf so that fully padded rows do not produce NaNs.
+    If given, the mask is written into out, a float tensor of shape [num_turns, 1, max_seq_length, max_seq_length]
+    (e.g. allocated in shared memory).
+    """
+    lengths = np.array(valid_length_list).reshape(-1, 1)
+    padding = np.arange(max_seq_length).reshape(1, -1) >= lengths # [num_turns, max_seq_length]
+    masked = padding[:, np.newaxis, :] | padding[:, :, np.newaxis]
 
-    seq_mask = torch.from_numpy(seq_mask).type(torch.FloatTensor) # [num_turns, max_seq_length, max_seq_length]
+    if out is None:
+        out = torch.empty(len(valid_length_list), 1, max_seq_length, max_seq_length)
+    seq_mask = out.numpy().reshape(masked.shape) # [num_turns, max_seq_length, max_seq_length], shares memory with out
+    seq_mask.fill(0)
+    seq_mask[masked] = np.float32(np.iinfo(np.int64).min)
 
-    return seq_mask.unsqueeze(1) # [num_turns, 1, max_seq_length, max_seq_length]
+    return out # [num_turns, 1, max_seq_length, max_seq_length]
 
 
 def _gen_timing_signal(length, channels, min_timescale=1.0, max_timescale=1.0e4):
@@ -69,7 +86,8 @@ def _gen_timing_signal(length, channels, min_timescale=1.0, max_timescale=1.0e4)
 
 class EncoderLayer(nn.Module):
     def __init__(self, hidden_size, total_key_depth, total_value_depth, filter_size, num_heads,
-                 bias_mask=None, layer_dropout=0.0, attention_dropout=0.0, relu_dropout=0.0):
+                 bias_mask=None, layer_dropout=0.0, attention_dropout=0.0, relu_dropout=0.0,
+                 attention_chunk_size=0, attention_chunk_threshold=0, attention_window=0, num_global_tokens=0):
         """
         Parameters:
             hidden_size: Hidden size
@@ -82,11 +100,19 @@ class EncoderLayer(nn.Module):
             layer_dropout: Dropout for this layer
             attention_dropout: Dropout probability after attention (Should be non-zero only during training)
             relu_dropout: Dropout probability after relu in FFN (Should be non-zero only during training)
+            attention_chunk_size: Number of keys per block of the chunked attention (0 disables it)
+            attention_chunk_threshold: Attention size (elements) above which the chunked attention is used
+            attention_window: If > 0, sliding-window self-attention over attention_window positions on each side
+            num_global_tokens: Number of leading positions attending globally in sliding-window attention
         """
         super(EncoderLayer, self).__init__()
 
         self.multi_head_attention = MultiHeadAttention(hidden_size, total_key_depth, total_value_depth,
-                                                       hidden_size, num_heads, bias_mask, attention_dropout)
+                                                       hidden_size, num_heads, bias_mask, attention_dropout,
+                                                       chunk_size=attention_chunk_size,
+                                                       chunk_threshold=attention_chunk_threshold,
+                                                       window_size=attention_window,
+                                                       num_global_tokens=num_global_tokens)
 
         self.positionwise_feed_forward = PositionwiseFeedForward(hidden_size, filter_size, hidden_size,
                                                                  layer_config='cc', padding='both',
@@ -120,7 +146,8 @@ class EncoderLayer(nn.Module):
 class Encoder(nn.Module):
     def __init__(self, embedding_size, hidden_size, num_layers, num_heads, total_key_depth, total_value_depth,
                  filter_size, max_length=100, input_dropout=0.0, layer_dropout=0.0,
-                 attention_dropout=0.0, relu_dropout=0.0, use_mask=False, use_pos=False):
+                 attention_dropout=0.0, relu_dropout=0.0, use_mask=False, use_pos=False, use_checkpoint=False,
+                 attention_chunk_size=0, attention_chunk_threshold=0, attention_window=0, num_global_tokens=0):
         """
         Parameters:
             embedding_size: Size of embeddings
@@ -137,6 +164,11 @@ class Encoder(nn.Module):
             attention_dropout: Dropout probability after attention (Should be non-zero only during training)
             relu_dropout: Dropout probability after relu in FFN (Should be non-zero only during training)
             use_mask: Set to True to turn on future value masking
+            use_checkpoint: Set to True to recompute layer activations during backward (training only)
+            attention_chunk_size: Number of keys per block of the chunked attention (0 disables it)
+            attention_chunk_threshold: Attention size (elements) above which the chunked attention is used
+            attention_window: If > 0, sliding-window self-attention over attention_window positions on each side
+            num_global_tokens: Number of leading positions attending globally in sliding-window attention
         """
         super(Encoder, self).__init__()
         self.timing_signal = _gen_timing_signal(max_length, hidden_size)
@@ -148,7 +180,11 @@ class Encoder(nn.Module):
                   _gen_bias_mask(max_length) if use_mask else None,
                   layer_dropout,
                   attention_dropout,
-                  relu_dropout)
+                  relu_dropout,
+                  attention_chunk_size,
+                  attention_chunk_threshold,
+                  attention_window,
+                  num_global_tokens)
 
         # Pos-tag & Entity feature should be added later.
         self.embedding_proj = nn.Linear(embedding_size, hidden_size, bias=False)
@@ -156,6 +192,7 @@ class Encoder(nn.Module):
         self.encoder_layers = nn.Sequential(*[EncoderLayer(*params) for l in range(num_layers)])
         self.layer_norm = LayerNorm(hidden_size)
         self.input_dropout = nn.Dropout(input_dropout)
+        self.use_checkpoint = use_checkpoint
 
     def forward(self, inputs, src_masks=None, role_inputs=None):
 
@@ -171,7 +208,10 @@ class Encoder(nn.Module):
         # y = self.encoder_layers((x, src_masks))
         y = x
         for idx, encoder_layer in enumerate(self.encoder_layers):
-            y = encoder_layer(inputs=y, src_masks=src_masks)
+            if self.use_checkpoint and self.training and torch.is_grad_enabled():
+                y = _checkpoint(encoder_layer, y, src_masks)
+            else:
+                y = encoder_layer(inputs=y, src_masks=src_masks)
 
         y = self.layer_norm(y)
         return y
@@ -185,7 +225,8 @@ class DecoderLayer(nn.Module):
     """
 
     def __init__(self, hidden_size, total_key_depth, total_value_depth, filter_size, num_heads,
-                 bias_mask, layer_dropout=0.0, attention_dropout=0.0, relu_dropout=0.0):
+                 bias_mask, layer_dropout=0.0, attention_dropout=0.0, relu_dropout=0.0,
+                 attention_chunk_size=0, attention_chunk_threshold=0, top_k_turns=0, cache_dtype=''):
         """
         Parameters:
             hidden_size: Hidden size
@@ -198,21 +239,35 @@ class DecoderLayer(nn.Module):
             layer_dropout: Dropout for this layer
             attention_dropout: Dropout probability after attention (Should be non-zero only during training)
             relu_dropout: Dropout probability after relu in FFN (Should be non-zero only during training)
+            attention_chunk_size: Number of keys per block of the chunked attention (0 disables it)
+            attention_chunk_threshold: Attention size (elements) above which the chunked attention is used
+            top_k_turns: If > 0, word-level attention only covers the words of the top_k_turns turns
+                         with the highest turn-level attention scores for each decoding position
+            cache_dtype: Storage dtype of the word/turn-attention keys and values cached for decoding
+                         ('', 'bfloat16', 'float16' or 'int8')
         """
 
         super(DecoderLayer, self).__init__()
         self.multi_head_attention_dec = MultiHeadAttention(hidden_size, total_key_depth, total_value_depth,
                                                            hidden_size, num_heads, bias_mask=bias_mask,
                                                            dropout=attention_dropout,
-                                                           attention_type='self-attention')
+                                                           attention_type='self-attention',
+                                                           chunk_size=attention_chunk_size,
+                                                           chunk_threshold=attention_chunk_threshold)
 
         self.multi_head_attention_word = MultiHeadAttention(hidden_size, total_key_depth, total_value_depth,
                                                            hidden_size, num_heads, None, dropout=attention_dropout,
-                                                            attention_type='word-attention')
+                                                            attention_type='word-attention',
+                                                            chunk_size=attention_chunk_size,
+                                                            chunk_threshold=attention_chunk_threshold,
+                                                            cache_dtype=cache_dtype)
 
         self.multi_head_attention_turn = MultiHeadAttention(hidden_size, total_key_depth, total_value_depth,
                                                            hidden_size, num_heads, None, dropout=attention_dropout,
-                                                            attention_type='turn-attention')
+                                                            attention_type='turn-attention',
+                                                            chunk_size=attention_chunk_size,
+                                                            chunk_threshold=attention_chunk_threshold,
+                                                            cache_dtype=cache_dtype)
 
         self.positionwise_feed_forward = PositionwiseFeedForward(hidden_size, filter_size, hidden_size,
                                                                  layer_config='cc', padding = 'left',
@@ -223,17 +278,20 @@ class DecoderLayer(nn.Module):
         self.layer_norm_mha_turn_enc = LayerNorm(hidden_size)
         self.layer_norm_ffn = LayerNorm(hidden_size)
         self.bias_mask = bias_mask
+        self.top_k_turns = top_k_turns
 
-    def forward(self, inputs, layer_cache=None):
+    def forward(self, inputs, layer_cache=None, word_turns=None):
+        """
+        word_turns (optional): [num_words] turn of every word of word_encoder_outputs, for the hierarchical
+                               attention. Defaults to turns of equal length.
+        """
         decoder_inputs, word_encoder_outputs, turn_encoder_outputs = inputs
 
         x_norm = self.layer_norm_mha_dec(decoder_inputs)
 
         # Masked Multi-head Self-attention for decoding inputs
-        start_time = time.time()
         y = self.multi_head_attention_dec(x_norm, x_norm,
                                           x_norm, layer_cache=layer_cache)
-        # print('[Self-Attention]: ', int(round((time.time() - start_time) * 1000)), 'MS')
 
 
         x = self.dropout(decoder_inputs + y) # [1, tgt_seq_len, 300]
@@ -242,24 +300,34 @@ class DecoderLayer(nn.Module):
         x_norm = self.layer_norm_mha_word_enc(x)
 
 
-        start_time = time.time()
         # Word-level cross-attention
-        y = self.multi_head_attention_word(x_norm, word_encoder_outputs,
-                                           word_encoder_outputs,
-                                           layer_cache=layer_cache)
-        # print('[Word-level cross-attention]: ', int(round((time.time() - start_time) * 1000)), 'MS')
+        num_turns = turn_encoder_outputs.shape[1]
+        if self.top_k_turns and num_turns > self.top_k_turns:
+            # Hierarchical attention: only the words of the turns with the highest turn-level scores
+            turn_indices = self.multi_head_attention_turn.select_top_k(x_norm, turn_encoder_outputs,
+                                                                       self.top_k_turns, layer_cache=layer_cache)
+            if word_turns is None:
+                word_turns = torch.arange(num_turns, device=turn_indices.device).repeat_interleave(
+                    word_encoder_outputs.shape[1] // num_turns)
+            y = self.multi_head_attention_word(x_norm, word_encoder_outputs,
+                                               word_encoder_outputs,
+                                               layer_cache=layer_cache,
+                                               turn_indices=turn_indices, num_turns=num_turns,
+                                               word_turns=word_turns)
+        else:
+            y = self.multi_head_attention_word(x_norm, word_encoder_outputs,
+                                               word_encoder_outputs,
+                                               layer_cache=layer_cache)
 
         x = self.dropout(x + y)
 
         # Layer Norm of turn-level cross attention
         x_norm = self.layer_norm_mha_turn_enc(x)
 
-        start_time = time.time()
         # Turn-level cross-attention
         y = self.multi_head_attention_turn(x_norm, turn_encoder_outputs,
                                            turn_encoder_outputs,
                                            layer_cache=layer_cache)
-        # print('[Turn-level cross-attention]: ', int(round((time.time() - start_time) * 1000)), 'MS')
 
         x = self.dropout(x + y)
 
@@ -282,7 +350,8 @@ class Decoder(nn.Module):
 
     def __init__(self, embedding_size, hidden_size, num_layers, num_heads, total_key_depth, total_value_depth,
                  filter_size, max_length=100, input_dropout=0.0, layer_dropout=0.0,
-                 attention_dropout=0.0, relu_dropout=0.0, use_mask=False):
+                 attention_dropout=0.0, relu_dropout=0.0, use_mask=False, use_checkpoint=False,
+                 attention_chunk_size=0, attention_chunk_threshold=0, top_k_turns=0, cache_dtype=''):
         """
         Parameters:
             embedding_size: Size of embeddings
@@ -298,6 +367,12 @@ class Decoder(nn.Module):
             layer_dropout: Dropout for each layer
             attention_dropout: Dropout probability after attention (Should be non-zero only during training)
             relu_dropout: Dropout probability after relu in FFN (Should be non-zero only during training)
+            use_checkpoint: Set to True to recompute layer activations during backward (training only)
+            attention_chunk_size: Number of keys per block of the chunked attention (0 disables it)
+            attention_chunk_threshold: Attention size (elements) above which the chunked attention is used
+            top_k_turns: Number of turns whose words are attended to by each decoding position (0 for all turns)
+            cache_dtype: Storage dtype of the cached encoder keys and values during decoding
+                         ('', 'bfloat16', 'float16' or 'int8' with per-head scales)
         """
 
         super(Decoder, self).__init__()
@@ -312,7 +387,11 @@ class Decoder(nn.Module):
                   _gen_bias_mask(max_length),  # mandatory
                   layer_dropout,
                   attention_dropout,
-                  relu_dropout)
+                  relu_dropout,
+                  attention_chunk_size,
+                  attention_chunk_threshold,
+                  top_k_turns,
+                  cache_dtype)
 
         self.num_layers = num_layers
         self.embedding_proj = nn.Linear(embedding_size, hidden_size, bias=False)
@@ -320,8 +399,12 @@ class Decoder(nn.Module):
 
         self.layer_norm = LayerNorm(hidden_size)
         self.input_dropout = nn.Dropout(input_dropout)
+        self.use_checkpoint = use_checkpoint
 
-    def forward(self, inputs, state=None, step=None):
+    def forward(self, inputs, state=None, step=None, word_turns=None):
+        """
+        word_turns (optional): [num_words] turn of every word of the word-level memory (hierarchical attention)
+        """
         decoder_inputs, word_encoder_outputs, turn_encoder_outputs = inputs
 
         # print('decoder_inputs: ', decoder_inputs)
@@ -340,9 +423,16 @@ class Decoder(nn.Module):
 
         output = x
         # Run decoder
-        if state is None:
+        if state is None and self.use_checkpoint and self.training and torch.is_grad_enabled():
+            for decoder_layer in self.decoder_layers:
+                output = _checkpoint(lambda *layer_inputs, layer=decoder_layer:
+                                     layer(inputs=layer_inputs, word_turns=word_turns)[0],
+                                     output, word_encoder_outputs, turn_encoder_outputs)
+        elif state is None:
             # y = x
-            output, word_encoder_outputs, turn_encoder_outputs = self.decoder_layers((output, word_encoder_outputs, turn_encoder_outputs))
+            for decoder_layer in self.decoder_layers:
+                output, word_encoder_outputs, turn_encoder_outputs = decoder_layer(
+                    inputs=(output, word_encoder_outputs, turn_encoder_outputs), word_turns=word_turns)
         else:
             # y = x
             # utilize state caching only for inference
@@ -350,16 +440,18 @@ class Decoder(nn.Module):
                 output, word_encoder_outputs, turn_encoder_outputs = decoder_layer(inputs=(output, word_encoder_outputs, turn_encoder_outputs),
                                                                                    layer_cache=state.cache[
                                                                                        "layer_{}".format(idx)]
-                                                                                   if state.cache is not None else None)
+                                                                                   if state.cache is not None else None,
+                                                                                   word_turns=word_turns)
 
         # Final layer normalization
         y = self.layer_norm(output)
 
         return y, state
 
-    def init_decoder_state(self):
+    def init_decoder_state(self, max_length=None):
+        """With max_length, the self-attention caches are preallocated for max_length steps (see DecoderState)."""
         state = DecoderState()
-        state._init_cache(self.num_layers)
+        state._init_cache(self.num_layers, max_length)
         return state
 
 
@@ -373,7 +465,7 @@ class DecoderState(object):
 
         self.cache = None
 
-    def _init_cache(self, num_layers):
+    def _init_cache(self, num_layers, max_length=None):
         self.cache = {}
 
         for l in range(num_layers):
@@ -381,19 +473,52 @@ class DecoderState(object):
                 "word_keys": None,
                 "word_values": None,
                 "turn_keys": None,
-                "turn_values": None
+                "turn_values": None,
+                # Scales of int8 word/turn keys and values
+                "word_keys_scale": None,
+                "word_values_scale": None,
+                "turn_keys_scale": None,
+                "turn_values_scale": None
             }
             layer_cache["self_keys"] = None
             layer_cache["self_values"] = None
+            # With max_length, the self-attention keys and values of every step are written into buffers
+            # [max_length, batch_size, num_heads, depth] allocated at the first step, and reordered into a
+            # second pair of buffers, self_keys/self_values are views of their first self_length positions
+            layer_cache["self_length"] = 0 if max_length else None
+            layer_cache["self_max_length"] = max_length
+            for name in ("self_keys", "self_values"):
+                layer_cache[name + "_buffer"] = None
+                layer_cache[name + "_reordered"] = None
             self.cache["layer_{}".format(l)] = layer_cache
 
+    def reorder(self, select_indices):
+        """
+        Reorders the self-attention caches by the rows of the previous step the beams extend. Preallocated
+        caches are reordered into their second buffers, which allocates nothing. The word/turn-level keys and
+        values are shared by all beams (batch size 1) and are not reordered.
+        """
+        for layer_cache in self.cache.values():
+            length = layer_cache["self_length"]
+            for name in ("self_keys", "self_values"):
+                if layer_cache[name] is None:
+                    continue
+                if length is None:
+                    layer_cache[name] = layer_cache[name].index_select(0, select_indices)
+                    continue
+                buffer, reordered = layer_cache[name + "_buffer"], layer_cache[name + "_reordered"]
+                torch.index_select(buffer[:length], 1, select_indices, out=reordered[:length])
+                layer_cache[name + "_buffer"], layer_cache[name + "_reordered"] = reordered, buffer
+                layer_cache[name] = reordered[:length].permute(1, 2, 0, 3)
+
     def map_batch_fn(self, fn):
+        """Applies fn to every cached tensor, for caches that are not preallocated (see reorder)."""
         def _recursive_map(struct, batch_dim=0):
             for k, v in struct.items():
                 if v is not None:
                     if isinstance(v, dict):
                         _recursive_map(v)
-                    else:
+                    elif torch.is_tensor(v):
                         struct[k] = fn(v, batch_dim)
         if self.cache is not None:
             _recursive_map(self.cache)
\ No newline at end of file
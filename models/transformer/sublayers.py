@@ -6,9 +6,117 @@ import torch
 import torch.nn as nn
 
 
+def _dropout_mask(generator, shape, dropout, like):
+    keep = torch.empty(shape, dtype=like.dtype, device=like.device).bernoulli_(1 - dropout, generator=generator)
+    return keep / (1 - dropout)
+
+
+def _sum_to_shape(x, shape):
+    """Sums x over the dimensions broadcast to reach its shape from shape."""
+    if x.dim() > len(shape):
+        x = x.sum(dim=tuple(range(x.dim() - len(shape))))
+    dims = tuple(dim for dim, size in enumerate(shape) if size == 1 and x.shape[dim] != 1)
+    return x.sum(dim=dims, keepdim=True) if dims else x
+
+
+class ChunkedAttention(torch.autograd.Function):
+    """
+    softmax(queries x keys^T + bias) x values, computed over blocks of chunk_size keys with an online softmax,
+    so that the [batch_size, num_heads, queries_seq_len, keys_seq_len] weights are never materialized.
+    The backward pass recomputes the weights block by block from the saved log-sum-exp of every query.
+    Attention dropout masks are drawn from a generator seeded with seed and redrawn in the same order in backward.
+    Reductions are done in fp32 (or fp64 for fp64 inputs). The bias (broadcast to the logits) gets a gradient
+    when it requires one.
+    """
+
+    @staticmethod
+    def forward(ctx, queries, keys, values, bias=None, chunk_size=1024, dropout=0.0, seed=0):
+        dtype = torch.float64 if queries.dtype == torch.float64 else torch.float32
+        generator = torch.Generator(device=queries.device)
+        generator.manual_seed(seed)
+
+        queries_float = queries.to(dtype)
+        shape = queries.shape[:-1] + (1,)
+        row_max = torch.full(shape, float('-inf'), dtype=dtype, device=queries.device)
+        row_sum = torch.zeros(shape, dtype=dtype, device=queries.device)
+        contexts = torch.zeros(queries.shape[:-1] + values.shape[-1:], dtype=dtype, device=queries.device)
+
+        for start in range(0, keys.shape[2], chunk_size):
+            end = start + chunk_size
+            logits = torch.matmul(queries_float, keys[:, :, start:end].to(dtype).transpose(-1, -2))
+            if bias is not None:
+                logits = logits + bias[..., start:end].to(dtype)
+
+            new_max = torch.max(row_max, logits.max(dim=-1, keepdim=True)[0])
+            # rows without any valid key so far keep a zero reference instead of -inf
+            safe_max = new_max.masked_fill(new_max == float('-inf'), 0.)
+            correction = torch.exp(row_max - safe_max)
+            weights = torch.exp(logits - safe_max)
+            row_sum = row_sum * correction + weights.sum(dim=-1, keepdim=True)
+            if dropout > 0:
+                weights = weights * _dropout_mask(generator, weights.shape, dropout, weights)
+            contexts = contexts * correction + torch.matmul(weights, values[:, :, start:end].to(dtype))
+            row_max = new_max
+
+        contexts = contexts / row_sum
+        log_sum_exp = row_max.masked_fill(row_max == float('-inf'), 0.) + torch.log(row_sum)
+
+        ctx.save_for_backward(queries, keys, values, contexts, log_sum_exp)
+        ctx.bias, ctx.chunk_size, ctx.dropout, ctx.seed = bias, chunk_size, dropout, seed
+        return contexts.type_as(values)
+
+    @staticmethod
+    def backward(ctx, grad_contexts):
+        queries, keys, values, contexts, log_sum_exp = ctx.saved_tensors
+        bias, chunk_size, dropout = ctx.bias, ctx.chunk_size, ctx.dropout
+        dtype = contexts.dtype
+        generator = torch.Generator(device=queries.device)
+        generator.manual_seed(ctx.seed)
+
+        queries_float = queries.to(dtype)
+        grad_contexts = grad_contexts.to(dtype)
+        delta = (grad_contexts * contexts).sum(dim=-1, keepdim=True)
+
+        grad_queries = torch.zeros_like(queries_float)
+        grad_keys = torch.zeros(keys.shape, dtype=dtype, device=keys.device)
+        grad_values = torch.zeros(values.shape, dtype=dtype, device=values.device)
+        grad_bias = None
+        if bias is not None and ctx.needs_input_grad[3]:
+            grad_bias = torch.zeros(bias.shape, dtype=dtype, device=bias.device)
+
+        for start in range(0, keys.shape[2], chunk_size):
+            end = start + chunk_size
+            keys_chunk = keys[:, :, start:end].to(dtype)
+            values_chunk = values[:, :, start:end].to(dtype)
+            logits = torch.matmul(queries_float, keys_chunk.transpose(-1, -2))
+            if bias is not None:
+                logits = logits + bias[..., start:end].to(dtype)
+
+            weights = torch.exp(logits - log_sum_exp)
+            grad_weights = torch.matmul(grad_contexts, values_chunk.transpose(-1, -2))
+            if dropout > 0:
+                keep = _dropout_mask(generator, weights.shape, dropout, weights)
+                grad_values[:, :, start:end] = torch.matmul((weights * keep).transpose(-1, -2), grad_contexts)
+                grad_weights = grad_weights * keep
+            else:
+                grad_values[:, :, start:end] = torch.matmul(weights.transpose(-1, -2), grad_contexts)
+
+            grad_logits = weights * (grad_weights - delta)
+            grad_queries += torch.matmul(grad_logits, keys_chunk)
+            grad_keys[:, :, start:end] = torch.matmul(grad_logits.transpose(-1, -2), queries_float)
+            if grad_bias is not None:
+                grad_bias[..., start:end] = _sum_to_shape(grad_logits, grad_bias[..., start:end].shape)
+
+        if grad_bias is not None:
+            grad_bias = grad_bias.type_as(bias)
+        return (grad_queries.type_as(queries), grad_keys.type_as(keys), grad_values.type_as(values),
+                grad_bias, None, None, None)
+
+
 class MultiHeadAttention(nn.Module):
     def __init__(self, input_depth, total_key_depth, total_value_depth, output_depth,
-                 num_heads, bias_mask=None, dropout=0.0, attention_type=None):
+                 num_heads, bias_mask=None, dropout=0.0, attention_type=None,
+                 chunk_size=0, chunk_threshold=0, window_size=0, num_global_tokens=0, cache_dtype=''):
         """
         Parameters:
             input_depth: Size of last dimension of input
@@ -18,6 +126,15 @@ class MultiHeadAttention(nn.Module):
             num_heads: Number of attention heads
             bias_mask: Masking tensor to prevent connections to future elements
             dropout: Dropout probability (Should be non-zero only during training)
+            chunk_size: Number of keys per block of the chunked attention (0 disables it)
+            chunk_threshold: Use the chunked attention when the attention weights would have more elements than this
+            window_size: If > 0, self-attention is restricted to keys at most window_size positions away
+                         (sliding window), except for the global tokens
+            num_global_tokens: Number of leading positions that attend to and are attended by every position
+            cache_dtype: Storage of the projected encoder keys and values in the decoding cache
+                         (word/turn-attention): '' keeps them as computed, 'bfloat16' or 'float16' casts them,
+                         'int8' quantizes them with a scale per head and position. They are converted back to the
+                         query dtype when read.
         """
         super(MultiHeadAttention, self).__init__()
         # Checks borrowed from
@@ -43,6 +160,11 @@ class MultiHeadAttention(nn.Module):
         self.key_projected = None
         self.value_projected = None
         self.attention_type = attention_type
+        self.chunk_size = chunk_size
+        self.chunk_threshold = chunk_threshold
+        self.window_size = window_size
+        self.num_global_tokens = num_global_tokens
+        self.cache_dtype = cache_dtype
 
         self.attention = None
 
@@ -73,10 +195,84 @@ class MultiHeadAttention(nn.Module):
         shape = x.shape
         return x.permute(0, 2, 1, 3).contiguous().view(shape[0], shape[2], shape[3]*self.num_heads)
 
-    def forward(self, queries, keys, values, src_masks=None, layer_cache=None):
+    def _store_cache(self, layer_cache, name, x):
+        """Stores projected keys or values [batch_size, num_heads, seq_length, depth/num_heads] in the cache."""
+        if self.cache_dtype == 'int8':
+            # Symmetric quantization, one scale per (head, position)
+            scale = x.detach().abs().amax(dim=-1, keepdim=True).float().clamp(min=1e-12) / 127.
+            layer_cache[name] = torch.round(x.float() / scale).to(torch.int8)
+            layer_cache[name + '_scale'] = scale
+        elif self.cache_dtype:
+            layer_cache[name] = x.to(getattr(torch, self.cache_dtype))
+        else:
+            layer_cache[name] = x
+
+    def _load_cache(self, layer_cache, name, dtype):
+        """
+        Reads cached keys or values cast to dtype, and the scales [batch_size, num_heads, seq_length, 1] of int8
+        ones (None otherwise). The scales are not applied: key scales multiply the attention logits and value
+        scales the attention weights, so the cache is never dequantized in fp32.
+        """
+        return layer_cache[name].to(dtype), layer_cache.get(name + '_scale')
+
+    def _append_self_cache(self, layer_cache, keys, values):
+        """
+        Writes the self-attention keys and values [batch_size, num_heads, 1, depth/num_heads] of a decoding step
+        into the preallocated [max_length, batch_size, num_heads, depth/num_heads] buffers of layer_cache.
+        Returns:
+            The keys and values of all steps so far, views with shape [batch_size, num_heads, length, depth/num_heads]
+        """
+        start = layer_cache["self_length"]
+        end = start + keys.shape[2]
+        for name, x in (("self_keys", keys), ("self_values", values)):
+            if layer_cache[name + "_buffer"] is None:
+                buffer = x.new_empty(layer_cache["self_max_length"], x.shape[0], x.shape[1], x.shape[3])
+                layer_cache[name + "_buffer"], layer_cache[name + "_reordered"] = buffer, torch.empty_like(buffer)
+            layer_cache[name + "_buffer"][start:end].copy_(x.permute(2, 0, 1, 3))
+            layer_cache[name] = layer_cache[name + "_buffer"][:end].permute(1, 2, 0, 3)
+        layer_cache["self_length"] = end
+        return layer_cache["self_keys"], layer_cache["self_values"]
+
+    def select_top_k(self, queries, keys, k, layer_cache=None):
+        """
+        Selects, for every query, the k keys with the highest attention logits (summed over heads),
+        e.g. the top-k turns of the turn-level attention.
+        Keys are taken from layer_cache when they were already projected.
+        Returns:
+            A LongTensor with shape [batch_size, queries_seq_len, k]
+        """
+        cache_name = self.attention_type.split('-')[0] + '_keys' if self.attention_type else None
+        with torch.no_grad():
+            queries = self._split_heads(self.query_linear(queries))
+            key_scale = None
+            if layer_cache is not None and layer_cache.get(cache_name) is not None:
+                keys, key_scale = self._load_cache(layer_cache, cache_name, queries.dtype)
+            else:
+                keys = self._split_heads(self.key_linear(keys))
+            fold_beams = keys.shape[0] == 1 and queries.shape[0] > 1 and queries.shape[2] == 1
+            if fold_beams:
+                # Keys cached once for all beams, see forward
+                queries = queries.transpose(0, 2)
+            logits = torch.matmul(queries, keys.permute(0, 1, 3, 2)) # [batch_size, num_heads, queries_seq_len, keys_seq_len]
+            if key_scale is not None:
+                logits = logits * key_scale.transpose(-1, -2)
+            logits = logits.sum(dim=1)
+            if fold_beams:
+                logits = logits.transpose(0, 1)
+            return logits.topk(k, dim=-1)[1]
+
+    def forward(self, queries, keys, values, src_masks=None, layer_cache=None, turn_indices=None, num_turns=None,
+                word_turns=None):
+        """
+        turn_indices (optional): [batch_size, queries_seq_len, k] turns to attend to for every query, for keys and
+                                 values that are the words of num_turns turns
+        word_turns (optional): [keys_seq_len] turn of every key, in increasing order (with turn_indices)
+        """
 
         queries = self.query_linear(queries)
         queries = self._split_heads(queries) # [batch_size, num_heads, seq_length, depth/num_heads]
+        # Per-position scales of int8 cached keys and values
+        key_scale = value_scale = None
 
         if (layer_cache is not None):
             # for inference
@@ -89,45 +285,36 @@ class MultiHeadAttention(nn.Module):
                 values = self._split_heads(values)
 
                 device = keys.device
-                if layer_cache["self_keys"] is not None:
-                    keys = torch.cat(
-                        (layer_cache["self_keys"].to(device), keys),
-                        dim=2)
-                if layer_cache["self_values"] is not None:
-                    values = torch.cat(
-                        (layer_cache["self_values"].to(device), values),
-                        dim=2)
-                layer_cache["self_keys"] = keys
-                layer_cache["self_values"] = values
-
-            elif self.attention_type == 'word-attention':
-                # for word-level or turn-level attention (in these cases, keys and values are already processed in encoder)
-                if layer_cache["word_keys"] is None:
-                    keys, values = self.key_linear(keys), \
-                                   self.value_linear(values)
-
-                    keys, values = self._split_heads(keys), \
-                                   self._split_heads(values)
-
+                if layer_cache.get("self_length") is not None:
+                    keys, values = self._append_self_cache(layer_cache, keys, values)
                 else:
-                    keys, values = layer_cache["word_keys"], \
-                                 layer_cache["word_values"]
-                layer_cache["word_keys"] = keys
-                layer_cache["word_values"] = values
+                    if layer_cache["self_keys"] is not None:
+                        keys = torch.cat(
+                            (layer_cache["self_keys"].to(device), keys),
+                            dim=2)
+                    if layer_cache["self_values"] is not None:
+                        values = torch.cat(
+                            (layer_cache["self_values"].to(device), values),
+                            dim=2)
+                    layer_cache["self_keys"] = keys
+                    layer_cache["self_values"] = values
 
             else:
-                if layer_cache["turn_keys"] is None:
+                # for word-level or turn-level attention (in these cases, keys and values are already processed in encoder)
+                prefix = 'word' if self.attention_type == 'word-attention' else 'turn'
+                if layer_cache[prefix + "_keys"] is None:
                     keys, values = self.key_linear(keys), \
                                    self.value_linear(values)
 
                     keys, values = self._split_heads(keys), \
                                    self._split_heads(values)
 
-                else:
-                    keys, values = layer_cache["turn_keys"], \
-                                 layer_cache["turn_values"]
-                layer_cache["turn_keys"] = keys
-                layer_cache["turn_values"] = values
+                    self._store_cache(layer_cache, prefix + "_keys", keys)
+                    self._store_cache(layer_cache, prefix + "_values", values)
+
+                # Every step reads the same (possibly quantized) keys and values
+                keys, key_scale = self._load_cache(layer_cache, prefix + "_keys", queries.dtype)
+                values, value_scale = self._load_cache(layer_cache, prefix + "_values", queries.dtype)
 
         else:
             keys = self.key_linear(keys)
@@ -141,26 +328,192 @@ class MultiHeadAttention(nn.Module):
         # scale queries
         queries *= self.query_scale
 
-        logits = torch.matmul(queries, keys.permute(0, 1, 3, 2)) # (batch_size, num_heads, queries_seq_len, keys_seq_len)
+        # The encoder keys and values are cached once for all beams: the beams of a decoding step attend to them
+        # as the queries of a single sequence
+        fold_beams = layer_cache is not None and turn_indices is None and keys.shape[0] == 1 and \
+            queries.shape[0] > 1 and queries.shape[2] == 1
+        if fold_beams:
+            queries = queries.transpose(0, 2) # [1, num_heads, batch_size, depth/num_heads]
+
+        if turn_indices is not None:
+            contexts = self._turn_sparse_attention(queries, keys, values, turn_indices, num_turns, word_turns,
+                                                   key_scale, value_scale)
+        elif self.window_size and layer_cache is None and keys.shape[2] > self.window_size + 1:
+            contexts = self._windowed_attention(queries, keys, values, src_masks)
+        elif self.chunk_size and queries.shape[:-1].numel() * keys.shape[2] > self.chunk_threshold:
+            if key_scale is not None:
+                keys, values = keys * key_scale.type_as(keys), values * value_scale.type_as(values)
+            contexts = self._chunked_attention(queries, keys, values, src_masks, layer_cache)
+        else:
+            logits = torch.matmul(queries, keys.permute(0, 1, 3, 2)) # (batch_size, num_heads, queries_seq_len, keys_seq_len)
+            if key_scale is not None:
+                logits = logits * key_scale.transpose(-1, -2)
 
-        if src_masks is not None:
-            # Encoder Self-Attention
-            logits += src_masks
+            if src_masks is not None:
+                # Encoder Self-Attention
+                logits += src_masks
 
-        # Add bias to mask future values (Triangular Masking)
-        if (self.bias_mask is not None) and (layer_cache is None):
-            logits += self.bias_mask[:, :, :logits.shape[-2], :logits.shape[-1]].type_as(logits.data)
+            # Add bias to mask future values (Triangular Masking)
+            if (self.bias_mask is not None) and (layer_cache is None):
+                logits += self.bias_mask[:, :, :logits.shape[-2], :logits.shape[-1]].type_as(logits.data)
 
-        weights = nn.functional.softmax(logits, dim=-1)
+            # Softmax is kept in fp32 under autocast
+            weights = nn.functional.softmax(logits.float(), dim=-1).type_as(values)
 
-        weights = self.dropout(weights)
+            weights = self.dropout(weights)
+            if value_scale is not None:
+                weights = weights * value_scale.transpose(-1, -2).type_as(weights)
+
+            contexts = torch.matmul(weights, values)
 
-        contexts = torch.matmul(weights, values)
+        if fold_beams:
+            contexts = contexts.transpose(0, 2)
         # Merge Heads
         contexts = self._merge_heads(contexts)
         outputs = self.output_linear(contexts)
         return outputs
 
+    def _turn_sparse_attention(self, queries, keys, values, turn_indices, num_turns, word_turns, key_scale=None,
+                               value_scale=None):
+        """
+        Attention of every query over the words of its selected turns only.
+        With several queries (training), the logits over all words are masked outside of the selected turns. A
+        single decoding position only gathers the keys and values of its k turns, so the cost of a decoding step
+        scales with k x turn length instead of the number of words.
+        Inputs:
+            queries: [batch_size, num_heads, queries_seq_len, depth/num_heads]
+            keys, values: [batch_size or 1, num_heads, num_words, depth/num_heads]
+            turn_indices: [batch_size, queries_seq_len, k]
+            word_turns: [num_words] turn of every word, the words of a turn are contiguous
+            key_scale, value_scale (optional): [batch_size or 1, num_heads, num_words, 1] scales of int8 keys and values
+        Returns:
+            A Tensor with shape [batch_size, num_heads, queries_seq_len, depth/num_heads]
+        """
+        batch_size, num_heads, queries_len, _ = queries.shape
+        if queries_len > 1:
+            selected = torch.zeros(batch_size, queries_len, num_turns, dtype=torch.bool, device=queries.device)
+            selected.scatter_(-1, turn_indices, True)
+            word_masks = selected[..., word_turns].unsqueeze(1) # [batch_size, 1, queries_seq_len, num_words]
+            logits = torch.matmul(queries, keys.transpose(-1, -2)).float()
+            if key_scale is not None:
+                logits = logits * key_scale.transpose(-1, -2)
+            logits = logits.masked_fill(~word_masks, float('-inf'))
+            weights = self.dropout(nn.functional.softmax(logits, dim=-1).type_as(values))
+            if value_scale is not None:
+                weights = weights * value_scale.transpose(-1, -2).type_as(weights)
+            return torch.matmul(weights, values)
+
+        # Words of every turn, [num_turns, max_turn_len] positions in the keys and padding mask
+        turn_lens = torch.bincount(word_turns, minlength=num_turns)
+        positions = torch.arange(int(turn_lens.max()), device=queries.device)
+        turn_words = ((turn_lens.cumsum(0) - turn_lens).unsqueeze(1) + positions).clamp(max=keys.shape[2] - 1)
+        turn_padding = positions >= turn_lens.unsqueeze(1)
+
+        word_index = turn_words[turn_indices[:, 0]].view(batch_size, -1) # [batch_size, k x max_turn_len]
+        word_padding = turn_padding[turn_indices[:, 0]].view(batch_size, 1, 1, -1)
+        batch_index = torch.arange(batch_size, device=queries.device).unsqueeze(1) if keys.shape[0] > 1 else \
+            torch.zeros(batch_size, 1, dtype=torch.long, device=queries.device)
+
+        def gather_words(x):
+            # [batch_size or 1, num_heads, num_words, d] -> [batch_size, num_heads, k x max_turn_len, d]
+            return x[batch_index, :, word_index].transpose(1, 2)
+
+        keys, values = gather_words(keys), gather_words(values)
+        logits = torch.matmul(queries, keys.transpose(-1, -2)).float()
+        if key_scale is not None:
+            logits = logits * gather_words(key_scale).transpose(-1, -2)
+        logits = logits.masked_fill(word_padding, float('-inf'))
+        weights = self.dropout(nn.functional.softmax(logits, dim=-1).type_as(values))
+        if value_scale is not None:
+            weights = weights * gather_words(value_scale).transpose(-1, -2).type_as(weights)
+        return torch.matmul(weights, values)
+
+    def _windowed_attention(self, queries, keys, values, src_masks=None):
+        """
+        Sliding-window self-attention: every position attends to the keys at most window_size positions away and
+        to the first num_global_tokens positions, which themselves attend to every position.
+        The sequence is split into blocks of window_size positions, each attending to itself and its two neighbour
+        blocks, so the cost is O(seq_length x window_size) instead of O(seq_length^2).
+        The key padding is taken from src_masks. Padding queries (rows of src_masks masking every key) get the
+        average of all values, as in dense attention where all their logits are masked, since the convolutional
+        feed-forward layers carry them into the neighbouring tokens.
+        Inputs:
+            queries, keys, values: [batch_size, num_heads, seq_length, depth/num_heads]
+            src_masks: [batch_size, 1, seq_length, seq_length]
+        Returns:
+            A Tensor with shape [batch_size, num_heads, seq_length, depth/num_heads]
+        """
+        batch_size, num_heads, length, depth = queries.shape
+        window = self.window_size
+        num_global = min(self.num_global_tokens, length)
+        num_blocks = (length + window - 1) // window
+        padding = num_blocks * window - length
+        device = queries.device
+
+        # [batch_size or 1, 1, 1, seq_length] key padding, taken from the rows of src_masks
+        if src_masks is not None:
+            key_bias = src_masks.max(dim=-2, keepdim=True)[0].float()
+        else:
+            key_bias = torch.zeros(1, 1, 1, length, device=device)
+
+        def to_blocks(x, value=0.):
+            # [..., seq_length, d] -> [..., num_blocks, 3 x window, d], block n holds positions [(n-1)w, (n+2)w)
+            x = nn.functional.pad(x, (0, 0, window, padding + window), value=value)
+            return x.unfold(-2, 3 * window, window).transpose(-1, -2)
+
+        query_blocks = nn.functional.pad(queries, (0, 0, 0, padding)).view(batch_size, num_heads, num_blocks,
+                                                                          window, depth)
+        key_blocks = to_blocks(keys) # [batch_size, num_heads, num_blocks, 3 x window, d]
+        value_blocks = to_blocks(values)
+
+        # Valid (query, key) pairs of every block: within the window, inside the sequence and not a global key
+        key_positions = (torch.arange(num_blocks, device=device).view(-1, 1) - 1) * window + \
+                        torch.arange(3 * window, device=device).view(1, -1) # [num_blocks, 3 x window]
+        distance = torch.arange(3 * window, device=device).view(1, -1) - window - \
+                   torch.arange(window, device=device).view(-1, 1) # [window, 3 x window]
+        valid = (distance.abs() <= window).unsqueeze(0) & \
+                ((key_positions >= num_global) & (key_positions < length)).unsqueeze(1) # [num_blocks, window, 3 x window]
+        local_bias = to_blocks(key_bias.transpose(-1, -2)).transpose(-1, -2) # [batch_size, 1, num_blocks, 1, 3 x window]
+        local_bias = local_bias.masked_fill(~valid, float('-inf'))
+
+        local_logits = torch.matmul(query_blocks, key_blocks.transpose(-1, -2)).float() + local_bias
+        global_keys = keys[:, :, :num_global].unsqueeze(2) # [batch_size, num_heads, 1, num_global, d]
+        global_logits = torch.matmul(query_blocks, global_keys.transpose(-1, -2)).float() + \
+                        key_bias[..., :num_global].unsqueeze(2)
+
+        weights = nn.functional.softmax(torch.cat((global_logits, local_logits), dim=-1), dim=-1).type_as(values)
+        weights = self.dropout(weights)
+        contexts = torch.matmul(weights[..., :num_global], values[:, :, :num_global].unsqueeze(2)) + \
+                   torch.matmul(weights[..., num_global:], value_blocks)
+        contexts = contexts.view(batch_size, num_heads, num_blocks * window, -1)[:, :, :length]
+
+        if num_global > 0:
+            # Global tokens attend to the whole sequence
+            global_logits = torch.matmul(queries[:, :, :num_global], keys.transpose(-1, -2)).float() + key_bias
+            global_weights = nn.functional.softmax(global_logits, dim=-1).type_as(values)
+            global_contexts = torch.matmul(self.dropout(global_weights), values)
+            contexts = torch.cat((global_contexts, contexts[:, :, num_global:]), dim=2)
+
+        if src_masks is not None:
+            padding_queries = src_masks.max(dim=-1, keepdim=True)[0] < 0 # [batch_size, 1, seq_length, 1]
+            contexts = torch.where(padding_queries, values.mean(dim=2, keepdim=True), contexts)
+
+        return contexts
+
+    def _chunked_attention(self, queries, keys, values, src_masks=None, layer_cache=None):
+        """
+        Same as the dense attention in forward, but streams keys and values in blocks of self.chunk_size
+        Returns:
+            A Tensor with shape [batch_size, num_heads, queries_seq_len, depth/num_heads]
+        """
+        bias = src_masks
+        if (self.bias_mask is not None) and (layer_cache is None):
+            bias_mask = self.bias_mask[:, :, :queries.shape[2], :keys.shape[2]].type_as(queries.data)
+            bias = bias_mask if bias is None else bias + bias_mask
+        dropout = self.dropout.p if self.training else 0.0
+        seed = int(torch.randint(2 ** 62, (1,)).item()) if dropout > 0 else 0
+        return ChunkedAttention.apply(queries, keys, values, bias, self.chunk_size, dropout, seed)
+
 
 class Conv(nn.Module):
     """
@@ -1,12 +1,16 @@
 import torch
 from torch import nn
-from utils.checkpointing import load_checkpoint, load_vocab
-from utils.utils import tile
+from torch.profiler import record_function
+from utils.checkpointing import load_checkpoint, load_vocab, load_weights, assign_weights
+from utils.beam_search import BeamSearch
 from models.model import SummarizationModel
 from data.dataset import *
+import os
 import time
 from tqdm import tqdm
-from utils.utils import compute_rouge_scores
+from utils.utils import compute_rouge_scores, autocast
+from utils.memory import PeakMemoryMonitor, MemoryLog, tensor_bytes
+from utils.results_store import ResultsStore, state_dict_hash, decode_config, decode_config_key
 
 
 class Predictor(object):
@@ -31,54 +35,58 @@ class Predictor(object):
         self.device = hparams.device
 
         self.summary_writer = summary_writer
+        # Set to a utils.profiler.ModuleProfiler to attribute module timings to decode steps
+        self.profiler = None
+        # Bytes held by the encoder outputs, decoder caches and beam tensors of the last inference call
+        self.memory_stats = {}
 
         if (model == None) and (checkpoint != ''):
-            self.build_model()
+            # The trained weights replace the GloVe initialization, no need to load spacy
+            self.build_model(checkpoint=self.hparams.load_pthpath)
 
             if self.vocab_word is None:
                 self.vocab_word = load_vocab(self.hparams.vocab_word_path)
 
-            model_state_dict, optimizer_state_dict = load_checkpoint(self.hparams.load_pthpath)
-
             print('============= Loading Trained Model from: ', self.hparams.load_pthpath, ' ==================')
-            if isinstance(self.model, nn.DataParallel):
-                self.model.module.load_state_dict(model_state_dict)
+            model = self.model.module if isinstance(self.model, nn.DataParallel) else self.model
+            if self.hparams.load_pthpath.endswith('.weights'):
+                # Weights-only export, the parameters become views of the memory-mapped file
+                model_state_dict, _ = load_weights(self.hparams.load_pthpath)
+                assign_weights(model, model_state_dict)
             else:
-                self.model.load_state_dict(model_state_dict, strict=True)
+                model_state_dict, optimizer_state_dict = load_checkpoint(self.hparams.load_pthpath)
+                model.load_state_dict(model_state_dict, strict=True)
 
-    def build_model(self):
+    def build_model(self, checkpoint=None):
         # Define model
         self.model = SummarizationModel(hparams=self.hparams, vocab_word=self.vocab_word,
-                                        vocab_role=self.vocab_role, vocab_pos=self.vocab_pos)
+                                        vocab_role=self.vocab_role, vocab_pos=self.vocab_pos,
+                                        checkpoint=checkpoint)
 
         # Multi-GPU
         self.model = self.model.to(self.device)
 
         # # Use Multi-GPUs
         if -1 not in self.hparams.gpu_ids and len(self.hparams.gpu_ids) > 1:
-            self.model = nn.DataPzarallel(self.model, self.hparams.gpu_ids)
+            self.model = nn.DataParallel(self.model, self.hparams.gpu_ids)
 
     def generator(self, decoder_outputs):
         logits = self.model.final_linear(decoder_outputs)
         shape = logits.shape
-        logits = logits.view(shape[0] * shape[1], shape[-1])  # [beam_size x tgt_seq_len, vocab_size]
-        softmax = nn.LogSoftmax(dim=-1)
-        probs = softmax(logits)
+        logits = logits.view(shape[0] * shape[1], shape[-1]).float()  # [beam_size x tgt_seq_len, vocab_size]
+        probs = torch.log_softmax(logits, dim=-1)
 
         return logits, probs
 
     def get_summaries(self, idxs):
-        tokens = [self.vocab_word.id2token[idx.item()] for idx in idxs]
-        summary = ' '.join(tokens)
-        return summary
+        return self.vocab_word.decode_text(idxs)
 
     def get_summaries_from_logits(self, logits):
         # logits : [batch x tgt_seq_len, vocab_size]
         softmax = nn.LogSoftmax(dim=-1)
         probs = softmax(logits)
         max_indices = torch.argmax(probs, dim=1)
-        tokens = [self.vocab_word.id2token[idx.item()] for idx in max_indices]
-        summary = ' '.join(tokens)
+        summary = self.vocab_word.decode_text(max_indices)
         return max_indices, summary
 
     def evaluate(self, test_dataloader, epoch=None, eval_path=None):
@@ -91,6 +99,18 @@ class Predictor(object):
         # else:
         #     self.model.load_state_dict(model_state_dict, strict=True)
 
+        memory_log = MemoryLog(os.path.join(self.hparams.save_dirpath, 'memory.csv'),
+                               summary_writer=self.summary_writer)
+
+        # Summaries already decoded with these weights and decode config are read from the store
+        results_store = ResultsStore(self.hparams.eval_results_path or
+                                     os.path.join(self.hparams.save_dirpath, 'results.jsonl'))
+        model = self.model.module if isinstance(self.model, nn.DataParallel) else self.model
+        checkpoint = state_dict_hash(model)
+        config = decode_config(self.hparams)
+        decode_key = decode_config_key(config)
+        num_cached = 0
+
         with torch.no_grad():
             cand_list = []
             ref_list = []
@@ -102,205 +122,109 @@ class Predictor(object):
                 labels_ids = data['labels_ids'].to(self.device)  # [batch, tgt_seq_len]
                 src_masks = data['src_masks'].to(self.device)
                 role_ids = data['role_ids'].to(self.device)
+                dialogues_lens = data['dialogues_lens'].to(self.device)
 
                 reference_summaries = self.get_summaries(labels_ids[0])
                 reference_summaries = reference_summaries.replace('<BEGIN>', '').replace('<END>', '')
 
-                generated_summaries = self.inference(inputs=dialogues_ids, src_masks=src_masks,
-                                                               role_ids=role_ids, pos_ids=pos_ids)
+                meeting_id = data['meeting_id'][0]
+                entry = results_store.get(checkpoint, meeting_id, decode_key)
+                if entry is not None:
+                    num_cached += 1
+                    cand_list.append(entry['summary'])
+                    ref_list.append(entry['reference'])
+                    continue
+
+                decode_begin = time.perf_counter()
+                with PeakMemoryMonitor(self.device) as memory_monitor:
+                    generated_summaries = self.inference(inputs=dialogues_ids, src_masks=src_masks,
+                                                         role_ids=role_ids, pos_ids=pos_ids,
+                                                         dialogues_lens=dialogues_lens)
+                decode_seconds = time.perf_counter() - decode_begin
+
+                memory_log.log(epoch=epoch, meeting=batch_idx, num_turns=dialogues_ids.size(1),
+                               num_tokens=int(dialogues_lens.sum()),
+                               summary_tokens=len(generated_summaries.split()),
+                               peak_memory_mb=memory_monitor.peak_mb, **self.memory_stats)
+
+                results_store.add(checkpoint, meeting_id, config, generated_summaries, reference_summaries,
+                                  epoch=epoch, eval_path=eval_path, decode_seconds=decode_seconds)
 
                 cand_list.append(generated_summaries)
                 ref_list.append(reference_summaries)
 
+            memory_log.close()
+            results_store.close()
+            if num_cached > 0:
+                print('[Results store]: {} of {} summaries read from {}'.format(
+                    num_cached, len(cand_list), results_store.path))
             results_dict = compute_rouge_scores(cand_list, ref_list)
             print('[ROUGE]: ', results_dict)
 
+            if self.profiler is not None:
+                print(self.profiler.export(os.path.join(self.hparams.save_dirpath, 'profile')))
+
             if epoch is not None:
                 self.summary_writer.add_scalar('test/rouge-F1', results_dict['rouge_1_f_score'], epoch)
                 self.summary_writer.add_scalar('test/rouge-F2', results_dict['rouge_2_f_score'], epoch)
                 self.summary_writer.add_scalar('test/rouge-FL', results_dict['rouge_l_f_score'], epoch)
 
-    def inference(self, inputs, src_masks, role_ids=None, pos_ids=None):
-        # Give full probability to the first beam on the first step.
-        topk_log_probs = (
-            torch.tensor([0.0] + [float("-inf")] * (self.beam_size - 1),
-                         device=self.device).repeat(self.batch_size))
-
-        alive_seq = torch.full(
-            [self.batch_size * self.beam_size, 1],
-            self.start_token_id,
-            dtype=torch.long,
-            device=self.device)
-
-        batch_offset = torch.arange(
-            self.batch_size, dtype=torch.long, device=self.device)
-
-        beam_offset = torch.arange(
-            0,
-            self.batch_size * self.beam_size,
-            step=self.beam_size,
-            dtype=torch.long,
-            device=self.device)
-
-        hypotheses = [[] for _ in range(self.batch_size)]
-        results = {}
-        results["predictions"] = [[] for _ in range(self.batch_size)]  # noqa: F812
-        results["scores"] = [[] for _ in range(self.batch_size)]  # noqa: F812
-        results["gold_score"] = [0] * self.batch_size
-
-        # construct inputs
-        inputs = torch.squeeze(inputs, 0)  # [num_turns, seq_len]
-        inputs_word_emb = self.model.embedding_word(inputs) # [num_turns, seq_len, 300]
-        src_masks = src_masks.squeeze(0)
-
-        if self.hparams.use_pos:
-            pos_ids = torch.squeeze(pos_ids, 0)
-            inputs_pos_emb = self.model.embedding_pos(pos_ids)  # [num_turns, seq_len, pos_dim==12]
-            inputs_word_emb = torch.cat((inputs_word_emb, inputs_pos_emb), -1)
-
-        word_level_outputs = self.model.word_level_encoder(inputs=inputs_word_emb,
-                                                           src_masks=src_masks)  # [num_turns, seq_len, 300]
-
-        turn_level_inputs = word_level_outputs[:, 0]  # [num_turns, 300]
-        turn_level_inputs = torch.unsqueeze(turn_level_inputs, 0)  # [1, num_turns, 300]
-
-        if self.hparams.use_role:
-            role_ids = role_ids.squeeze(-1)
-            turn_level_role_emb = self.model.embedding_role(role_ids)  # [1, num_turns, role_dim==30]
-            turn_level_outputs = self.model.turn_level_encoder(inputs=turn_level_inputs,
-                                                         src_masks=None,
-                                                         role_inputs=turn_level_role_emb)  # [1, num_turns, 300]
-        else:
-            turn_level_outputs = self.model.turn_level_encoder(inputs=turn_level_inputs)  # [1, num_turns, 300]
-
-        # word_level_outputs = word_level_outputs[:, 1:]
-        word_level_shape = word_level_outputs.shape
-        word_level_outputs = word_level_outputs.reshape(word_level_shape[0] * word_level_shape[1], 300)
-        word_level_outputs = word_level_outputs.unsqueeze(0)  # [1, num_turns * seq_len, 300]
-
-        decoder_state = self.model.decoder.init_decoder_state()
-        decoder_state.map_batch_fn(
-            lambda state, dim: tile(state, self.beam_size, dim=dim))
-
-        word_level_memory_beam = word_level_outputs.detach().repeat(self.beam_size, 1, 1)  # [beam_size, num_turns * seq_len, 300]
-        turn_level_memory_beam = turn_level_outputs.detach().repeat(self.beam_size, 1, 1)  # [beam_size, num_turns, 300]
-
-        for step in tqdm(range(self.gen_max_length)):
-            tgt_inputs = alive_seq[:, -1].view(1, -1).transpose(0, 1)  # (beam_size, tgt_seq_len==1)
-
-            tgt_word_emb = self.model.embedding_word(tgt_inputs) # (beam_size, tgt_seq_len==1, 300)
-
-            decoder_outputs, decoder_state = self.model.decoder(
-                inputs=(tgt_word_emb, word_level_memory_beam, turn_level_memory_beam),
-                state=decoder_state, step=step)
-
-            logits, log_probs = self.generator(decoder_outputs)  # logits: [beam_size, tgt_seq_len==1, vocab_size]
-
-            log_probs = log_probs.squeeze(1) # [beam_size, vocab_size]
-            vocab_size = log_probs.size(1)
-
-            if step < self.min_length:
-                log_probs[:, self.end_token_id] = -1e20
-
-            # Multiply probs by the beam probability.
-            log_probs += topk_log_probs.view(-1).unsqueeze(1)
-
-            alpha = 0.6
-            length_penalty = ((5.0 + (step + 1)) / 6.0) ** alpha
-
-            # Flatten probs into a list of possibilities.
-            curr_scores = log_probs / length_penalty
-
-            if self.hparams.blook_trigram:
-                # Trigram-Blocking
-                cur_len = alive_seq.size(1)
-                if (cur_len > 3):
-                    for i in range(self.beam_size):  # For each (batch x beam_size)
-
-                        fail = False
-                        words = map(lambda n: int(n), alive_seq[i])
-                        words = list(map(lambda w: self.vocab_word.id2token[w], words))
-                        if (len(words) <= 3):
-                            continue
-                        trigrams = [(words[i - 1], words[i], words[i + 1]) for i in range(1, len(words) - 1)]
-                        trigram = tuple(trigrams[-1])
-                        if trigram in trigrams[:-1]:
-                            fail = True
-                        if fail:
-                            curr_scores[i] = -1e20
-
-            curr_scores = curr_scores.reshape(-1, self.beam_size * vocab_size)
-            topk_scores, topk_ids = curr_scores.topk(self.beam_size, dim=-1)
-
-            # Recover log probs.
-            topk_log_probs = topk_scores * length_penalty
-
-            # Resolve beam origin and true word ids.
-            topk_beam_index = topk_ids.div(vocab_size)
-            topk_ids = topk_ids.fmod(vocab_size)
-
-            # Map beam_index to batch_index in the flat representation.
-            batch_index = (
-                    topk_beam_index
-                    + beam_offset[:topk_beam_index.size(0)].unsqueeze(1))
-            select_indices = batch_index.view(-1)
-
-            # Append last prediction.
-            alive_seq = torch.cat(
-                [alive_seq.index_select(0, select_indices),
-                 topk_ids.view(-1, 1)], -1)
-
-            is_finished = topk_ids.eq(self.end_token_id)
-
-            if step + 1 == self.gen_max_length:
-                is_finished.fill_(1)
-            end_condition = is_finished[:, 0].eq(1)
-
-            if is_finished.any():
-                predictions = alive_seq.view(-1, self.beam_size, alive_seq.size(-1))
-                for i in range(is_finished.size(0)):
-                    b = batch_offset[i]
-                    if end_condition[i]:
-                        is_finished[i].fill_(1)
-                    finished_hyp = is_finished[i].nonzero().view(-1)
-                    # Store finished hypotheses for this batch.
-                    for j in finished_hyp:
-                        hypotheses[b].append((
-                            topk_scores[i, j],
-                            predictions[i, j, 1:]))
-                    # If the batch reached the end, save the n_best hypotheses.
-                    if end_condition[i]:
-                        best_hyp = sorted(
-                            hypotheses[b], key=lambda x: x[0], reverse=True)
-                        score, pred = best_hyp[0]
-
-                        results["scores"][b].append(score)
-                        results["predictions"][b].append(pred)
-
-                non_finished = end_condition.eq(0).nonzero().view(-1)
-                # If all sentences are translated, no need to go further.
-                if len(non_finished) == 0:
-                    break
-
-                # Remove finished batches for the next step.
-                topk_log_probs = topk_log_probs.index_select(0, non_finished)
-                batch_index = batch_index.index_select(0, non_finished)
-                batch_offset = batch_offset.index_select(0, non_finished)
-                alive_seq = predictions.index_select(0, non_finished) \
-                    .view(-1, alive_seq.size(-1))
-
-            # Reorder states.
-            select_indices = batch_index.view(-1)
-            word_level_memory_beam = word_level_memory_beam.index_select(0, select_indices)
-            turn_level_memory_beam = turn_level_memory_beam.index_select(0, select_indices)
-            decoder_state.map_batch_fn(
-                lambda state, dim: state.index_select(dim, select_indices))
-
-        preds = results['predictions'][0][0]
-        summary = self.get_summaries(preds)
-        summary = summary.replace('<EOS>', '').replace('<END>', '')
-
-        print('[Generated_Summaries]: ', summary)
-        return summary
-
-
+        return results_dict
+
+    def inference(self, inputs, src_masks, role_ids=None, pos_ids=None, dialogues_lens=None):
+        # Decoding runs under autocast with hparams.autocast_dtype wherever inference is called from
+        with autocast(self.hparams):
+            # Beam bookkeeping tensors are allocated once per meeting, see utils/beam_search.py
+            beam = BeamSearch(self.batch_size, self.beam_size, self.gen_max_length, self.start_token_id,
+                              self.end_token_id, min_length=self.min_length, block_trigram=self.hparams.blook_trigram,
+                              device=self.device)
+
+            # construct inputs
+            word_level_outputs, turn_level_outputs = self.model.encode(inputs, src_masks, role_ids=role_ids,
+                                                                       pos_ids=pos_ids,
+                                                                       dialogues_lens=dialogues_lens) # [1, num_words, 300]
+
+            # Self-attention caches are preallocated for gen_max_length steps and reordered in place, the encoder
+            # memories and their cross-attention keys and values are shared by all beams
+            decoder_state = self.model.decoder.init_decoder_state(max_length=self.gen_max_length)
+            word_level_memory = word_level_outputs.detach() # [1, num_words, 300]
+            turn_level_memory = turn_level_outputs.detach() # [1, num_turns, 300]
+
+            for step in tqdm(range(self.gen_max_length)):
+                if self.profiler is not None:
+                    self.profiler.set_step(step)
+
+                # Only the decoder computation allocates, the beam bookkeeping and the reordering do not
+                with record_function('decoder_step'):
+                    tgt_word_emb = self.model.embedding_word(beam.last_tokens) # (beam_size, tgt_seq_len==1, 300)
+
+                    decoder_outputs, decoder_state = self.model.decoder(
+                        inputs=(tgt_word_emb, word_level_memory, turn_level_memory),
+                        state=decoder_state, step=step, word_turns=self.model.word_turns)
+
+                    logits, log_probs = self.generator(decoder_outputs)  # log_probs: [beam_size x tgt_seq_len==1, vocab_size]
+
+                with record_function('beam_step'):
+                    select_indices = beam.advance(step, log_probs)
+                    # If all meetings are summarized, no need to go further.
+                    if beam.is_done():
+                        break
+
+                    # Reorder states.
+                    decoder_state.reorder(select_indices)
+
+            # The caches are allocated at the first step with their final size
+            mb = 1024 ** 2
+            self.memory_stats = {'encoder_output_mb': tensor_bytes([word_level_outputs, turn_level_outputs]) / mb,
+                                 'decoder_cache_mb': tensor_bytes(decoder_state.cache) / mb,
+                                 'beam_mb': tensor_bytes([log_probs] + beam.buffers()) / mb}
+
+            if self.profiler is not None:
+                self.profiler.set_step(None)
+
+            predictions, _ = beam.finalize()
+            summary = self.get_summaries(predictions[0])
+            summary = summary.replace('<EOS>', '').replace('<END>', '')
+
+            print('[Generated_Summaries]: ', summary)
+            return summary
@@ -0,0 +1,47 @@
+"""
+Fixtures building a small randomly initialized model on the synthetic meetings
+of ``benchmarks/synthetic.py`` (no AMI data or GloVe vectors needed).
+
+    python -m pytest tests
+"""
+import collections
+
+import pytest
+import torch
+from torch.utils.data import DataLoader
+
+from benchmarks.synthetic import write_corpora
+from config.hparams import PARAMS
+from data.dataset import AMIDataset
+from models.model import SummarizationModel
+
+
+@pytest.fixture(scope='session')
+def data_dir(tmp_path_factory):
+    data_dir = str(tmp_path_factory.mktemp('corpora')) + '/'
+    return write_corpora(data_dir, num_meetings=2, num_turns=8, turn_length=12, vocab_size=30, summary_length=10)
+
+
+@pytest.fixture
+def small_model(data_dir):
+    """Returns a function building (hparams, model, batches) of a small model in eval mode, hparams can be
+    overridden by keyword."""
+    def build(**overrides):
+        hparams = dict(PARAMS)
+        hparams.update(device='cpu', data_dir=data_dir, save_dirpath=data_dir, workers=0, gpu_ids=[-1],
+                       embedding_size_word=32, hidden_size=32, num_heads=2, filter_size=16, num_hidden_layers=1,
+                       beam_size=4, min_length=0, gen_max_length=16)
+        hparams.update(overrides)
+        hparams = collections.namedtuple('HParams', sorted(hparams.keys()))(**hparams)
+
+        torch.manual_seed(0)
+        dataset = AMIDataset(hparams, type='test')
+        # checkpoint != None skips loading GloVe vectors from spaCy
+        model = SummarizationModel(hparams=hparams, vocab_word=dataset.vocab_word, vocab_role=dataset.vocab_role,
+                                   vocab_pos=dataset.vocab_pos, checkpoint='synthetic',
+                                   word_counts=dataset.word_counts())
+        model.eval()
+        batches = [{key: value for key, value in batch.items() if isinstance(value, torch.Tensor)}
+                   for batch in DataLoader(dataset, batch_size=1)]
+        return hparams, model, batches
+    return build
@@ -0,0 +1,185 @@
+import pytest
+import torch
+
+from models.transformer.layers import _gen_bias_mask, _gen_seq_bias_mask
+from models.transformer.sublayers import ChunkedAttention, MultiHeadAttention
+
+
+def dense_attention(queries, keys, values, bias):
+    weights = torch.softmax(torch.matmul(queries, keys.transpose(-1, -2)) + bias, dim=-1)
+    return torch.matmul(weights, values)
+
+
+def attention_inputs(bias_shape, dtype=torch.float64):
+    """Queries [2, 2, 5, 4], keys [2, 2, 7, 4], values [2, 2, 7, 3] and a bias of bias_shape, requiring gradients."""
+    torch.manual_seed(0)
+    shapes = [(2, 2, 5, 4), (2, 2, 7, 4), (2, 2, 7, 3), bias_shape]
+    return [torch.randn(*shape, dtype=dtype, requires_grad=True) for shape in shapes]
+
+
+# The bias is broadcast over heads (padding masks) or over the batch and heads (causal mask)
+@pytest.mark.parametrize('bias_shape', [(2, 1, 5, 7), (1, 1, 5, 7), (2, 2, 5, 7)])
+@pytest.mark.parametrize('dropout', [0.0, 0.3])
+def test_chunked_attention_gradcheck(bias_shape, dropout):
+    # Dropout masks are redrawn from the same seed at every call, so the function is deterministic
+    inputs = attention_inputs(bias_shape)
+    assert torch.autograd.gradcheck(lambda *args: ChunkedAttention.apply(*args, 3, dropout, 1234), inputs)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 7, 16])
+def test_chunked_attention_matches_dense_attention(chunk_size):
+    inputs = attention_inputs((2, 1, 5, 7))
+    # Masked keys, as in the padding masks of _gen_seq_bias_mask
+    with torch.no_grad():
+        inputs[3][:, :, :, 5:] = float(torch.iinfo(torch.int64).min)
+    grad_outputs = torch.randn(2, 2, 5, 3, dtype=torch.float64)
+
+    outputs = ChunkedAttention.apply(*inputs, chunk_size, 0.0, 0)
+    grads = torch.autograd.grad(outputs, inputs, grad_outputs)
+    expected_outputs = dense_attention(*inputs)
+    expected_grads = torch.autograd.grad(expected_outputs, inputs, grad_outputs)
+
+    assert torch.allclose(outputs, expected_outputs)
+    for grad, expected_grad in zip(grads, expected_grads):
+        assert torch.allclose(grad, expected_grad)
+
+
+@pytest.mark.parametrize('causal', [False, True])
+def test_chunked_multi_head_attention_matches_dense(causal):
+    torch.manual_seed(0)
+    bias_mask = _gen_bias_mask(16) if causal else None
+    dense = MultiHeadAttention(8, 8, 8, 8, num_heads=2, bias_mask=bias_mask).double()
+    chunked = MultiHeadAttention(8, 8, 8, 8, num_heads=2, bias_mask=bias_mask, chunk_size=2, chunk_threshold=0).double()
+    chunked.load_state_dict(dense.state_dict())
+    inputs = torch.randn(3, 6, 8, dtype=torch.float64, requires_grad=True)
+    src_masks = _gen_seq_bias_mask([6, 4, 2], 6).double()
+
+    outputs = [attention(inputs, inputs, inputs, src_masks) for attention in (dense, chunked)]
+    # Padding rows are not compared, as they are not in the model outputs
+    valid = (src_masks[:, 0].diagonal(dim1=-2, dim2=-1) == 0).unsqueeze(-1).double()
+    grads = [torch.autograd.grad((output * valid).sum(), [inputs] + list(attention.parameters()))
+             for output, attention in zip(outputs, (dense, chunked))]
+
+    assert torch.allclose(outputs[0] * valid, outputs[1] * valid)
+    for grad, expected_grad in zip(grads[1], grads[0]):
+        assert torch.allclose(grad, expected_grad)
+
+
+def projected_inputs(attention, lengths, seq_len=9):
+    """Scaled queries, keys and values [len(lengths), 2, seq_len, 4] of attention and the padding masks of lengths."""
+    torch.manual_seed(0)
+    inputs = torch.randn(len(lengths), seq_len, 8)
+    queries, keys, values = (attention._split_heads(linear(inputs)) for linear in
+                             (attention.query_linear, attention.key_linear, attention.value_linear))
+    return queries * attention.query_scale, keys, values, _gen_seq_bias_mask(lengths, seq_len)
+
+
+@pytest.mark.parametrize('window_size', [8, 9, 12])
+@pytest.mark.parametrize('num_global_tokens', [0, 1])
+def test_windowed_attention_covering_the_sequence_matches_dense(window_size, num_global_tokens):
+    attention = MultiHeadAttention(8, 8, 8, 8, num_heads=2, window_size=window_size,
+                                   num_global_tokens=num_global_tokens).eval()
+    queries, keys, values, src_masks = projected_inputs(attention, [9, 5, 2])
+
+    with torch.no_grad():
+        contexts = attention._windowed_attention(queries, keys, values, src_masks)
+        expected = torch.matmul(torch.softmax(torch.matmul(queries, keys.transpose(-1, -2)) + src_masks, dim=-1),
+                                values)
+    # Padding queries included
+    assert torch.allclose(contexts, expected, atol=1e-6)
+
+
+@pytest.mark.parametrize('window_size', [1, 2, 3])
+def test_windowed_attention_matches_banded_dense_attention(window_size):
+    attention = MultiHeadAttention(8, 8, 8, 8, num_heads=2, window_size=window_size, num_global_tokens=1).eval()
+    queries, keys, values, src_masks = projected_inputs(attention, [9, 5, 2])
+
+    positions = torch.arange(9)
+    band = (positions.view(-1, 1) - positions.view(1, -1)).abs() <= window_size
+    band[0, :] = band[:, 0] = True
+    logits = torch.matmul(queries, keys.transpose(-1, -2)) + src_masks
+    with torch.no_grad():
+        contexts = attention._windowed_attention(queries, keys, values, src_masks)
+        expected = torch.matmul(torch.softmax(logits.masked_fill(~band, float('-inf')), dim=-1), values)
+        dense_padding = torch.matmul(torch.softmax(logits, dim=-1), values)
+    valid = src_masks.max(dim=-1, keepdim=True)[0] == 0
+    assert torch.allclose(contexts, torch.where(valid, expected, dense_padding), atol=1e-6)
+
+
+def test_windowed_encoder_matches_banded_dense_encoder(small_model):
+    # The convolutional feed-forward layers carry the outputs of padding positions into the real tokens
+    _, dense_model, _ = small_model()
+    _, windowed_model, _ = small_model(encoder_attention_window=2)
+    encoder, windowed_encoder = dense_model.word_level_encoder, windowed_model.word_level_encoder
+    windowed_encoder.load_state_dict(encoder.state_dict())
+    torch.manual_seed(0)
+    inputs = torch.randn(3, 9, 32)
+    src_masks = _gen_seq_bias_mask([9, 5, 2], 9)
+
+    # The window as a mask of the real queries, every position attends to and is attended by the first one
+    positions = torch.arange(9)
+    band = (positions.view(-1, 1) - positions.view(1, -1)).abs() <= 2
+    band[0, :] = band[:, 0] = True
+    valid = src_masks.max(dim=-1, keepdim=True)[0] == 0
+    band_masks = src_masks.masked_fill(valid & ~band, float(torch.iinfo(torch.int64).min))
+    with torch.no_grad():
+        expected = encoder(inputs=inputs, src_masks=band_masks, role_inputs=None)
+        outputs = windowed_encoder(inputs=inputs, src_masks=src_masks, role_inputs=None)
+    assert torch.allclose(outputs, expected, atol=1e-5)
+
+
+def turn_sparse_inputs(turn_lengths, batch_size=3, queries_len=4, k=2):
+    """Queries, keys and values of the words of turns of turn_lengths, the turn of every word and the top-k turns
+    of every query."""
+    torch.manual_seed(0)
+    num_words = sum(turn_lengths)
+    queries = torch.randn(batch_size, 2, queries_len, 4)
+    keys, values = torch.randn(batch_size, 2, num_words, 4), torch.randn(batch_size, 2, num_words, 4)
+    word_turns = torch.arange(len(turn_lengths)).repeat_interleave(torch.tensor(turn_lengths))
+    turn_indices = torch.rand(batch_size, queries_len, len(turn_lengths)).topk(k, dim=-1)[1]
+    return queries, keys, values, word_turns, turn_indices
+
+
+@pytest.mark.parametrize('turn_lengths', [[3, 3, 3, 3], [3, 1, 5, 2, 4]])
+def test_turn_sparse_attention_matches_masked_dense_attention(turn_lengths):
+    attention = MultiHeadAttention(8, 8, 8, 8, num_heads=2).eval()
+    queries, keys, values, word_turns, turn_indices = turn_sparse_inputs(turn_lengths)
+
+    # Every query only attends to the words of its turns
+    selected = (word_turns.view(1, 1, 1, -1) == turn_indices.unsqueeze(-1)).any(dim=-2).unsqueeze(1)
+    logits = torch.matmul(queries, keys.transpose(-1, -2)).masked_fill(~selected, float('-inf'))
+    expected = torch.matmul(torch.softmax(logits, dim=-1), values)
+    with torch.no_grad():
+        contexts = attention._turn_sparse_attention(queries, keys, values, turn_indices, len(turn_lengths),
+                                                    word_turns)
+        # Single decoding positions gather the words of their turns instead
+        steps = [attention._turn_sparse_attention(queries[:, :, [i]], keys, values, turn_indices[:, [i]],
+                                                  len(turn_lengths), word_turns) for i in range(queries.shape[2])]
+        # Keys and values shared by the whole batch
+        shared = attention._turn_sparse_attention(queries[:, :, :1], keys[:1], values[:1], turn_indices[:, :1],
+                                                  len(turn_lengths), word_turns)
+
+    assert torch.allclose(contexts, expected, atol=1e-6)
+    assert torch.allclose(torch.cat(steps, dim=2), expected, atol=1e-6)
+    shared_expected = torch.matmul(torch.softmax(torch.matmul(queries[:, :, :1], keys[:1].transpose(-1, -2))
+                                                 .masked_fill(~selected[:, :, :1], float('-inf')), dim=-1), values[:1])
+    assert torch.allclose(shared, shared_expected, atol=1e-6)
+
+
+def test_hierarchical_decoding_matches_training(small_model):
+    _, model, batches = small_model(hierarchical_top_k_turns=3)
+    batch = batches[0]
+    targets = batch['labels_ids'][:, :8]
+    with torch.no_grad():
+        word_memory, turn_memory = model.encode(batch['dialogues_ids'], batch['src_masks'],
+                                                dialogues_lens=batch['dialogues_lens'])
+        # Padding positions are removed from the word memory with the hierarchical attention too
+        assert word_memory.shape[1] == batch['dialogues_lens'].sum() == len(model.word_turns)
+        assert turn_memory.shape[1] > 3
+
+        targets_word_emb = model.embedding_word(targets)
+        expected, _ = model.decoder((targets_word_emb, word_memory, turn_memory), word_turns=model.word_turns)
+        state = model.decoder.init_decoder_state()
+        outputs = [model.decoder((targets_word_emb[:, [step]], word_memory, turn_memory), state=state, step=step,
+                                 word_turns=model.word_turns)[0] for step in range(targets.shape[1])]
+    assert torch.allclose(torch.cat(outputs, dim=1), expected, atol=1e-5)
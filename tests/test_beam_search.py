@@ -0,0 +1,239 @@
+import pytest
+import torch
+
+from predictor import Predictor
+from utils.beam_search import BeamSearch
+from utils.utils import tile
+
+
+def allocations(fn):
+    """(op name, bytes) of every CPU allocation made while running fn, from the profiler memory events."""
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as profiler:
+        fn()
+    return [(event.name, event.self_cpu_memory_usage) for event in profiler.events()
+            if event.self_cpu_memory_usage > 0]
+
+
+def range_allocations(fn, name):
+    """(op name, bytes) of the CPU allocations made inside the record_function ranges called name while running
+    fn, and the number of these ranges."""
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as profiler:
+        fn()
+
+    def in_range(event):
+        while event is not None:
+            if event.name == name:
+                return True
+            event = event.cpu_parent
+        return False
+    events = profiler.events()
+    return [(event.name, event.self_cpu_memory_usage) for event in events
+            if event.self_cpu_memory_usage > 0 and in_range(event)], sum(event.name == name for event in events)
+
+
+def test_allocations_are_detected():
+    assert allocations(lambda: torch.cat([torch.zeros(64, 64), torch.ones(64, 64)]))
+
+
+@pytest.mark.parametrize('block_trigram', [True, False])
+def test_advance_does_not_allocate(block_trigram):
+    batch_size, beam_size, vocab_size, num_steps = 2, 4, 8, 40
+    torch.manual_seed(0)
+    beam = BeamSearch(batch_size, beam_size, num_steps, start_token_id=4, end_token_id=5, min_length=10,
+                      block_trigram=block_trigram)
+    # A small vocabulary so that trigrams repeat, advance modifies the log-probabilities in place
+    log_probs = [torch.randn(batch_size * beam_size, vocab_size).log_softmax(-1) for _ in range(num_steps)]
+    # Past the first trigram blocking step
+    for step in range(5):
+        beam.advance(step, log_probs[step])
+
+    def decode():
+        for step in range(5, num_steps):
+            beam.advance(step, log_probs[step])
+    assert allocations(decode) == []
+
+
+class ReferenceSearch(object):
+    """The search of Predictor.inference before utils/beam_search.py (batch_size 1), on growing tensors."""
+
+    def __init__(self, beam_size, max_length, start_token_id, end_token_id, min_length=0, block_trigram=True):
+        self.beam_size = beam_size
+        self.max_length = max_length
+        self.end_token_id = end_token_id
+        self.min_length = min_length
+        self.block_trigram = block_trigram
+        # Give full probability to the first beam on the first step.
+        self.topk_log_probs = torch.tensor([0.0] + [float("-inf")] * (beam_size - 1))
+        self.alive_seq = torch.full([beam_size, 1], start_token_id, dtype=torch.long)
+        self.hypotheses = []
+        self.num_blocked = 0
+        self.done = False
+
+    def advance(self, step, log_probs):
+        vocab_size = log_probs.size(1)
+        if step < self.min_length:
+            log_probs[:, self.end_token_id] = -1e20
+        log_probs += self.topk_log_probs.view(-1).unsqueeze(1)
+        length_penalty = ((5.0 + (step + 1)) / 6.0) ** 0.6
+        curr_scores = log_probs / length_penalty
+
+        if self.block_trigram and self.alive_seq.size(1) > 3:
+            for i in range(self.beam_size):
+                words = self.alive_seq[i].tolist()
+                trigrams = [(words[j - 1], words[j], words[j + 1]) for j in range(1, len(words) - 1)]
+                if len(words) > 3 and tuple(trigrams[-1]) in trigrams[:-1]:
+                    curr_scores[i] = -1e20
+                    self.num_blocked += 1
+
+        topk_scores, topk_ids = curr_scores.reshape(-1, self.beam_size * vocab_size).topk(self.beam_size, dim=-1)
+        self.topk_log_probs = topk_scores * length_penalty
+        # Floor division, Tensor.div of integers is a true division since torch 1.5
+        select_indices = torch.div(topk_ids, vocab_size, rounding_mode='floor').view(-1)
+        topk_ids = topk_ids.fmod(vocab_size)
+        self.alive_seq = torch.cat([self.alive_seq.index_select(0, select_indices), topk_ids.view(-1, 1)], -1)
+
+        is_finished = topk_ids.eq(self.end_token_id)
+        if step + 1 == self.max_length:
+            is_finished.fill_(1)
+        if is_finished[0, 0]:
+            is_finished.fill_(1)
+            self.done = True
+        for j in is_finished[0].nonzero().view(-1):
+            self.hypotheses.append((float(topk_scores[0, j]), self.alive_seq[j, 1:].tolist()))
+        return select_indices
+
+    def finalize(self):
+        score, prediction = sorted(self.hypotheses, key=lambda x: x[0], reverse=True)[0]
+        return prediction, score
+
+
+@pytest.mark.parametrize('min_length, max_length, block_trigram', [
+    (0, 30, True),
+    (10, 30, True),
+    (10, 30, False),
+    (30, 30, True),
+])
+def test_advance_matches_reference_search(min_length, max_length, block_trigram):
+    beam_size, vocab_size, start_token_id, end_token_id = 4, 6, 4, 5
+    for seed in range(5):
+        torch.manual_seed(seed)
+        beam = BeamSearch(1, beam_size, max_length, start_token_id, end_token_id, min_length=min_length,
+                          block_trigram=block_trigram)
+        reference = ReferenceSearch(beam_size, max_length, start_token_id, end_token_id, min_length=min_length,
+                                    block_trigram=block_trigram)
+        for step in range(max_length):
+            # A small vocabulary so that trigrams repeat
+            log_probs = torch.randn(beam_size, vocab_size).mul_(2).log_softmax(-1)
+            select_indices = beam.advance(step, log_probs.clone())
+            assert select_indices.tolist() == reference.advance(step, log_probs).tolist()
+            assert beam.is_done() == reference.done
+            if beam.is_done():
+                break
+
+        predictions, scores = beam.finalize()
+        prediction, score = reference.finalize()
+        assert predictions[0] == prediction
+        assert scores[0] == pytest.approx(score, rel=1e-5)
+        if block_trigram:
+            assert reference.num_blocked > 0
+
+
+def reference_inference(predictor, inputs, src_masks, dialogues_lens):
+    """ReferenceSearch with the encoder and decoder of Predictor.inference."""
+    model, beam_size = predictor.model, predictor.beam_size
+    reference = ReferenceSearch(beam_size, predictor.gen_max_length, predictor.start_token_id,
+                                predictor.end_token_id, min_length=predictor.min_length,
+                                block_trigram=predictor.hparams.blook_trigram)
+
+    word_level_outputs, turn_level_outputs = model.encode(inputs, src_masks, dialogues_lens=dialogues_lens)
+    decoder_state = model.decoder.init_decoder_state()
+    decoder_state.map_batch_fn(lambda state, dim: tile(state, beam_size, dim=dim))
+    word_level_memory_beam = word_level_outputs.detach().repeat(beam_size, 1, 1)
+    turn_level_memory_beam = turn_level_outputs.detach().repeat(beam_size, 1, 1)
+
+    for step in range(predictor.gen_max_length):
+        tgt_inputs = reference.alive_seq[:, -1:]
+        decoder_outputs, decoder_state = model.decoder(
+            inputs=(model.embedding_word(tgt_inputs), word_level_memory_beam, turn_level_memory_beam),
+            state=decoder_state, step=step, word_turns=model.word_turns)
+        _, log_probs = predictor.generator(decoder_outputs)
+        select_indices = reference.advance(step, log_probs)
+        if reference.done:
+            break
+
+        word_level_memory_beam = word_level_memory_beam.index_select(0, select_indices)
+        turn_level_memory_beam = turn_level_memory_beam.index_select(0, select_indices)
+        decoder_state.map_batch_fn(lambda state, dim: state.index_select(dim, select_indices))
+
+    prediction, _ = reference.finalize()
+    return predictor.get_summaries(prediction).replace('<EOS>', '').replace('<END>', '')
+
+
+@pytest.mark.parametrize('min_length, gen_max_length, blook_trigram', [
+    (0, 16, True),
+    (0, 16, False),
+    (8, 16, True),
+    (4, 24, True),
+    (12, 12, False),
+])
+def test_beam_search_matches_reference(small_model, min_length, gen_max_length, blook_trigram):
+    hparams, model, batches = small_model(min_length=min_length, gen_max_length=gen_max_length,
+                                          blook_trigram=blook_trigram)
+    predictor = Predictor(hparams, model=model, vocab_word=model.vocab_word, vocab_role=model.vocab_role,
+                          vocab_pos=model.vocab_pos)
+    with torch.no_grad():
+        for batch in batches:
+            inputs, src_masks, dialogues_lens = batch['dialogues_ids'], batch['src_masks'], batch['dialogues_lens']
+            summary = predictor.inference(inputs, src_masks, role_ids=batch['role_ids'], pos_ids=batch['pos_ids'],
+                                          dialogues_lens=dialogues_lens)
+            assert summary == reference_inference(predictor, inputs, src_masks, dialogues_lens)
+
+
+def test_inference_steps_do_not_allocate(small_model):
+    hparams, model, batches = small_model(min_length=8, gen_max_length=16)
+    predictor = Predictor(hparams, model=model, vocab_word=model.vocab_word, vocab_role=model.vocab_role,
+                          vocab_pos=model.vocab_pos)
+    batch = batches[0]
+
+    def inference():
+        with torch.no_grad():
+            predictor.inference(batch['dialogues_ids'], batch['src_masks'], role_ids=batch['role_ids'],
+                                pos_ids=batch['pos_ids'], dialogues_lens=batch['dialogues_lens'])
+    # The beam search, its is_done check and the reordering of the decoder caches, at every step
+    beam_allocations, num_steps = range_allocations(inference, 'beam_step')
+    assert num_steps >= hparams.min_length
+    assert beam_allocations == []
+    # The decoder computation itself allocates
+    assert range_allocations(inference, 'decoder_step')[0]
+
+
+def test_preallocated_decoder_state(small_model):
+    hparams, model, batches = small_model()
+    batch, beam_size = batches[0], hparams.beam_size
+    torch.manual_seed(0)
+    tokens = torch.randint(len(model.vocab_word), (beam_size, 3, 1))
+    select_indices = [torch.tensor([1, 1, 0, 3]), torch.tensor([2, 0, 0, 1])]
+    with torch.no_grad():
+        word_memory, turn_memory = model.encode(batch['dialogues_ids'], batch['src_masks'],
+                                                dialogues_lens=batch['dialogues_lens'])
+        state = model.decoder.init_decoder_state(max_length=3)
+        # Caches of the repeated memories, reordered by index_select
+        reference = model.decoder.init_decoder_state()
+        reference_memories = word_memory.repeat(beam_size, 1, 1), turn_memory.repeat(beam_size, 1, 1)
+        for step in range(3):
+            inputs = model.embedding_word(tokens[:, step])
+            outputs, _ = model.decoder((inputs, word_memory, turn_memory), state=state, step=step,
+                                       word_turns=model.word_turns)
+            expected, _ = model.decoder((inputs,) + reference_memories, state=reference, step=step,
+                                        word_turns=model.word_turns)
+            assert torch.allclose(outputs, expected, atol=1e-5)
+            if step < 2:
+                state.reorder(select_indices[step])
+                reference.map_batch_fn(lambda x, dim: x.index_select(dim, select_indices[step]))
+
+    layer_cache = state.cache['layer_0']
+    # Encoder keys and values are cached once for all beams, the self-attention keys have a row per beam
+    assert layer_cache['word_keys'].shape[0] == layer_cache['turn_values'].shape[0] == 1
+    assert layer_cache['self_keys'].shape == reference.cache['layer_0']['self_keys'].shape
+    assert layer_cache['self_length'] == 3 and layer_cache['self_keys_buffer'].shape[0] == 3
+    assert torch.allclose(layer_cache['self_keys'], reference.cache['layer_0']['self_keys'], atol=1e-5)
@@ -0,0 +1,71 @@
+import pytest
+import torch
+
+from models.transformer.sublayers import MultiHeadAttention
+
+
+def test_int8_cache_round_trip():
+    attention = MultiHeadAttention(8, 8, 8, 8, num_heads=2, cache_dtype='int8')
+    torch.manual_seed(0)
+    # Positions of very different magnitudes, each gets its own scale
+    x = torch.randn(1, 2, 7, 4) * torch.logspace(-3, 2, 7).view(1, 1, 7, 1)
+    layer_cache = {}
+    attention._store_cache(layer_cache, 'word_keys', x)
+    quantized, scale = attention._load_cache(layer_cache, 'word_keys', torch.float)
+
+    assert layer_cache['word_keys'].dtype == torch.int8
+    assert scale.shape == (1, 2, 7, 1)
+    # Rounded to the nearest step, the largest element of every (head, position) is 127 steps
+    assert ((quantized * scale - x).abs() <= scale * 0.501).all()
+    assert quantized.abs().amax(dim=-1).eq(127).all()
+
+
+def encoded_inputs(model, batch, beam_size, num_steps=6):
+    """Encoder memories of batch (shared by the beams) and random input tokens [beam_size, num_steps]."""
+    with torch.no_grad():
+        memories = model.encode(batch['dialogues_ids'], batch['src_masks'], dialogues_lens=batch['dialogues_lens'])
+    torch.manual_seed(0)
+    return memories, torch.randint(len(model.vocab_word), (beam_size, num_steps))
+
+
+def decode_steps(model, memories, state, tokens):
+    """Decoder outputs [beam_size, num_steps, hidden_size] of tokens fed one step at a time."""
+    outputs = []
+    with torch.no_grad():
+        for step in range(tokens.shape[1]):
+            inputs = model.embedding_word(tokens[:, step:step + 1])
+            output, state = model.decoder((inputs,) + tuple(memories), state=state, step=step,
+                                          word_turns=model.word_turns)
+            outputs.append(output)
+    return torch.cat(outputs, dim=1)
+
+
+@pytest.mark.parametrize('hierarchical_top_k_turns', [0, 3])
+def test_int8_scales_match_dequantized_cache(small_model, hierarchical_top_k_turns):
+    # The scales applied to the logits and attention weights give the attention over the dequantized cache
+    hparams, model, batches = small_model(decoder_cache_dtype='int8',
+                                          hierarchical_top_k_turns=hierarchical_top_k_turns)
+    memories, tokens = encoded_inputs(model, batches[0], hparams.beam_size)
+    state = model.decoder.init_decoder_state(max_length=tokens.shape[1])
+    outputs = decode_steps(model, memories, state, tokens)
+
+    dequantized = model.decoder.init_decoder_state(max_length=tokens.shape[1])
+    for name, layer_cache in state.cache.items():
+        for key in ('word_keys', 'word_values', 'turn_keys', 'turn_values'):
+            assert layer_cache[key].dtype == torch.int8
+            dequantized.cache[name][key] = layer_cache[key].float() * layer_cache[key + '_scale']
+    expected = decode_steps(model, memories, dequantized, tokens)
+    assert torch.allclose(outputs, expected, atol=1e-5)
+
+
+@pytest.mark.parametrize('decoder_cache_dtype', ['bfloat16', 'int8'])
+def test_quantized_cache_decoding_matches_full_precision(small_model, decoder_cache_dtype):
+    hparams, model, batches = small_model()
+    _, quantized_model, _ = small_model(decoder_cache_dtype=decoder_cache_dtype)
+    quantized_model.load_state_dict(model.state_dict())
+    memories, tokens = encoded_inputs(model, batches[0], hparams.beam_size)
+
+    expected = decode_steps(model, memories, model.decoder.init_decoder_state(max_length=tokens.shape[1]), tokens)
+    outputs = decode_steps(quantized_model, memories,
+                           quantized_model.decoder.init_decoder_state(max_length=tokens.shape[1]), tokens)
+    assert (outputs - expected).abs().max() < 0.05
@@ -0,0 +1,45 @@
+import pytest
+import torch
+
+from models.transformer.layers import _gen_seq_bias_mask
+
+SEQ_LEN = 10
+
+
+def encoder_inputs(num_turns, word_dim):
+    torch.manual_seed(num_turns)
+    lengths = torch.randint(2, SEQ_LEN + 1, (num_turns,)).tolist()
+    lengths[0] = SEQ_LEN
+    return torch.randn(num_turns, SEQ_LEN, word_dim), _gen_seq_bias_mask(lengths, SEQ_LEN)
+
+
+def chunk_sizes(model, inputs_word_emb, src_masks):
+    """Number of turns of every word-level encoder call of model.encode_words, and its outputs."""
+    sizes = []
+    handle = model.word_level_encoder.register_forward_hook(lambda module, inputs, outputs: sizes.append(len(outputs)))
+    try:
+        outputs = model.encode_words(inputs_word_emb, src_masks)
+    finally:
+        handle.remove()
+    return sizes, outputs
+
+
+@pytest.mark.parametrize('encoder_attention_window', [0, 2])
+@pytest.mark.parametrize('num_turns', [1, 2, 5, 8])
+# Budgets in turns, below one turn every turn is encoded alone
+@pytest.mark.parametrize('budget_turns', [0.01, 0.5, 1, 2.5, 4])
+def test_chunked_encoding_matches_unchunked(small_model, encoder_attention_window, num_turns, budget_turns):
+    hparams, model, _ = small_model(encoder_attention_window=encoder_attention_window)
+    inputs_word_emb, src_masks = encoder_inputs(num_turns, hparams.embedding_size_word)
+    turn_bytes = model.turn_encoding_bytes(SEQ_LEN)
+
+    with torch.no_grad():
+        expected = model.encode_words(inputs_word_emb, src_masks)
+        model.hparams = hparams._replace(encoder_memory_budget_mb=(budget_turns * turn_bytes + 1) / 1024 ** 2)
+        sizes, outputs = chunk_sizes(model, inputs_word_emb, src_masks)
+
+    assert outputs.shape == expected.shape
+    assert torch.allclose(outputs, expected, atol=1e-5)
+    assert sum(sizes) == num_turns
+    # The activations of every chunk fit in the budget, whatever the number of turns
+    assert max(sizes) == min(num_turns, max(1, int(budget_turns)))
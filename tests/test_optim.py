@@ -0,0 +1,109 @@
+import pytest
+import torch
+import torch.nn.functional as F
+from torch import nn, optim
+
+from utils.optim import LazyAdam, build_optimizer, clip_grad_norm
+
+
+def dense_copies(parameters):
+    """Copies of the parameters with their gradients densified."""
+    copies = []
+    for p in parameters:
+        copy = p.detach().clone().requires_grad_()
+        copy.grad = p.grad.to_dense() if p.grad.is_sparse else p.grad.clone()
+        copies.append(copy)
+    return copies
+
+
+def test_lazy_adam_matches_adam_on_dense_gradients():
+    torch.manual_seed(0)
+    params = [torch.randn(5, 3, requires_grad=True), torch.randn(4, requires_grad=True)]
+    adam_params = [p.detach().clone().requires_grad_() for p in params]
+    lazy_adam = LazyAdam(params, lr=0.1, betas=(0.8, 0.9))
+    adam = optim.Adam(adam_params, lr=0.1, betas=(0.8, 0.9))
+
+    for _ in range(3):
+        for p, adam_p in zip(params, adam_params):
+            p.grad = torch.randn_like(p)
+            adam_p.grad = p.grad.clone()
+        lazy_adam.step()
+        adam.step()
+        for p, adam_p in zip(params, adam_params):
+            assert torch.allclose(p, adam_p, atol=1e-6)
+            for key in ('exp_avg', 'exp_avg_sq'):
+                assert torch.allclose(lazy_adam.state[p][key], adam.state[adam_p][key], atol=1e-6)
+
+
+def test_lazy_adam_only_updates_the_rows_of_sparse_gradients():
+    torch.manual_seed(0)
+    embedding = nn.Embedding(10, 4, sparse=True)
+    optimizer = LazyAdam(embedding.parameters(), lr=0.1)
+    # A first step on all rows, so that every row has non-zero moments
+    embedding(torch.arange(10)).sum().backward()
+    optimizer.step()
+    optimizer.zero_grad(set_to_none=True)
+
+    state = optimizer.state[embedding.weight]
+    before = {'weight': embedding.weight.detach().clone(), 'exp_avg': state['exp_avg'].clone(),
+              'exp_avg_sq': state['exp_avg_sq'].clone()}
+    # Row 3 twice, its gradients are summed
+    embedding(torch.tensor([1, 3, 3, 7])).pow(2).sum().backward()
+    [adam_weight] = dense_copies([embedding.weight])
+    adam = optim.Adam([adam_weight], lr=0.1)
+    adam.state[adam_weight] = {key: value.clone() if torch.is_tensor(value) else value
+                               for key, value in state.items()}
+    adam.state[adam_weight]['step'] = torch.tensor(float(state['step']))
+    optimizer.step()
+    adam.step()
+
+    rows = [1, 3, 7]
+    after = {'weight': embedding.weight.detach(), 'exp_avg': state['exp_avg'], 'exp_avg_sq': state['exp_avg_sq']}
+    for key in before:
+        changed = (after[key] != before[key]).any(1).nonzero().view(-1).tolist()
+        assert changed == rows
+    # The rows of the gradient get the Adam update
+    assert torch.allclose(embedding.weight[rows], adam_weight[rows], atol=1e-6)
+
+
+@pytest.mark.parametrize('max_norm', [0.5, 1e6])
+def test_clip_grad_norm_matches_dense_clipping(max_norm):
+    torch.manual_seed(0)
+    embedding, linear = nn.Embedding(10, 4, sparse=True), nn.Linear(4, 2)
+    linear(embedding(torch.tensor([1, 3, 3, 7]))).mul(10).pow(2).sum().backward()
+    parameters = list(embedding.parameters()) + list(linear.parameters())
+    dense_parameters = dense_copies(parameters)
+
+    expected_norm = nn.utils.clip_grad_norm_(dense_parameters, max_norm)
+    total_norm = clip_grad_norm(parameters, max_norm)
+
+    assert embedding.weight.grad.is_sparse
+    assert total_norm.item() == pytest.approx(expected_norm.item(), rel=1e-5)
+    for p, dense_p in zip(parameters, dense_parameters):
+        grad = p.grad.to_dense() if p.grad.is_sparse else p.grad
+        assert torch.allclose(grad, dense_p.grad, atol=1e-6)
+
+
+def test_sparse_word_embedding_training_step(small_model):
+    hparams, model, batches = small_model(sparse_word_embedding=True, softmax_samples=8)
+    model.train()
+    batch, labels_ids = batches[0], batches[0]['labels_ids']
+    logits = model(inputs=batch['dialogues_ids'], targets=labels_ids[:, :-1], src_masks=batch['src_masks'],
+                   dialogues_lens=batch['dialogues_lens'], sampled_labels=labels_ids[:, 1:])
+    F.cross_entropy(logits, torch.zeros(logits.shape[0], dtype=torch.long)).backward()
+
+    # The tied weight gets the rows of the inputs, targets, labels and sampled negatives only
+    weight = model.embedding_word.weight
+    assert model.final_linear.weight is weight
+    assert weight.grad.is_sparse
+    grad = weight.grad.coalesce()
+    # Rows of padding tokens can have all-zero gradients
+    rows = grad._indices()[0][grad._values().abs().sum(1) > 0].tolist()
+    assert 0 < len(rows) < model.vocab_size
+
+    optimizer = build_optimizer(model, hparams)
+    assert isinstance(optimizer, LazyAdam)
+    before = weight.detach().clone()
+    clip_grad_norm(model.parameters(), hparams.max_gradient_norm)
+    optimizer.step()
+    assert (weight != before).any(1).nonzero().view(-1).tolist() == sorted(rows)
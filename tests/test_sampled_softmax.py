@@ -0,0 +1,40 @@
+import pytest
+import torch
+from torch import nn
+
+from train import Summarization
+
+
+def build_trainer(hparams, model):
+    # compute_loss only needs the hparams, the model, its criterion and the device
+    trainer = Summarization.__new__(Summarization)
+    trainer.hparams, trainer.model, trainer.device = hparams, model, torch.device('cpu')
+    trainer.criterion = nn.CrossEntropyLoss()
+    return trainer
+
+
+def test_sampled_softmax_training_step(small_model):
+    hparams, model, batches = small_model(softmax_samples=8)
+    model.train()
+    loss = build_trainer(hparams, model).compute_loss(batches[0])
+    loss.backward()
+
+    assert torch.isfinite(loss)
+    assert model.final_linear.weight is model.embedding_word.weight
+    assert model.embedding_word.weight.grad is not None
+    # The sampling distribution is rebuilt from the word counts, not saved in checkpoints
+    assert model.sampling_probs.sum().item() == pytest.approx(1.0)
+    assert 'sampling_probs' not in model.state_dict()
+
+
+def test_sampled_logits(small_model):
+    hparams, model, _ = small_model(softmax_samples=8)
+    decoder_outputs = torch.randn(1, 5, hparams.hidden_size)
+    labels = torch.randint(6, model.vocab_size, (1, 5))
+    logits = model.sampled_logits(decoder_outputs, labels)
+
+    assert logits.shape == (5, 1 + hparams.softmax_samples)
+    label_ids = labels[0]
+    expected = (decoder_outputs[0] * model.final_linear.weight[label_ids]).sum(-1) + model.final_linear.bias[label_ids]
+    expected -= torch.log(hparams.softmax_samples * model.sampling_probs[label_ids])
+    assert torch.allclose(logits[:, 0], expected, atol=1e-5)
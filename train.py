@@ -1,20 +1,65 @@
 import os
-from utils.utils import compare_models
+import math
+import time
+import collections
+from contextlib import nullcontext
+from datetime import timedelta
+from utils.utils import compare_models, autocast
 import logging
 from datetime import datetime
 from tqdm import tqdm
 import torch
-from torch import nn, optim
+import torch.distributed as dist
+from torch import nn
+from torch.nn.parallel import DistributedDataParallel
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 from torch.utils.tensorboard import SummaryWriter
 from data.dataset import AMIDataset
+from data.prefetcher import PrefetchLoader, TimedDataset, auto_num_workers, collate_meetings
 from models.model import SummarizationModel
-from utils.checkpointing import CheckpointManager, load_checkpoint, dump_vocab
+from utils.checkpointing import CheckpointManager, load_checkpoint, load_vocab, dump_vocab, restore_model_hparams
 from predictor import Predictor
+from utils.profiler import ModuleProfiler
+from utils.optim import build_optimizer, clip_grad_norm, optimizer_step_bytes
+from utils.telemetry import TrainingTelemetry
+from utils.eval_worker import EvaluationWorker
+from utils.distillation import student_hparams, project_embedding, distillation_loss
+from utils.results_store import ResultsStore, state_dict_hash, decode_config, decode_config_key
+
+
+def setup_distributed(rank, hparams):
+    """Joins the gloo process group of a multi-process training run (one process per rank, see main.py)."""
+    if hparams.device == 'cuda':
+        raise ValueError('Distributed training (world_size > 1) runs on CPU, set device=cpu')
+
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', str(hparams.dist_port))
+    dist.init_process_group(hparams.dist_backend, rank=rank, world_size=hparams.world_size,
+                            timeout=timedelta(minutes=hparams.dist_timeout_minutes))
+    # Split the cores between the ranks instead of oversubscribing them
+    torch.set_num_threads(max(1, os.cpu_count() // hparams.world_size))
+
+
+def train_worker(rank, hparams_dict):
+    """Entry point of a training process started by torch.multiprocessing.spawn."""
+    hparams = collections.namedtuple("HParams", sorted(hparams_dict.keys()))(**hparams_dict)
+    setup_distributed(rank, hparams)
+    try:
+        build_trainer(hparams, rank=rank).train()
+    finally:
+        dist.destroy_process_group()
+
+
+def build_trainer(hparams, rank=0):
+    """Trainer of a training run: Summarization, or Distillation of hparams.distill_teacher_path."""
+    if hparams.distill_teacher_path:
+        return Distillation(hparams, rank=rank)
+    return Summarization(hparams, mode='train', rank=rank)
 
 
 class Summarization(object):
-    def __init__(self, hparams, mode='train'):
+    def __init__(self, hparams, mode='train', rank=0):
         self.hparams = hparams
         self._logger = logging.getLogger(__name__)
         print('self.hparams:', self.hparams)
@@ -25,42 +70,83 @@ class Summarization(object):
         else:
             self.device = torch.device('cpu')
 
+        # With world_size > 1 every rank trains on its shard of the training set, rank 0 also
+        # writes the logs and checkpoints and runs the evaluation
+        self.rank = rank
+        self.world_size = hparams.world_size if mode == 'train' else 1
+        self.distributed = self.world_size > 1
+        self.is_main_process = self.rank == 0
+
+        self.mode = mode
         self.build_dataloader()
 
         self.save_dirpath = self.hparams.save_dirpath
         today = str(datetime.today().month) + 'M_' + str(datetime.today().day) + 'D' + '_GEN_MAX_' + str(
             self.hparams.gen_max_length)
         tensorboard_path = self.save_dirpath + today
-        self.summary_writer = SummaryWriter(tensorboard_path, comment="Unmt")
+        self.summary_writer = SummaryWriter(tensorboard_path, comment="Unmt") if self.is_main_process else None
 
         if mode == 'train':
             self.build_model()
             self.setup_training()
-            self.predictor = self.build_eval_model(model=self.model, summary_writer=self.summary_writer)
-            dump_vocab(self.hparams.save_dirpath + 'vocab_word', self.vocab_word)
+            self.predictor = self.build_eval_model(model=self.unwrapped_model, summary_writer=self.summary_writer)
+            if self.is_main_process:
+                dump_vocab(self.hparams.save_dirpath + 'vocab_word', self.vocab_word)
 
         elif mode == 'eval':
             self.predictor = self.build_eval_model(summary_writer=self.summary_writer)
 
+        self.profiler = None
+        if self.hparams.profile:
+            self.profiler = ModuleProfiler(self.predictor.model).start()
+            self.predictor.profiler = self.profiler
+
     def build_dataloader(self):
-        self.train_dataset = AMIDataset(self.hparams, type='train')
-        self.train_dataloader = DataLoader(
-            self.train_dataset,
+        # workers=-1 picks the number of workers from the cores and the prefetch depth
+        num_workers = self.hparams.workers
+        if num_workers < 0:
+            num_workers = auto_num_workers(self.hparams.prefetch_depth, self.world_size)
+
+        # Items are built in shared memory by the workers and only hold the tensors used for training
+        self.train_dataset = AMIDataset(self.hparams, type='train', return_text=False,
+                                        shared_memory=num_workers > 0)
+        self.train_sampler = None
+        if self.distributed:
+            self.train_sampler = DistributedSampler(self.train_dataset, num_replicas=self.world_size,
+                                                    rank=self.rank, shuffle=True)
+        self.train_dataloader = PrefetchLoader(DataLoader(
+            TimedDataset(self.train_dataset),
             batch_size=self.hparams.batch_size,
-            num_workers=self.hparams.workers,
-            shuffle=True,
+            num_workers=num_workers,
+            shuffle=self.train_sampler is None,
+            sampler=self.train_sampler,
+            collate_fn=collate_meetings,
+            pin_memory=self.device.type == 'cuda',
             drop_last=True
-        )
+        ), depth=self.hparams.prefetch_depth)
         self.vocab_word = self.train_dataset.vocab_word
         self.vocab_role = self.train_dataset.vocab_role
         self.vocab_pos = self.train_dataset.vocab_pos
+        vocab_path = self.vocab_path()
+        if vocab_path is not None and os.path.exists(vocab_path):
+            self.vocab_word = self.train_dataset.vocab_word = load_vocab(vocab_path)
+
+        # Teacher-forced validation loss after every epoch
+        self.dev_dataset = AMIDataset(self.hparams, type='dev', return_text=False,
+                                      vocab_word=self.vocab_word, vocab_role=self.vocab_role, vocab_pos=self.vocab_pos)
+        self.dev_dataloader = DataLoader(
+            self.dev_dataset,
+            batch_size=self.hparams.batch_size,
+            num_workers=num_workers,
+            drop_last=False
+        )
 
         self.test_dataset = AMIDataset(self.hparams, type='test',
                                        vocab_word=self.vocab_word, vocab_role=self.vocab_role, vocab_pos=self.vocab_pos)
         self.test_dataloader = DataLoader(
             self.test_dataset,
             batch_size=self.hparams.batch_size,
-            num_workers=self.hparams.workers,
+            num_workers=num_workers,
             drop_last=False
         )
 
@@ -70,30 +156,51 @@ class Summarization(object):
            # -------------------------------------------------------------------------
            """)
 
+    def vocab_path(self):
+        """Word vocabulary file to use instead of the one built from the corpora, None to build it.
+        Checkpoints are evaluated with the vocabulary saved next to them, which differs from the rebuilt one
+        for checkpoints pruned by main.py --mode prune."""
+        if self.mode == 'eval':
+            return os.path.join(self.hparams.save_dirpath, 'vocab_word')
+        return None
+
+    def create_model(self):
+        return SummarizationModel(hparams=self.hparams, vocab_word=self.vocab_word,
+                                  vocab_role=self.vocab_role, vocab_pos=self.vocab_pos,
+                                  word_counts=self.train_dataset.word_counts())
+
     def build_model(self):
         # Define model
-        self.model = SummarizationModel(hparams=self.hparams, vocab_word=self.vocab_word,
-                                        vocab_role=self.vocab_role, vocab_pos=self.vocab_pos)
+        self.model = self.create_model()
 
         # Multi-GPU
         self.model = self.model.to(self.device)
+        self.unwrapped_model = self.model
 
+        if self.distributed:
+            # Broadcasts the parameters of rank 0 and all-reduces (averages) the gradients in backward
+            self.model = DistributedDataParallel(self.model)
         # Use Multi-GPUs
-        if -1 not in self.hparams.gpu_ids and len(self.hparams.gpu_ids) > 1:
+        elif -1 not in self.hparams.gpu_ids and len(self.hparams.gpu_ids) > 1:
             self.model = nn.DataParallel(self.model, self.hparams.gpu_ids)
 
         # Define Loss and Optimizer
         self.criterion = nn.CrossEntropyLoss()
-        self.optimizer = optim.Adam(self.model.parameters(), lr=self.hparams.learning_rate, betas=(self.hparams.optimizer_adam_beta1,
-                                                                                               self.hparams.optimizer_adam_beta2))
+        self.optimizer = build_optimizer(self.model, self.hparams)
 
     def setup_training(self):
         self.save_dirpath = self.hparams.save_dirpath
         today = str(datetime.today().month) + 'M_' + str(datetime.today().day) + 'D'
         tensorboard_path = self.save_dirpath + today
-        self.summary_writer = SummaryWriter(tensorboard_path, comment="Unmt")
-        self.checkpoint_manager = CheckpointManager(self.model, self.optimizer,
-                                                    self.save_dirpath, hparams=self.hparams)
+        self.checkpoint_manager = None
+        if self.is_main_process:
+            self.summary_writer = SummaryWriter(tensorboard_path, comment="Unmt")
+            self.checkpoint_manager = CheckpointManager(self.model, self.optimizer, self.save_dirpath,
+                                                        keep_last=self.hparams.checkpoint_keep_last,
+                                                        keep_best=self.hparams.checkpoint_keep_best,
+                                                        keep_every=self.hparams.checkpoint_keep_every,
+                                                        mode=self.hparams.checkpoint_metric_mode,
+                                                        hparams=self.hparams)
 
         # If loading from checkpoint, adjust start epoch and load parameters.
         if self.hparams.load_pthpath == "":
@@ -103,10 +210,7 @@ class Summarization(object):
             self.start_epoch = int(self.hparams.load_pthpath.split("_")[-1][:-4])
             self.start_epoch += 1
             model_state_dict, optimizer_state_dict = load_checkpoint(self.hparams.load_pthpath)
-            if isinstance(self.model, nn.DataParallel):
-                self.model.module.load_state_dict(model_state_dict, strict=True)
-            else:
-                self.model.load_state_dict(model_state_dict)
+            self.unwrapped_model.load_state_dict(model_state_dict, strict=True)
 
             self.optimizer.load_state_dict(optimizer_state_dict, strict=True)
             self.previous_model_path = self.hparams.load_pthpath
@@ -128,55 +232,294 @@ class Summarization(object):
 
         return predictor
 
+    def validate(self, epoch):
+        """Teacher-forced loss and perplexity of the dev set, one forward pass per meeting."""
+        model = self.unwrapped_model
+        model.eval()
+        criterion = nn.CrossEntropyLoss(reduction='sum')
+        total_loss, total_tokens = 0., 0
+        with torch.no_grad():
+            for data in self.dev_dataloader:
+                labels_ids = data['labels_ids'].to(self.device)
+                with autocast(self.hparams):
+                    logits = model(inputs=data['dialogues_ids'].to(self.device), targets=labels_ids[:, :-1],
+                                   src_masks=data['src_masks'].to(self.device),
+                                   role_ids=data['role_ids'].to(self.device), pos_ids=data['pos_ids'].to(self.device),
+                                   dialogues_lens=data['dialogues_lens'].to(self.device))
+                labels_ids = labels_ids[:, 1:].reshape(-1)
+                total_loss += criterion(logits.float(), labels_ids).item()
+                total_tokens += labels_ids.numel()
+        model.train()
+
+        dev_loss = total_loss / max(1, total_tokens)
+        metrics = {'dev_loss': dev_loss, 'dev_perplexity': math.exp(min(dev_loss, 50.))}
+        self.summary_writer.add_scalar('dev/loss', metrics['dev_loss'], epoch)
+        self.summary_writer.add_scalar('dev/perplexity', metrics['dev_perplexity'], epoch)
+        print('[Epoch {} dev]: {}'.format(epoch, metrics))
+        return metrics
+
+    def record_metrics(self, epoch, metrics):
+        if self.hparams.checkpoint_metric in metrics:
+            self.checkpoint_manager.record_metric(epoch, metrics[self.hparams.checkpoint_metric])
+
+    def submit_evaluation(self, epoch, checkpoint_path):
+        # Called on the checkpoint writer thread once the checkpoint is on disk
+        if epoch in self.eval_epochs:
+            self.eval_worker.submit(epoch, checkpoint_path)
+
+    def record_evaluations(self, finished):
+        for epoch, results_dict in finished:
+            if results_dict is not None:
+                print('[Epoch {} ROUGE]: {}'.format(epoch, results_dict))
+                self.record_metrics(epoch, results_dict)
+            self.checkpoint_manager.unpin(epoch)
+
+    def sync_stop(self, stop):
+        """Early-stopping decision of rank 0, shared with all ranks."""
+        if not self.distributed:
+            return stop
+        stop = torch.tensor([int(stop)])
+        dist.broadcast(stop, src=0)
+        return bool(stop.item())
+
+    def compute_loss(self, data):
+        """Training loss of a batch."""
+        dialogues_ids = data['dialogues_ids'].to(self.device)
+        pos_ids = data['pos_ids'].to(self.device)
+        labels_ids = data['labels_ids'].to(self.device) # [batch==1, tgt_seq_len]
+        src_masks = data['src_masks'].to(self.device)
+        role_ids = data['role_ids'].to(self.device)
+        dialogues_lens = data['dialogues_lens'].to(self.device)
+
+        # Sampled softmax: logits of the next token (class 0) and of the sampled negatives
+        sampled_labels = labels_ids[:, 1:] if self.hparams.softmax_samples > 0 else None
+        with autocast(self.hparams):
+            logits = self.model(inputs=dialogues_ids, targets=labels_ids[:, :-1],  # before <END> token
+                                src_masks=src_masks, role_ids=role_ids, pos_ids=pos_ids,
+                                dialogues_lens=dialogues_lens,
+                                sampled_labels=sampled_labels) # [batch x tgt_seq_len, vocab_size]
+
+        labels_ids = labels_ids[:, 1:]
+        labels_ids = labels_ids.view(labels_ids.shape[0] * labels_ids.shape[1]) # [batch x tgt_seq_len]
+        if sampled_labels is not None:
+            labels_ids = torch.zeros_like(labels_ids)
+
+        # Loss is computed in fp32 even when the forward pass runs under autocast
+        return self.criterion(logits.float(), labels_ids)
+
     def train(self):
         train_begin = datetime.utcnow()  # News
         global_iteration_step = 0
+        accumulation_steps = self.hparams.gradient_accumulation_steps
+        telemetry = TrainingTelemetry(self.summary_writer, self.device, log_every=self.hparams.log_every_steps,
+                                      world_size=self.world_size, loader_stats=self.train_dataloader.pop_stats)
+        # Time spent in the training loop and meetings trained on by all ranks, without checkpointing and evaluation
+        train_time, train_meetings = 0., 0
+
+        # Early stopping on the dev loss. ROUGE is only decoded for checkpoints that improve it.
+        best_dev_loss, epochs_without_improvement = float('inf'), 0
+        self.eval_epochs = set()
+
+        # Checkpoints are evaluated in a separate process as soon as they are written
+        self.eval_worker = None
+        if self.is_main_process and self.hparams.async_eval:
+            self.eval_worker = EvaluationWorker(self.hparams, self.vocab_word, self.vocab_role, self.vocab_pos,
+                                                self.summary_writer.log_dir).start()
+            self.checkpoint_manager.add_save_callback(self.submit_evaluation)
         for epoch in range(self.hparams.num_epochs):
             self.model.train()
-            tqdm_batch_iterator = tqdm(self.train_dataloader)
+            if self.train_sampler is not None:
+                self.train_sampler.set_epoch(epoch)
+            # Checkpointing and evaluation of the previous epoch are not part of the first interval
+            telemetry.reset()
+            epoch_begin = time.time()
+            tqdm_batch_iterator = tqdm(telemetry.iterate(self.train_dataloader), total=len(self.train_dataloader),
+                                       disable=not self.is_main_process)
             for batch_idx, batch in enumerate(tqdm_batch_iterator):
                 data = batch
-                dialogues_ids = data['dialogues_ids'].to(self.device)
-                pos_ids = data['pos_ids'].to(self.device)
-                labels_ids = data['labels_ids'].to(self.device) # [batch==1, tgt_seq_len]
-                src_masks = data['src_masks'].to(self.device)
-                role_ids = data['role_ids'].to(self.device)
+                telemetry.add_batch(data)
 
-                logits = self.model(inputs=dialogues_ids, targets=labels_ids[:, :-1],  # before <END> token
-                                    src_masks=src_masks, role_ids=role_ids, pos_ids=pos_ids) # [batch x tgt_seq_len, vocab_size]
+                # Accumulate gradients of several meetings before updating. The last group of the epoch may be
+                # shorter, its loss is averaged over the meetings it actually has.
+                num_batches = len(self.train_dataloader)
+                group_size = min(accumulation_steps, num_batches - batch_idx // accumulation_steps * accumulation_steps)
+                update_step = (batch_idx + 1) % accumulation_steps == 0 or batch_idx + 1 == num_batches
+                # Gradients are only all-reduced in the backward pass of the update step
+                sync_context = self.model.no_sync() if self.distributed and not update_step else nullcontext()
 
-                labels_ids = labels_ids[:, 1:]
-                labels_ids = labels_ids.view(labels_ids.shape[0] * labels_ids.shape[1]) # [batch x tgt_seq_len]
+                with sync_context:
+                    loss = self.compute_loss(data)
+                    (loss / group_size).backward()
+                telemetry.add_loss(loss)
 
-                loss = self.criterion(logits, labels_ids)
-                loss.backward()
+                if not update_step:
+                    continue
 
                 # gradient cliping
-                nn.utils.clip_grad_norm_(self.model.parameters(), self.hparams.max_gradient_norm)
+                grad_norm = clip_grad_norm(self.model.parameters(), self.hparams.max_gradient_norm)
+                optimizer_bytes = optimizer_step_bytes(self.optimizer)
+                optimizer_begin = time.time()
                 self.optimizer.step()
+                optimizer_time = time.time() - optimizer_begin
                 self.optimizer.zero_grad()
 
                 global_iteration_step += 1
-                description = "[{}][Epoch: {:3d}][Iter: {:6d}][Loss: {:6f}][lr: {:7f}]".format(
-                    datetime.utcnow() - train_begin,
-                    epoch,
-                    global_iteration_step, loss,
-                    self.optimizer.param_groups[0]['lr'])
-                tqdm_batch_iterator.set_description(description)
+                # Metrics stay on the device until the end of the logging interval
+                metrics = telemetry.optimizer_step(global_iteration_step, grad_norm,
+                                                   self.optimizer.param_groups[0]['lr'],
+                                                   optimizer_time=optimizer_time, optimizer_bytes=optimizer_bytes)
+                if metrics is not None:
+                    description = "[{}][Epoch: {:3d}][Iter: {:6d}][Loss: {:6f}][lr: {:7f}][tok/s: {:.0f}][wait: {:.0%}]".format(
+                        datetime.utcnow() - train_begin,
+                        epoch,
+                        global_iteration_step, metrics['loss'], metrics['lr'],
+                        metrics['source_tokens_per_sec'], metrics['data_wait_fraction'])
+                    tqdm_batch_iterator.set_description(description)
+
+            telemetry.flush(global_iteration_step)
+            train_time += time.time() - epoch_begin
+            train_meetings += len(self.train_dataloader) * self.hparams.batch_size * self.world_size
 
             # # -------------------------------------------------------------------------
             # #   ON EPOCH END  (checkpointing and validation)
             # # -------------------------------------------------------------------------
+            if not self.is_main_process:
+                # Wait for rank 0 to checkpoint and evaluate
+                if self.sync_stop(False):
+                    break
+                continue
+
+            dev_metrics = self.validate(epoch)
+            if dev_metrics['dev_loss'] < best_dev_loss - self.hparams.early_stopping_min_delta:
+                best_dev_loss, epochs_without_improvement = dev_metrics['dev_loss'], 0
+                if epoch >= self.hparams.start_eval_epoch:
+                    self.eval_epochs.add(epoch)
+            else:
+                epochs_without_improvement += 1
+
+            if self.eval_worker is not None:
+                self.record_evaluations(self.eval_worker.poll())
+                if epoch in self.eval_epochs:
+                    # Kept until its evaluation is recorded
+                    self.checkpoint_manager.pin(epoch)
+
             self.checkpoint_manager.step(epoch)
+            self.record_metrics(epoch, dev_metrics)
+            if self.profiler is not None:
+                print(self.profiler.export(os.path.join(self.save_dirpath, 'profile')))
             self.previous_model_path = os.path.join(self.checkpoint_manager.ckpt_dirpath, "checkpoint_%d.pth" % (epoch))
             self._logger.info(self.previous_model_path)
 
             # torch.cuda.empty_cache()
 
-            if epoch % 10 == 0 and epoch >= self.hparams.start_eval_epoch:
+            if self.eval_worker is None and epoch in self.eval_epochs:
                 print('======= Evaluation Start Epoch: ', epoch, ' ==================')
+                # No dropout while decoding, train() is restored at the start of the next epoch
+                self.model.eval()
 
-                self.predictor.evaluate(test_dataloader=self.test_dataloader, epoch=epoch,
-                                        eval_path=self.previous_model_path)
+                results_dict = self.predictor.evaluate(test_dataloader=self.test_dataloader, epoch=epoch,
+                                                       eval_path=self.previous_model_path)
+                self.record_metrics(epoch, results_dict)
 
                 print('============================================================\n\n')
+
+            patience = self.hparams.early_stopping_patience
+            stop = patience > 0 and epochs_without_improvement >= patience
+            if self.sync_stop(stop):
+                print('Early stopping at epoch {}: no dev loss improvement for {} epochs (best {:.4f})'.format(
+                    epoch, epochs_without_improvement, best_dev_loss))
+                break
+
+        if self.is_main_process:
+            # Wait for the last checkpoint writes and their evaluations
+            self.checkpoint_manager.wait()
+            if self.eval_worker is not None:
+                self.record_evaluations(self.eval_worker.close())
+            self.checkpoint_manager.close()
+
+        return {'train_time': train_time, 'meetings': train_meetings,
+                'meetings_per_sec': train_meetings / max(train_time, 1e-9)}
+
+
+class Distillation(Summarization):
+    """
+    Trains a smaller student (student_* hparams, see utils/distillation.py) on the outputs of the teacher
+    checkpoint hparams.distill_teacher_path: the cross-entropy of the targets mixed with the KL divergence to
+    the teacher distribution of every summary position. With distill_sequence_level the targets are the
+    teacher's beam search summaries of the training meetings instead of the references (sequence-level
+    distillation), decoded the first time a meeting is seen and stored in <save_dirpath>/teacher_summaries.jsonl.
+    The student uses the vocabulary of the teacher and is checkpointed and evaluated like a trained model.
+    """
+
+    def __init__(self, hparams, rank=0):
+        teacher_dirpath = os.path.dirname(hparams.distill_teacher_path)
+        self.teacher_hparams = restore_model_hparams(hparams._replace(load_pthpath=hparams.distill_teacher_path),
+                                                     teacher_dirpath)
+        if hparams.distill_sequence_level and hparams.batch_size != 1:
+            raise ValueError('Sequence-level distillation decodes one meeting at a time, set batch_size=1')
+        super(Distillation, self).__init__(student_hparams(hparams), mode='train', rank=rank)
+
+    def vocab_path(self):
+        return os.path.join(os.path.dirname(self.hparams.distill_teacher_path), 'vocab_word')
+
+    def build_dataloader(self):
+        super(Distillation, self).build_dataloader()
+        self.teacher = Predictor(self.teacher_hparams, vocab_word=self.vocab_word, vocab_role=self.vocab_role,
+                                 vocab_pos=self.vocab_pos, checkpoint=self.teacher_hparams.load_pthpath)
+        self.teacher_model = self.teacher.model.module if isinstance(self.teacher.model, nn.DataParallel) \
+            else self.teacher.model
+        self.teacher_model.eval()
+        for parameter in self.teacher_model.parameters():
+            parameter.requires_grad = False
+
+        self.teacher_summaries = None
+        if self.hparams.distill_sequence_level:
+            name = 'teacher_summaries.jsonl' if not self.distributed else 'teacher_summaries_%d.jsonl' % self.rank
+            self.teacher_summaries = ResultsStore(os.path.join(self.hparams.save_dirpath, name))
+            self.teacher_checkpoint = state_dict_hash(self.teacher_model)
+            self.teacher_decode_config = decode_config(self.teacher_hparams)
+            self.teacher_decode_key = decode_config_key(self.teacher_decode_config)
+
+    def create_model(self):
+        # The GloVe vectors have the teacher size, the student starts from the projected teacher embedding
+        embedding_weight = project_embedding(self.teacher_model.embedding_word.weight.cpu(),
+                                             self.hparams.embedding_size_word)
+        return SummarizationModel(hparams=self.hparams, vocab_word=self.vocab_word,
+                                  vocab_role=self.vocab_role, vocab_pos=self.vocab_pos,
+                                  word_counts=self.train_dataset.word_counts(), embedding_weight=embedding_weight)
+
+    def teacher_targets(self, data, inputs):
+        """[1, tgt_seq_len] ids of the teacher's beam search summary of the meeting (with <BEGIN> and <END>)."""
+        meeting_id = data['meeting_id'][0]
+        entry = self.teacher_summaries.get(self.teacher_checkpoint, meeting_id, self.teacher_decode_key)
+        if entry is None:
+            with torch.no_grad():
+                summary = self.teacher.inference(**inputs)
+            entry = self.teacher_summaries.add(self.teacher_checkpoint, meeting_id, self.teacher_decode_config,
+                                               summary, '')
+        labels_ids = self.train_dataset.tokens2ids(entry['summary'].split(), self.vocab_word, is_reference=True)
+        return torch.tensor([labels_ids], dtype=torch.long, device=self.device)
+
+    def compute_loss(self, data):
+        inputs = dict(inputs=data['dialogues_ids'].to(self.device), src_masks=data['src_masks'].to(self.device),
+                      role_ids=data['role_ids'].to(self.device), pos_ids=data['pos_ids'].to(self.device),
+                      dialogues_lens=data['dialogues_lens'].to(self.device))
+        if self.teacher_summaries is not None:
+            labels_ids = self.teacher_targets(data, inputs)
+        else:
+            labels_ids = data['labels_ids'].to(self.device) # [batch==1, tgt_seq_len]
+
+        with torch.no_grad(), autocast(self.teacher_hparams):
+            teacher_logits = self.teacher_model(targets=labels_ids[:, :-1], **inputs)
+        with autocast(self.hparams):
+            logits = self.model(targets=labels_ids[:, :-1], **inputs) # [batch x tgt_seq_len, vocab_size]
+
+        labels_ids = labels_ids[:, 1:].reshape(-1) # [batch x tgt_seq_len]
+        return distillation_loss(logits, teacher_logits, labels_ids, temperature=self.hparams.distill_temperature,
+                                 alpha=self.hparams.distill_alpha)
+
+    def train(self):
+        stats = super(Distillation, self).train()
+        if self.teacher_summaries is not None:
+            self.teacher_summaries.close()
+        return stats
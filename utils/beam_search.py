@@ -0,0 +1,215 @@
+"""
+Beam search bookkeeping on preallocated tensors.
+
+``BeamSearch`` keeps the alive beams, the chosen tokens and backpointers of
+every step and the best finished hypothesis of every meeting in tensors
+allocated once per search. ``advance`` only writes into them (``out=`` and
+in-place ops on views), so the decode loop allocates nothing for the beam
+bookkeeping, and the summaries are reconstructed by following the
+backpointers once the search is finished.
+
+It follows the search of the original ``Predictor.inference``: the
+``<END>`` token is masked before ``min_length``, scores are divided by the
+GNMT length penalty ``((5 + length) / 6) ** alpha``, beams whose last
+trigram already occurs in them are blocked, beams that emit ``<END>``
+become hypotheses and stay alive, and a meeting is finished (all of its
+beams becoming hypotheses) once its best beam emits ``<END>``.
+"""
+import torch
+
+
+class BeamSearch(object):
+    """Fixed-size beam search state for ``batch_size`` meetings.
+
+    Parameters
+    ----------
+    batch_size: int
+        Number of meetings decoded together.
+    beam_size: int
+        Beams per meeting, the decoder runs on ``batch_size * beam_size`` rows.
+    max_length: int
+        Maximum number of generated tokens, every beam is finished at the last step.
+    start_token_id, end_token_id: int
+        ``<BEGIN>`` and ``<END>`` ids of the word vocabulary.
+    min_length: int, optional (default=0)
+        ``<END>`` cannot be generated before this step.
+    alpha: float, optional (default=0.6)
+        Length penalty exponent.
+    block_trigram: bool, optional (default=True)
+        Block beams that repeat a trigram.
+    device: str, optional (default='cpu')
+
+    Example
+    --------
+    >>> beam = BeamSearch(1, 12, 400, start_token_id, end_token_id, min_length=280)
+    >>> for step in range(400):
+    ...     log_probs = decode(beam.last_tokens)  # [batch_size * beam_size, vocab_size]
+    ...     select_indices = beam.advance(step, log_probs)
+    ...     if beam.is_done():
+    ...         break
+    ...     decoder_state.reorder(select_indices)
+    >>> predictions, scores = beam.finalize()
+    """
+
+    def __init__(self, batch_size, beam_size, max_length, start_token_id, end_token_id,
+                 min_length=0, alpha=0.6, block_trigram=True, device='cpu'):
+        self.batch_size = batch_size
+        self.beam_size = beam_size
+        self.max_length = max_length
+        self.end_token_id = end_token_id
+        self.min_length = min_length
+        self.block_trigram = block_trigram
+        num_beams = batch_size * beam_size
+
+        def long(*size):
+            return torch.zeros(*size, dtype=torch.long, device=device)
+
+        def bool_(*size):
+            return torch.zeros(*size, dtype=torch.bool, device=device)
+
+        def float_(*size):
+            return torch.zeros(*size, dtype=torch.float, device=device)
+
+        # Length penalty of every step
+        self.length_penalty = ((5.0 + torch.arange(1, max_length + 1, dtype=torch.float, device=device)) / 6.0) ** alpha
+        # Row of the first beam of every meeting
+        self.beam_offset = torch.arange(0, num_beams, step=beam_size, dtype=torch.long, device=device).unsqueeze(1)
+
+        # Token chosen at every step by each beam, and the beam (row of the previous step) it extends
+        self.tokens = long(max_length, num_beams)
+        self.backpointers = long(max_length, num_beams)
+        self.start_tokens = long(num_beams, 1).fill_(start_token_id)
+        # Give full probability to the first beam on the first step.
+        self.topk_log_probs = float_(batch_size, beam_size).fill_(float('-inf'))
+        self.topk_log_probs[:, 0] = 0.
+
+        # Best finished hypothesis of every meeting: length-penalized score, last step and row
+        self.best_scores = float_(batch_size).fill_(float('-inf'))
+        self.best_steps = long(batch_size)
+        self.best_rows = long(batch_size)
+        self.done = bool_(batch_size)
+
+        # Step outputs
+        self.topk_scores = float_(batch_size, beam_size)
+        self.topk_ids = long(batch_size, beam_size)
+        self.topk_beams = long(batch_size, beam_size)
+        self.select_indices = long(batch_size, beam_size)
+        self.is_finished = bool_(batch_size, beam_size)
+
+        # Workspace
+        self._end_condition = bool_(batch_size)
+        self._not_finished = bool_(batch_size, beam_size)
+        self._candidate_scores = float_(batch_size, beam_size)
+        self._candidate_max = float_(batch_size)
+        self._candidate_beams = long(batch_size)
+        self._candidate_rows = long(batch_size)
+        self._improved = bool_(batch_size)
+        self._long_workspace = long(batch_size)
+        self._all_done = bool_(1)
+        if block_trigram:
+            # Alive sequences (with <BEGIN>), reordered into the second buffer at every step
+            self.alive_seq = long(num_beams, max_length + 1).fill_(start_token_id)
+            self._alive_seq_next = long(num_beams, max_length + 1)
+            self._trigram_match = bool_(num_beams, max_length)
+            self._trigram_workspace = bool_(num_beams, max_length)
+            self._blocked = bool_(num_beams)
+        self._step = 0
+
+    @property
+    def last_tokens(self):
+        """Input tokens of the current step, [batch_size * beam_size, 1]."""
+        if self._step == 0:
+            return self.start_tokens
+        return self.tokens[self._step - 1].unsqueeze(1)
+
+    def buffers(self):
+        """Tensors of the search state, for memory accounting."""
+        return [value for value in vars(self).values() if torch.is_tensor(value)]
+
+    def _block_repeated_trigrams(self, scores, length):
+        # A beam is blocked if the trigram ending at its last token occurs earlier in it
+        alive_seq, match, workspace = self.alive_seq, self._trigram_match[:, :length - 3], \
+            self._trigram_workspace[:, :length - 3]
+        torch.eq(alive_seq[:, :length - 3], alive_seq[:, length - 3:length - 2], out=match)
+        torch.eq(alive_seq[:, 1:length - 2], alive_seq[:, length - 2:length - 1], out=workspace)
+        match.logical_and_(workspace)
+        torch.eq(alive_seq[:, 2:length - 1], alive_seq[:, length - 1:length], out=workspace)
+        match.logical_and_(workspace)
+        torch.any(match, dim=1, out=self._blocked)
+        scores.masked_fill_(self._blocked.unsqueeze(1), -1e20)
+
+    def advance(self, step, log_probs):
+        """Extends the beams with the log-probabilities of the next token
+        (``[batch_size * beam_size, vocab_size]``, modified in place), returns
+        the rows of the previous step the new beams extend, by which the
+        decoder state has to be reordered."""
+        vocab_size = log_probs.size(-1)
+        if step < self.min_length:
+            log_probs[:, self.end_token_id].fill_(-1e20)
+
+        # Multiply probs by the beam probability, the scores are length-penalized
+        log_probs += self.topk_log_probs.view(-1, 1)
+        length_penalty = self.length_penalty[step]
+        scores = log_probs.div_(length_penalty)
+        if self.block_trigram and step + 1 > 3:
+            self._block_repeated_trigrams(scores, step + 1)
+
+        torch.topk(scores.view(self.batch_size, self.beam_size * vocab_size), self.beam_size, dim=-1,
+                   out=(self.topk_scores, self.topk_ids))
+        torch.mul(self.topk_scores, length_penalty, out=self.topk_log_probs)
+
+        # Resolve beam origin and true word ids.
+        torch.div(self.topk_ids, vocab_size, rounding_mode='floor', out=self.topk_beams)
+        torch.remainder(self.topk_ids, vocab_size, out=self.topk_ids)
+        torch.add(self.topk_beams, self.beam_offset, out=self.select_indices)
+        select_indices = self.select_indices.view(-1)
+        self.tokens[step].copy_(self.topk_ids.view(-1))
+        self.backpointers[step].copy_(select_indices)
+
+        if self.block_trigram:
+            torch.index_select(self.alive_seq, 0, select_indices, out=self._alive_seq_next)
+            self._alive_seq_next[:, step + 1].copy_(self.tokens[step])
+            self.alive_seq, self._alive_seq_next = self._alive_seq_next, self.alive_seq
+
+        # Beams emitting <END> become hypotheses, all beams of a meeting do once its best beam does
+        torch.eq(self.topk_ids, self.end_token_id, out=self.is_finished)
+        if step + 1 == self.max_length:
+            self.is_finished.fill_(True)
+        self._end_condition.copy_(self.is_finished[:, 0])
+        self.is_finished.logical_or_(self._end_condition.unsqueeze(1))
+
+        # Keep the best hypothesis of the meetings not finished at an earlier step
+        torch.logical_not(self.is_finished, out=self._not_finished)
+        self._candidate_scores.copy_(self.topk_scores).masked_fill_(self._not_finished, float('-inf'))
+        self._candidate_scores.masked_fill_(self.done.unsqueeze(1), float('-inf'))
+        torch.max(self._candidate_scores, dim=1, out=(self._candidate_max, self._candidate_beams))
+        torch.gt(self._candidate_max, self.best_scores, out=self._improved)
+        torch.max(self.best_scores, self._candidate_max, out=self.best_scores)
+        self.best_steps.masked_fill_(self._improved, step)
+        torch.add(self._candidate_beams, self.beam_offset.view(-1), out=self._candidate_rows)
+        torch.where(self._improved, self._candidate_rows, self.best_rows, out=self._long_workspace)
+        self.best_rows.copy_(self._long_workspace)
+        self.done.logical_or_(self._end_condition)
+
+        self._step = step + 1
+        return select_indices
+
+    def is_done(self):
+        torch.all(self.done, dim=0, keepdim=True, out=self._all_done)
+        return bool(self._all_done)
+
+    def finalize(self):
+        """Backtracks the best hypothesis of every meeting, returns the lists of their
+        token ids (without ``<BEGIN>``, with ``<END>`` if it was generated) and scores."""
+        tokens, backpointers = self.tokens[:self._step].tolist(), self.backpointers[:self._step].tolist()
+        predictions, scores = [], []
+        for batch_index in range(self.batch_size):
+            step, row = int(self.best_steps[batch_index]), int(self.best_rows[batch_index])
+            prediction = []
+            while step >= 0:
+                prediction.append(tokens[step][row])
+                row = backpointers[step][row]
+                step -= 1
+            predictions.append(prediction[::-1])
+            scores.append(float(self.best_scores[batch_index]))
+        return predictions, scores
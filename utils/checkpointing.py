@@ -1,6 +1,9 @@
 """
 A checkpoint manager periodically saves model and optimizer as .pth
-files during training.
+files during training. State is snapshotted to CPU memory on the training
+thread and serialized on a background thread, old checkpoints are removed
+according to a retention policy and the surviving ones are listed in a
+``checkpoints.json`` manifest.
 
 Checkpoint managers help with experiment reproducibility, they record
 the commit SHA of your current codebase in the checkpoint saving
@@ -11,15 +14,27 @@ this directory.
 
 That said, always run your experiments after committing your changes,
 this doesn't account for untracked or staged, but uncommitted changes.
+
+For evaluation and serving, ``export_weights`` writes the model weights
+alone (no optimizer state) as a flat ``.weights`` file: a JSON header
+followed by aligned raw tensor data, which ``load_weights`` maps into
+memory without copying.
 """
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 from subprocess import PIPE, Popen
+import os
+import threading
 import warnings
 
+import numpy as np
 import torch
 from torch import nn, optim
 import json
 
+from data.vocab import Vocab
+
 
 class CheckpointManager(object):
     """A checkpoint manager saves state dicts of model and optimizer
@@ -27,8 +42,9 @@ class CheckpointManager(object):
     the API of PyTorch optimizers and learning rate schedulers.
 
     Note::
-        For ``DataParallel`` modules, ``model.module.state_dict()`` is
-        saved, instead of ``model.state_dict()``.
+        For ``DataParallel`` and ``DistributedDataParallel`` modules,
+        ``model.module.state_dict()`` is saved, instead of
+        ``model.state_dict()``.
 
     Parameters
     ----------
@@ -42,6 +58,23 @@ class CheckpointManager(object):
         Period of saving checkpoints.
     last_epoch: int, optional (default=-1)
         The index of last epoch.
+    keep_last: int, optional (default=0)
+        Keep the ``keep_last`` most recent checkpoints.
+    keep_best: int, optional (default=0)
+        Keep the ``keep_best`` checkpoints with the best metric reported
+        through ``record_metric``.
+    keep_every: int, optional (default=0)
+        Keep the checkpoints of every ``keep_every``-th epoch.
+    mode: str, optional (default="max")
+        Whether a higher ("max") or lower ("min") metric is better.
+    async_save: bool, optional (default=True)
+        Serialize checkpoints on a background thread.
+
+    Note::
+        A checkpoint is deleted once no retention rule keeps it, the most
+        recent checkpoint and pinned checkpoints (e.g. still queued for
+        evaluation, see ``pin``) are always kept. With all of ``keep_last``,
+        ``keep_best`` and ``keep_every`` set to 0 nothing is deleted.
 
     Example
     --------
@@ -52,6 +85,7 @@ class CheckpointManager(object):
     ...     for batch in dataloader:
     ...         do_iteration(batch)
     ...     ckpt_manager.step()
+    >>> ckpt_manager.close()
     """
 
     def __init__(
@@ -61,6 +95,11 @@ class CheckpointManager(object):
         checkpoint_dirpath,
         step_size=1,
         last_epoch=-1,
+        keep_last=0,
+        keep_best=0,
+        keep_every=0,
+        mode="max",
+        async_save=True,
         **kwargs,
     ):
 
@@ -77,7 +116,23 @@ class CheckpointManager(object):
         self.ckpt_dirpath = Path(checkpoint_dirpath)
         self.step_size = step_size
         self.last_epoch = last_epoch
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.keep_every = keep_every
+        self.mode = mode
+        self.manifest_path = self.ckpt_dirpath / "checkpoints.json"
+
+        # epoch -> metric (None until reported), of the checkpoints on disk
+        self.checkpoints = {}
+        self.pinned = set()
+        # Called with (epoch, path) on the writer thread once a checkpoint is on disk
+        self.save_callbacks = []
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1) if async_save else None
+        self._pending = []
+
         self.init_directory(**kwargs)
+        self._load_manifest()
 
     def init_directory(self, hparams):
         """Initialize empty checkpoint directory and record commit SHA
@@ -87,13 +142,12 @@ class CheckpointManager(object):
 
         self.ckpt_dirpath.mkdir(parents=True, exist_ok=True)
         # save current git commit hash in this checkpoint directory
-        commit_sha_subprocess = Popen(
-            ["git", "rev-parse", "--short", "HEAD"], stdout=PIPE, stderr=PIPE
-        )
-        commit_sha, _ = commit_sha_subprocess.communicate()
-        commit_sha = commit_sha.decode("utf-8").strip().replace("\n", "")
+        commit_sha = _commit_sha()
         commit_sha_filepath = self.ckpt_dirpath / f".commit-{commit_sha}"
         commit_sha_filepath.touch()
+        if hasattr(hparams, "_asdict"):
+            # HParams namedtuple, stored with the field names
+            hparams = hparams._asdict()
         with open(str(self.ckpt_dirpath / "hparams.json"), 'w') as hparams_handle:
             json.dump(hparams, hparams_handle)
 
@@ -105,22 +159,191 @@ class CheckpointManager(object):
         self.last_epoch = epoch
 
         if not self.last_epoch % self.step_size:
-            torch.save(
+            # Copy to CPU now, training may update the parameters before the write finishes
+            components = _cpu_snapshot(
                 {
                     "model": self._model_state_dict(),
                     "optimizer": self.optimizer.state_dict(),
-                },
-                self.ckpt_dirpath / f"checkpoint_{self.last_epoch}.pth",
+                }
             )
+            self._submit(self._save, components, self.last_epoch)
+
+    def record_metric(self, epoch, metric):
+        """Report the evaluation metric of the checkpoint of ``epoch``,
+        used by the ``keep_best`` retention rule."""
+        self._submit(self._set_metric, epoch, metric)
+
+    def pin(self, epoch):
+        """Protect the checkpoint of ``epoch`` from deletion until ``unpin``,
+        may be called before the checkpoint is saved."""
+        self._submit(self._set_pinned, epoch, True)
+
+    def unpin(self, epoch):
+        self._submit(self._set_pinned, epoch, False)
+
+    def add_save_callback(self, callback):
+        self.save_callbacks.append(callback)
+
+    def checkpoint_path(self, epoch):
+        return self.ckpt_dirpath / f"checkpoint_{epoch}.pth"
+
+    def wait(self):
+        """Block until all pending checkpoint writes are done, re-raising
+        the first error of a background write."""
+        pending, self._pending = self._pending, []
+        for future in pending:
+            future.result()
+
+    def close(self):
+        self.wait()
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    def _submit(self, fn, *args):
+        # Surface errors of earlier writes instead of silently losing checkpoints
+        for future in [f for f in self._pending if f.done()]:
+            self._pending.remove(future)
+            future.result()
+
+        if self._executor is None:
+            fn(*args)
+        else:
+            self._pending.append(self._executor.submit(fn, *args))
+
+    def _save(self, components, epoch):
+        path = self.checkpoint_path(epoch)
+        tmp_path = path.with_name(path.name + ".tmp")
+        torch.save(components, tmp_path)
+        # Atomic on POSIX, readers never see a partially written checkpoint
+        os.replace(str(tmp_path), str(path))
+
+        with self._lock:
+            self.checkpoints.setdefault(epoch, None)
+            self._apply_retention()
+
+        for callback in self.save_callbacks:
+            callback(epoch, path)
+
+    def _set_pinned(self, epoch, pinned):
+        with self._lock:
+            if pinned:
+                self.pinned.add(epoch)
+            else:
+                self.pinned.discard(epoch)
+                self._apply_retention()
+
+    def _set_metric(self, epoch, metric):
+        with self._lock:
+            if epoch in self.checkpoints:
+                self.checkpoints[epoch] = metric
+            self._apply_retention()
+
+    def _retained_epochs(self):
+        epochs = sorted(self.checkpoints)
+        if not self.keep_last and not self.keep_best and not self.keep_every:
+            return set(epochs)
+
+        keep = set(epochs[-max(1, self.keep_last):]) | (self.pinned & set(epochs))
+        if self.keep_every:
+            keep.update(e for e in epochs if e % self.keep_every == 0)
+        if self.keep_best:
+            scored = [e for e in epochs if self.checkpoints[e] is not None]
+            scored.sort(key=lambda e: self.checkpoints[e], reverse=(self.mode == "max"))
+            keep.update(scored[:self.keep_best])
+        return keep
+
+    def _apply_retention(self):
+        keep = self._retained_epochs()
+        for epoch in sorted(set(self.checkpoints) - keep):
+            path = self.checkpoint_path(epoch)
+            if path.exists():
+                path.unlink()
+            del self.checkpoints[epoch]
+        self._write_manifest()
+
+    def _write_manifest(self):
+        scored = [e for e in self.checkpoints if self.checkpoints[e] is not None]
+        best = None
+        if scored:
+            pick = max if self.mode == "max" else min
+            best = pick(scored, key=lambda e: self.checkpoints[e])
+
+        manifest = {
+            "best_epoch": best,
+            "checkpoints": [
+                {"epoch": e, "path": self.checkpoint_path(e).name, "metric": self.checkpoints[e]}
+                for e in sorted(self.checkpoints)
+            ],
+        }
+        tmp_path = self.manifest_path.with_name(self.manifest_path.name + ".tmp")
+        with open(str(tmp_path), "w") as manifest_handle:
+            json.dump(manifest, manifest_handle, indent=2)
+        os.replace(str(tmp_path), str(self.manifest_path))
+
+    def _load_manifest(self):
+        """Resume the retention policy of an earlier run in this directory."""
+        if not self.manifest_path.exists():
+            return
+        with open(str(self.manifest_path)) as manifest_handle:
+            manifest = json.load(manifest_handle)
+        for entry in manifest["checkpoints"]:
+            if self.checkpoint_path(entry["epoch"]).exists():
+                self.checkpoints[entry["epoch"]] = entry["metric"]
 
     def _model_state_dict(self):
         """Returns state dict of model, taking care of DataParallel case."""
-        if isinstance(self.model, nn.DataParallel):
+        if isinstance(self.model, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
             return self.model.module.state_dict()
         else:
             return self.model.state_dict()
 
 
+def _cpu_snapshot(obj):
+    """Recursively copy the tensors of a (nested) state dict to CPU memory."""
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        snapshot = type(obj)((k, _cpu_snapshot(v)) for k, v in obj.items())
+        if hasattr(obj, "_metadata"):
+            # Module versions, used by load_state_dict
+            snapshot._metadata = obj._metadata
+        return snapshot
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_cpu_snapshot(v) for v in obj)
+    return obj
+
+
+@lru_cache(maxsize=None)
+def _commit_sha():
+    """Short commit SHA of the codebase, looked up once per process."""
+    commit_sha_subprocess = Popen(
+        ["git", "rev-parse", "--short", "HEAD"], stdout=PIPE, stderr=PIPE
+    )
+    commit_sha, _ = commit_sha_subprocess.communicate()
+    return commit_sha.decode("utf-8").strip().replace("\n", "")
+
+
+# Hyper-parameters that define the shapes of the model parameters
+MODEL_PARAMS = ("attention_key_channels", "attention_value_channels", "embedding_size_word", "filter_size",
+                "hidden_size", "num_decoder_layers", "num_heads", "num_hidden_layers")
+
+
+def restore_model_hparams(hparams, checkpoint_dirpath):
+    """Replaces the MODEL_PARAMS fields of hparams by those of the run that wrote
+    ``checkpoint_dirpath/hparams.json``, so that a model trained with other sizes
+    (e.g. a distilled student) is rebuilt with the shapes of its checkpoints.
+    hparams is returned unchanged if the file is missing or was written without
+    the field names."""
+    hparams_path = os.path.join(str(checkpoint_dirpath), "hparams.json")
+    if not os.path.exists(hparams_path):
+        return hparams
+    with open(hparams_path) as hparams_handle:
+        saved = json.load(hparams_handle)
+    if not isinstance(saved, dict):
+        return hparams
+    return hparams._replace(**{name: saved[name] for name in MODEL_PARAMS if name in saved})
+
+
 def load_checkpoint(checkpoint_pthpath):
     """Given a path to saved checkpoint, load corresponding state dicts
     of model and optimizer from it. This method checks if the current
@@ -155,11 +378,7 @@ def load_checkpoint(checkpoint_pthpath):
         )
     else:
         # verify commit sha, raise warning if it doesn't match
-        commit_sha_subprocess = Popen(
-            ["git", "rev-parse", "--short", "HEAD"], stdout=PIPE, stderr=PIPE
-        )
-        commit_sha, _ = commit_sha_subprocess.communicate()
-        commit_sha = commit_sha.decode("utf-8").strip().replace("\n", "")
+        commit_sha = _commit_sha()
 
         # remove ".commit-"
         checkpoint_commit_sha = checkpoint_commit_sha[0].name[8:]
@@ -176,8 +395,154 @@ def load_checkpoint(checkpoint_pthpath):
     return components["model"], components["optimizer"]
 
 
+# Header: 8 byte little-endian header length, then the JSON header. Every
+# tensor starts at a multiple of WEIGHTS_ALIGNMENT bytes from the file start.
+WEIGHTS_ALIGNMENT = 64
+
+# torch dtype -> (name, numpy dtype of the stored bytes). bfloat16 has no
+# numpy equivalent, its bytes are stored as int16 and viewed back.
+_WEIGHTS_DTYPES = {
+    torch.float32: ("float32", np.float32),
+    torch.float64: ("float64", np.float64),
+    torch.float16: ("float16", np.float16),
+    torch.int64: ("int64", np.int64),
+    torch.int32: ("int32", np.int32),
+    torch.uint8: ("uint8", np.uint8),
+    torch.bool: ("bool", np.bool_),
+}
+if hasattr(torch, "bfloat16"):
+    _WEIGHTS_DTYPES[torch.bfloat16] = ("bfloat16", np.int16)
+
+
+def _align(offset):
+    return (offset + WEIGHTS_ALIGNMENT - 1) // WEIGHTS_ALIGNMENT * WEIGHTS_ALIGNMENT
+
+
+def export_weights(model_state_dict, weights_path, metadata=None):
+    """Write a weights-only checkpoint that ``load_weights`` can map
+    without copying.
+
+    Tensors sharing storage (e.g. the tied embedding and output
+    projection) are written once, the other names are stored as aliases.
+
+    Parameters
+    ----------
+    model_state_dict: dict
+        State dict of the model, e.g. from ``load_checkpoint``.
+    weights_path: str or pathlib.Path
+        Output path, conventionally ending in ``.weights``.
+    metadata: dict, optional (default=None)
+        JSON-serializable data stored in the header (e.g. the vocabulary).
+    """
+    tensors = {}
+    arrays = []
+    data_ptrs = {}
+    offset = 0
+    for name, tensor in model_state_dict.items():
+        tensor = tensor.detach().cpu()
+        key = (tensor.data_ptr(), tensor.dtype, tuple(tensor.shape), tensor.stride())
+        if tensor.numel() > 0 and key in data_ptrs:
+            tensors[name] = {"alias": data_ptrs[key]}
+            continue
+        data_ptrs[key] = name
+
+        dtype_name, np_dtype = _WEIGHTS_DTYPES[tensor.dtype]
+        array = tensor.contiguous()
+        if tensor.dtype == getattr(torch, "bfloat16", None):
+            array = array.view(torch.int16)
+        array = array.numpy().astype(np_dtype, copy=False)
+
+        offset = _align(offset)
+        tensors[name] = {"dtype": dtype_name, "shape": list(tensor.shape), "offset": offset}
+        arrays.append((offset, array))
+        offset += array.nbytes
+
+    header = json.dumps({"tensors": tensors, "metadata": metadata or {}}).encode("utf-8")
+    data_start = _align(8 + len(header))
+
+    weights_path = Path(weights_path)
+    tmp_path = weights_path.with_name(weights_path.name + ".tmp")
+    with open(str(tmp_path), "wb") as weights_handle:
+        weights_handle.write(len(header).to_bytes(8, "little"))
+        weights_handle.write(header)
+        for tensor_offset, array in arrays:
+            weights_handle.seek(data_start + tensor_offset)
+            weights_handle.write(array.tobytes())
+        weights_handle.truncate(data_start + offset)
+    os.replace(str(tmp_path), str(weights_path))
+
+
+def load_weights(weights_path):
+    """Map a checkpoint written by ``export_weights`` into memory.
+
+    The tensors are views of a copy-on-write memory map of the file: pages
+    are read from disk when first accessed, shared between processes
+    loading the same file, and private only once written to.
+
+    Returns
+    -------
+    dict, dict
+        Model state dict and the header metadata.
+    """
+    with open(str(weights_path), "rb") as weights_handle:
+        header_len = int.from_bytes(weights_handle.read(8), "little")
+        header = json.loads(weights_handle.read(header_len).decode("utf-8"))
+    data_start = _align(8 + header_len)
+    buffer = np.memmap(str(weights_path), dtype=np.uint8, mode="c")
+
+    dtypes = {dtype_name: (torch_dtype, np_dtype)
+              for torch_dtype, (dtype_name, np_dtype) in _WEIGHTS_DTYPES.items()}
+    state_dict = {}
+    for name, entry in header["tensors"].items():
+        if "alias" in entry:
+            continue
+        torch_dtype, np_dtype = dtypes[entry["dtype"]]
+        count = int(np.prod(entry["shape"]))
+        begin = data_start + entry["offset"]
+        array = buffer[begin:begin + count * np.dtype(np_dtype).itemsize].view(np_dtype)
+        tensor = torch.from_numpy(array.reshape(entry["shape"]))
+        if torch_dtype != tensor.dtype:
+            tensor = tensor.view(torch_dtype)
+        state_dict[name] = tensor
+
+    for name, entry in header["tensors"].items():
+        if "alias" in entry:
+            state_dict[name] = state_dict[entry["alias"]]
+    # Keep the order of the exported state dict
+    state_dict = {name: state_dict[name] for name in header["tensors"]}
+    return state_dict, header["metadata"]
+
+
+def assign_weights(model, state_dict, strict=True):
+    """Replace the parameters and buffers of model by the tensors of
+    state_dict without copying them, unlike ``load_state_dict``. Used
+    with ``load_weights`` so the model reads the memory-mapped file.
+    """
+    model_keys = set(model.state_dict().keys())
+    missing = model_keys - set(state_dict.keys())
+    unexpected = set(state_dict.keys()) - model_keys
+    if strict and (missing or unexpected):
+        raise RuntimeError(
+            "Error(s) in assigning weights to {}: missing keys {}, unexpected keys {}".format(
+                type(model).__name__, sorted(missing), sorted(unexpected)))
+
+    modules = dict(model.named_modules())
+    for name in model_keys - missing:
+        module_name, _, tensor_name = name.rpartition(".")
+        module = modules[module_name]
+        tensor = state_dict[name].to(getattr(module, tensor_name).device)
+        if tensor_name in module._parameters:
+            module._parameters[tensor_name].data = tensor
+        else:
+            module._buffers[tensor_name] = tensor
+
+
 def load_vocab(path):
-    return torch.load(path)
+    """Loads a ``Vocab``, ``AttrDict`` vocabularies written by earlier versions are converted."""
+    vocab = torch.load(path)
+    if not isinstance(vocab, Vocab):
+        vocab = Vocab.from_token2id(vocab.token2id)
+    return vocab
 
 
 def dump_vocab(path, vocab):
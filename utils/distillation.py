@@ -0,0 +1,121 @@
+"""
+Knowledge distillation of a trained model into a smaller student.
+
+The student of ``student_hparams`` has fewer attention heads, a smaller
+hidden size and fewer decoder layers than the teacher. Its word embedding
+has the student hidden size (the turn-level encoder reads the word-level
+outputs as embeddings) and is initialized with the teacher embedding
+projected on its principal components (``project_embedding``), the GloVe
+vectors having the teacher size. ``distillation_loss`` mixes the
+cross-entropy of the targets with the KL divergence between the
+temperature-scaled teacher and student distributions. ``speed_quality_report``
+decodes the test meetings with both models and compares their decoding time
+and ROUGE scores.
+"""
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from utils.utils import compute_rouge_scores
+
+
+def student_hparams(hparams):
+    """Hyper-parameters of the student model, from the student_* fields of hparams."""
+    return hparams._replace(num_heads=hparams.student_num_heads,
+                            hidden_size=hparams.student_hidden_size,
+                            embedding_size_word=hparams.student_hidden_size,
+                            num_decoder_layers=hparams.student_num_decoder_layers)
+
+
+def project_embedding(weight, size):
+    """Projects the rows of an embedding matrix [vocab_size, dim] on their top ``size`` principal
+    components, returns [vocab_size, size]."""
+    weight = weight.detach().float()
+    if size == weight.shape[1]:
+        return weight.clone()
+    if size > weight.shape[1]:
+        raise ValueError('Cannot project embeddings of size {} to size {}'.format(weight.shape[1], size))
+    centered = weight - weight.mean(0, keepdim=True)
+    _, _, components = torch.pca_lowrank(centered, q=size, center=False)
+    return torch.matmul(centered, components[:, :size])
+
+
+def distillation_loss(logits, teacher_logits, labels, temperature=2.0, alpha=0.5):
+    """
+    (1 - alpha) * cross-entropy of the labels + alpha * temperature^2 * KL(teacher || student) of the
+    temperature-scaled distributions, averaged over the positions. The temperature^2 factor keeps the
+    gradient scale of the soft targets independent of the temperature.
+
+    :param
+    logits: [num_positions, vocab_size] student logits
+    teacher_logits: [num_positions, vocab_size]
+    labels: [num_positions]
+    """
+    logits, teacher_logits = logits.float(), teacher_logits.float()
+    hard_loss = F.cross_entropy(logits, labels)
+    soft_loss = F.kl_div(F.log_softmax(logits / temperature, dim=-1),
+                         F.log_softmax(teacher_logits / temperature, dim=-1),
+                         reduction='batchmean', log_target=True) * temperature ** 2
+    return (1 - alpha) * hard_loss + alpha * soft_loss
+
+
+def _model_stats(model):
+    # Tied parameters are listed once
+    parameters = list(model.parameters())
+    return {'parameters': sum(p.numel() for p in parameters),
+            'parameters_mb': sum(p.numel() * p.element_size() for p in parameters) / 1024 ** 2}
+
+
+def speed_quality_report(predictors, test_dataloader, device='cpu'):
+    """
+    Decodes every meeting of test_dataloader with each predictor (beam search, without the results store)
+    and returns, per predictor name, the number and MB of parameters, the decoding time per meeting
+    (mean, p50, p90), the generated tokens per second and the ROUGE scores. The speedup and ROUGE
+    differences of the other predictors relative to the first one are added under 'relative'.
+
+    :param
+    predictors: dict name -> Predictor, e.g. {'teacher': teacher, 'student': student}
+    """
+    report = {}
+    for name, predictor in predictors.items():
+        predictor.model.eval()
+        times, num_tokens, cand_list, ref_list = [], 0, [], []
+        with torch.no_grad():
+            for data in test_dataloader:
+                labels_ids = data['labels_ids'].to(device)
+                reference = predictor.get_summaries(labels_ids[0]).replace('<BEGIN>', '').replace('<END>', '')
+                if device == 'cuda':
+                    torch.cuda.synchronize()
+                begin = time.perf_counter()
+                # Under the autocast dtype of each predictor
+                summary = predictor.inference(inputs=data['dialogues_ids'].to(device),
+                                              src_masks=data['src_masks'].to(device),
+                                              role_ids=data['role_ids'].to(device),
+                                              pos_ids=data['pos_ids'].to(device),
+                                              dialogues_lens=data['dialogues_lens'].to(device))
+                if device == 'cuda':
+                    torch.cuda.synchronize()
+                times.append(time.perf_counter() - begin)
+                num_tokens += len(summary.split())
+                cand_list.append(summary)
+                ref_list.append(reference)
+
+        report[name] = dict(_model_stats(predictor.model),
+                            decode_seconds_mean=float(np.mean(times)),
+                            decode_seconds_p50=float(np.percentile(times, 50)),
+                            decode_seconds_p90=float(np.percentile(times, 90)),
+                            tokens_per_sec=num_tokens / max(sum(times), 1e-9),
+                            rouge=compute_rouge_scores(cand_list, ref_list))
+
+    names = list(report)
+    baseline = report[names[0]]
+    report['relative'] = {}
+    for name in names[1:]:
+        stats = report[name]
+        report['relative'][name] = {
+            'speedup': baseline['decode_seconds_mean'] / max(stats['decode_seconds_mean'], 1e-9),
+            'parameters_ratio': stats['parameters'] / max(baseline['parameters'], 1),
+            'rouge_delta': {key: stats['rouge'][key] - baseline['rouge'][key] for key in baseline['rouge']}}
+    return report
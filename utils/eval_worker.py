@@ -0,0 +1,138 @@
+"""
+Out-of-band evaluation of training checkpoints.
+
+An ``EvaluationWorker`` runs ``Predictor.evaluate`` in a separate process, so
+the training loop does not stop for beam-search decoding of the test set.
+Checkpoints are submitted by path (typically from a ``CheckpointManager``
+save callback, once the file is on disk). The worker writes the ROUGE scores
+to the TensorBoard directory of the training run and sends them back to the
+trainer, which collects them with ``poll``.
+"""
+import collections
+import queue
+import threading
+import traceback
+
+import torch
+import torch.multiprocessing as mp
+
+
+def _evaluation_loop(hparams_dict, vocabs, tensorboard_path, jobs, results):
+    # Imported in the worker process only
+    from torch.utils.data import DataLoader
+    from torch.utils.tensorboard import SummaryWriter
+    from data.dataset import AMIDataset
+    from predictor import Predictor
+    from utils.checkpointing import load_checkpoint
+
+    hparams = collections.namedtuple("HParams", sorted(hparams_dict.keys()))(**hparams_dict)
+    if hparams.eval_num_threads > 0:
+        torch.set_num_threads(hparams.eval_num_threads)
+
+    vocab_word, vocab_role, vocab_pos = vocabs
+    test_dataset = AMIDataset(hparams, type='test', vocab_word=vocab_word, vocab_role=vocab_role, vocab_pos=vocab_pos)
+    test_dataloader = DataLoader(test_dataset, batch_size=hparams.batch_size, num_workers=0, drop_last=False)
+    summary_writer = SummaryWriter(tensorboard_path)
+
+    predictor = None
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        epoch, checkpoint_path = job
+        try:
+            if predictor is None:
+                predictor = Predictor(hparams._replace(load_pthpath=checkpoint_path), vocab_word=vocab_word,
+                                      vocab_role=vocab_role, vocab_pos=vocab_pos, summary_writer=summary_writer)
+            else:
+                model_state_dict, _ = load_checkpoint(checkpoint_path)
+                predictor.model.load_state_dict(model_state_dict)
+            predictor.model.eval()
+
+            results_dict = predictor.evaluate(test_dataloader=test_dataloader, epoch=epoch, eval_path=checkpoint_path)
+            summary_writer.flush()
+            results.put((epoch, results_dict, None))
+        except Exception:
+            results.put((epoch, None, traceback.format_exc()))
+
+    summary_writer.close()
+
+
+class EvaluationWorker(object):
+    """Evaluates checkpoints in a background process.
+
+    Parameters
+    ----------
+    hparams: HParams
+        Hyper-parameters of the training run, ``eval_num_threads`` limits
+        the CPU threads of the worker (0 keeps the PyTorch default).
+    vocab_word, vocab_role, vocab_pos: Vocab
+        Vocabularies of the training run.
+    tensorboard_path: str
+        Directory of the training SummaryWriter, the worker adds its own
+        event file there.
+
+    Example
+    --------
+    >>> worker = EvaluationWorker(hparams, vocab_word, vocab_role, vocab_pos, tensorboard_path).start()
+    >>> worker.submit(epoch, "checkpoint_20.pth")
+    >>> for epoch, results_dict in worker.poll():
+    ...     print(epoch, results_dict['rouge_l_f_score'])
+    >>> worker.close()
+    """
+
+    def __init__(self, hparams, vocab_word, vocab_role, vocab_pos, tensorboard_path):
+        self.hparams = hparams
+        self.vocabs = (vocab_word, vocab_role, vocab_pos)
+        self.tensorboard_path = tensorboard_path
+
+        # spawn: the training process may already run threads (checkpoint writer, prefetcher)
+        self._context = mp.get_context('spawn')
+        self._jobs = self._context.Queue()
+        self._results = self._context.Queue()
+        self._process = None
+        self._lock = threading.Lock()
+        self.num_pending = 0
+
+    def start(self):
+        self._process = self._context.Process(
+            target=_evaluation_loop,
+            args=(self.hparams._asdict(), self.vocabs, self.tensorboard_path, self._jobs, self._results),
+            daemon=True)
+        self._process.start()
+        return self
+
+    def submit(self, epoch, checkpoint_path):
+        """Queue a checkpoint for evaluation, safe to call from any thread."""
+        with self._lock:
+            self.num_pending += 1
+        self._jobs.put((epoch, str(checkpoint_path)))
+
+    def poll(self, block=False):
+        """Returns the (epoch, results_dict) of the evaluations finished since
+        the last call, waits for all submitted ones if block is True.
+        Failed evaluations are reported and returned with results_dict None."""
+        finished = []
+        while self.num_pending > 0:
+            if not block and self._results.empty():
+                break
+            try:
+                epoch, results_dict, error = self._results.get(timeout=10)
+            except queue.Empty:
+                if not self._process.is_alive():
+                    raise RuntimeError('Evaluation worker exited with code {}'.format(self._process.exitcode))
+                continue
+            with self._lock:
+                self.num_pending -= 1
+            if error is not None:
+                print('[Evaluation of epoch {} failed]: {}'.format(epoch, error))
+            finished.append((epoch, results_dict))
+        return finished
+
+    def close(self):
+        """Waits for the submitted evaluations and stops the worker, returns
+        the results not collected by ``poll`` yet."""
+        finished = self.poll(block=True)
+        self._jobs.put(None)
+        self._process.join()
+        return finished
@@ -0,0 +1,140 @@
+"""
+Memory accounting for evaluation: the peak resident set size of a region of
+code (sampled on a background thread, since ``ru_maxrss`` only ever grows over
+the lifetime of the process), and the bytes held by nested tensor structures
+such as encoder outputs, ``DecoderState`` caches and beam tensors.
+"""
+import csv
+import os
+import resource
+import threading
+
+import torch
+
+
+def current_rss_mb():
+    """
+    Current resident set size of the process in MB, falls back to the peak RSS
+    where /proc is not available.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+    except (IOError, OSError, ValueError, IndexError):
+        # ru_maxrss is reported in KB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def tensor_bytes(obj, _seen=None):
+    """
+    Number of bytes held by the tensors in obj (a tensor, or dicts/lists/tuples of them).
+    Tensors sharing the same storage are only counted once.
+    """
+    if _seen is None:
+        _seen = set()
+
+    if torch.is_tensor(obj):
+        key = (obj.device, obj.data_ptr())
+        if key in _seen:
+            return 0
+        _seen.add(key)
+        return obj.numel() * obj.element_size()
+    if isinstance(obj, dict):
+        return sum(tensor_bytes(v, _seen) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(tensor_bytes(v, _seen) for v in obj)
+    return 0
+
+
+class PeakMemoryMonitor(object):
+    """Peak memory of the enclosed region in MB.
+
+    On cuda the peak allocated memory is read from the caching allocator,
+    otherwise the RSS is polled every ``interval`` seconds.
+
+    Parameters
+    ----------
+    device: str
+        Device the model runs on.
+    interval: float, optional (default=0.005)
+        RSS sampling interval in seconds.
+
+    Example
+    --------
+    >>> with PeakMemoryMonitor('cpu') as monitor:
+    ...     predictor.inference(...)
+    >>> monitor.peak_mb
+    """
+
+    def __init__(self, device, interval=0.005):
+        self.is_cuda = torch.device(device).type == 'cuda'
+        self.device = device
+        self.interval = interval
+        self.peak_mb = 0.
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while not self._stop_event.wait(self.interval):
+            self.peak_mb = max(self.peak_mb, current_rss_mb())
+
+    def __enter__(self):
+        if self.is_cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+        else:
+            self.peak_mb = current_rss_mb()
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self.is_cuda:
+            self.peak_mb = torch.cuda.max_memory_allocated(self.device) / 1024 ** 2
+        else:
+            self._stop_event.set()
+            self._thread.join()
+            self.peak_mb = max(self.peak_mb, current_rss_mb())
+        return False
+
+
+class MemoryLog(object):
+    """Appends one row per meeting to a CSV file and logs it to a SummaryWriter.
+
+    Parameters
+    ----------
+    csv_path: str
+        Output CSV, the header is written when the file is created.
+    summary_writer: SummaryWriter, optional (default=None)
+        Every numeric field except the epoch and meeting index is logged as
+        ``memory/epoch_<epoch>/<field>`` (``memory/<field>`` without an epoch) at the meeting index,
+        so that the evaluations of different epochs do not write to the same steps.
+    """
+
+    FIELDS = ('epoch', 'meeting', 'num_turns', 'num_tokens', 'summary_tokens', 'peak_memory_mb',
+              'encoder_output_mb', 'decoder_cache_mb', 'beam_mb')
+
+    def __init__(self, csv_path, summary_writer=None):
+        self.csv_path = csv_path
+        self.summary_writer = summary_writer
+
+        dirpath = os.path.dirname(csv_path)
+        if dirpath and not os.path.exists(dirpath):
+            os.makedirs(dirpath)
+        self._file = open(csv_path, 'a', newline='')
+        self._writer = csv.DictWriter(self._file, fieldnames=self.FIELDS)
+        if self._file.tell() == 0:
+            self._writer.writeheader()
+
+    def log(self, **row):
+        self._writer.writerow(row)
+        self._file.flush()
+
+        if self.summary_writer is not None:
+            prefix = 'memory/' if row.get('epoch') is None else 'memory/epoch_{}/'.format(row['epoch'])
+            for field in self.FIELDS[2:]:
+                self.summary_writer.add_scalar(prefix + field, row[field], row['meeting'])
+
+    def close(self):
+        self._file.close()
@@ -0,0 +1,135 @@
+"""
+Optimizer for sparse word embedding gradients.
+
+With ``sparse_word_embedding`` (and the sampled softmax) the word embedding,
+tied to the output projection, gets sparse gradients that only hold the rows
+of the tokens of the batch and of the sampled negatives. ``LazyAdam``
+updates the Adam moments and the parameters of those rows only (the moments
+of the other rows are left as they are, as in TensorFlow's LazyAdam), and is
+a regular Adam for dense gradients. ``clip_grad_norm`` and
+``optimizer_step_bytes`` accept both kinds of gradients.
+"""
+import math
+
+import torch
+from torch import nn, optim
+
+
+class LazyAdam(optim.Optimizer):
+    """Adam that updates only the rows present in sparse gradients.
+
+    Dense gradients get the same update as ``torch.optim.Adam`` (without
+    weight decay and amsgrad). The state uses the keys of ``torch.optim.Adam``,
+    so checkpoints of either optimizer can be loaded by the other.
+
+    Parameters
+    ----------
+    params: iterable
+        Parameters or parameter groups.
+    lr: float, optional (default=1e-3)
+    betas: (float, float), optional (default=(0.9, 0.999))
+    eps: float, optional (default=1e-8)
+
+    Example
+    --------
+    >>> embedding = nn.Embedding(50000, 300, sparse=True)
+    >>> optimizer = LazyAdam(model.parameters(), lr=5e-4)
+    >>> loss.backward()
+    >>> optimizer.step()
+    """
+
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8):
+        super(LazyAdam, self).__init__(params, dict(lr=lr, betas=betas, eps=eps))
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        for group in self.param_groups:
+            beta1, beta2 = group['betas']
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                grad = p.grad
+                state = self.state[p]
+                if len(state) == 0:
+                    state['step'] = 0
+                    state['exp_avg'] = torch.zeros_like(p, memory_format=torch.preserve_format)
+                    state['exp_avg_sq'] = torch.zeros_like(p, memory_format=torch.preserve_format)
+                exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
+                # torch.optim.Adam keeps the step as a tensor
+                state['step'] = int(state['step']) + 1
+
+                bias_correction1 = 1 - beta1 ** state['step']
+                bias_correction2 = 1 - beta2 ** state['step']
+                step_size = group['lr'] / bias_correction1
+
+                if grad.is_sparse:
+                    grad = grad.coalesce()
+                    rows, values = grad._indices()[0], grad._values()
+                    row_exp_avg = exp_avg.index_select(0, rows).mul_(beta1).add_(values, alpha=1 - beta1)
+                    row_exp_avg_sq = exp_avg_sq.index_select(0, rows).mul_(beta2).addcmul_(values, values,
+                                                                                           value=1 - beta2)
+                    exp_avg.index_copy_(0, rows, row_exp_avg)
+                    exp_avg_sq.index_copy_(0, rows, row_exp_avg_sq)
+                    denom = (row_exp_avg_sq.sqrt_() / math.sqrt(bias_correction2)).add_(group['eps'])
+                    p.index_add_(0, rows, row_exp_avg.div_(denom).mul_(-step_size))
+                else:
+                    exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+                    exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+                    denom = (exp_avg_sq.sqrt() / math.sqrt(bias_correction2)).add_(group['eps'])
+                    p.addcdiv_(exp_avg, denom, value=-step_size)
+
+        return loss
+
+
+def build_optimizer(model, hparams):
+    """Adam, or LazyAdam when the word embedding has sparse gradients."""
+    betas = (hparams.optimizer_adam_beta1, hparams.optimizer_adam_beta2)
+    if hparams.sparse_word_embedding:
+        return LazyAdam(model.parameters(), lr=hparams.learning_rate, betas=betas)
+    return optim.Adam(model.parameters(), lr=hparams.learning_rate, betas=betas)
+
+
+def clip_grad_norm(parameters, max_norm):
+    """``nn.utils.clip_grad_norm_`` that also accepts sparse gradients (coalesced in place).
+    Returns the total norm of the gradients."""
+    parameters = [p for p in parameters if p.grad is not None]
+    if not any(p.grad.is_sparse for p in parameters):
+        return nn.utils.clip_grad_norm_(parameters, max_norm)
+
+    norms = []
+    for p in parameters:
+        if p.grad.is_sparse:
+            p.grad = p.grad.coalesce()
+            norms.append(p.grad._values().norm(2))
+        else:
+            norms.append(p.grad.norm(2))
+    total_norm = torch.stack([norm.to(norms[0].device) for norm in norms]).norm(2)
+    clip_coef = (max_norm / (total_norm + 1e-6)).clamp(max=1.0)
+    for p in parameters:
+        if p.grad.is_sparse:
+            p.grad._values().mul_(clip_coef.to(p.grad.device))
+        else:
+            p.grad.mul_(clip_coef.to(p.grad.device))
+    return total_norm
+
+
+def optimizer_step_bytes(optimizer):
+    """Bytes an Adam step reads and writes for the current gradients: parameter, gradient and both
+    moments read, parameter and moments written, for all rows of dense gradients and the rows of
+    sparse ones."""
+    total = 0
+    for group in optimizer.param_groups:
+        for p in group['params']:
+            if p.grad is None:
+                continue
+            numel = p.numel()
+            if p.grad.is_sparse:
+                grad = p.grad.coalesce()
+                numel = grad._values().numel()
+            total += 7 * numel * p.element_size()
+    return total
@@ -0,0 +1,154 @@
+"""
+A module profiler measures the wall time of the encoder/decoder hot path with
+forward hooks on ``Encoder``, ``EncoderLayer``, ``DecoderLayer``,
+``MultiHeadAttention`` and ``PositionwiseFeedForward`` modules.
+
+Hooks are only registered between ``start()`` and ``stop()``, so a model
+without a running profiler pays nothing. Timings are aggregated per module
+(attention modules are labelled with their ``attention_type``) and per decode
+step, and can be exported as a Chrome trace (chrome://tracing, Perfetto)
+and a summary table.
+"""
+from collections import defaultdict
+import json
+import os
+import time
+
+import torch
+
+from models.transformer.layers import Encoder, EncoderLayer, DecoderLayer
+from models.transformer.sublayers import MultiHeadAttention, PositionwiseFeedForward
+
+
+class ModuleProfiler(object):
+    """Forward-hook based wall-time profiler.
+
+    Parameters
+    ----------
+    model: nn.Module
+        Model whose submodules are profiled.
+    max_events: int, optional (default=1000000)
+        Maximum number of trace events kept in memory, aggregates are
+        always updated.
+
+    Example
+    --------
+    >>> profiler = ModuleProfiler(model).start()
+    >>> for step in range(max_length):
+    ...     profiler.set_step(step)
+    ...     decode_step()
+    >>> profiler.stop()
+    >>> profiler.export("/tmp/profile")
+    """
+
+    PROFILED_MODULES = (Encoder, EncoderLayer, DecoderLayer, MultiHeadAttention, PositionwiseFeedForward)
+
+    def __init__(self, model, max_events=1000000):
+        self.model = model
+        self.max_events = max_events
+        self.sync_cuda = next(model.parameters()).is_cuda
+
+        self.handles = []
+        self.events = []
+        self.calls = defaultdict(int)
+        self.total_time = defaultdict(float)
+        self.step_time = defaultdict(lambda: defaultdict(float))
+        self.step_total = defaultdict(float)
+        self.step = None
+
+        self._start_times = defaultdict(list)
+        self._depth = 0
+        self._origin = time.perf_counter()
+
+    def start(self):
+        """Registers the forward hooks."""
+        for name, module in self.model.named_modules():
+            if isinstance(module, self.PROFILED_MODULES):
+                label = self._label(name, module)
+                self.handles.append(module.register_forward_pre_hook(self._pre_hook(label)))
+                self.handles.append(module.register_forward_hook(self._post_hook(label)))
+        return self
+
+    def stop(self):
+        """Removes the forward hooks."""
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    def set_step(self, step):
+        """Attributes the following module calls to decode step ``step`` (None outside of decoding)."""
+        self.step = step
+
+    @staticmethod
+    def _label(name, module):
+        if isinstance(module, MultiHeadAttention) and module.attention_type is not None:
+            return "{}[{}]".format(name, module.attention_type)
+        return name
+
+    def _now(self):
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def _pre_hook(self, label):
+        def hook(module, inputs):
+            self._depth += 1
+            self._start_times[label].append(self._now())
+        return hook
+
+    def _post_hook(self, label):
+        def hook(module, inputs, outputs):
+            end = self._now()
+            start = self._start_times[label].pop()
+            duration = end - start
+            step = "encode" if self.step is None else self.step
+
+            self.calls[label] += 1
+            self.total_time[label] += duration
+            self.step_time[step][label] += duration
+            self._depth -= 1
+            if self._depth == 0:
+                # only outermost profiled modules count towards the step time
+                self.step_total[step] += duration
+
+            if len(self.events) < self.max_events:
+                self.events.append({
+                    "name": label,
+                    "cat": type(module).__name__,
+                    "ph": "X",
+                    "ts": (start - self._origin) * 1e6,
+                    "dur": duration * 1e6,
+                    "pid": os.getpid(),
+                    "tid": 0,
+                    "args": {"step": self.step},
+                })
+        return hook
+
+    def summary(self):
+        """Returns a table of calls, total and mean wall time per module."""
+        rows = sorted(self.total_time.items(), key=lambda item: item[1], reverse=True)
+        width = max([len(label) for label, _ in rows] + [len("module")])
+        lines = ["{:<{w}}  {:>8}  {:>12}  {:>10}".format("module", "calls", "total (ms)", "mean (ms)", w=width)]
+        for label, total in rows:
+            lines.append("{:<{w}}  {:>8d}  {:>12.2f}  {:>10.3f}".format(
+                label, self.calls[label], total * 1e3, total * 1e3 / self.calls[label], w=width))
+
+        step_totals = [total for step, total in self.step_total.items() if step != "encode"]
+        if step_totals:
+            lines.append("")
+            lines.append("decode steps: {}, mean {:.3f} ms, max {:.3f} ms per step".format(
+                len(step_totals), 1e3 * sum(step_totals) / len(step_totals), 1e3 * max(step_totals)))
+        return "\n".join(lines)
+
+    def export(self, dirpath):
+        """Writes ``trace.json`` (Chrome trace), ``steps.json`` (time per module per decode step)
+        and ``summary.txt`` in ``dirpath``."""
+        os.makedirs(dirpath, exist_ok=True)
+        with open(os.path.join(dirpath, "trace.json"), "w") as trace_handle:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, trace_handle)
+        with open(os.path.join(dirpath, "steps.json"), "w") as steps_handle:
+            json.dump({str(step): dict(times) for step, times in self.step_time.items()}, steps_handle)
+        summary = self.summary()
+        with open(os.path.join(dirpath, "summary.txt"), "w") as summary_handle:
+            summary_handle.write(summary + "\n")
+        return summary
@@ -0,0 +1,116 @@
+"""
+Persistent store of generated summaries.
+
+``Predictor.evaluate`` appends one JSON line per decoded meeting to a
+``results.jsonl`` file, keyed by a hash of the model weights, the meeting id
+and the decoding configuration. An interrupted evaluation resumes where it
+stopped, re-running a sweep skips the (checkpoint, meeting, decode config)
+entries already present, and ROUGE is recomputed from the stored summaries
+without decoding (``python main.py --mode rouge --results_path ...``).
+"""
+import hashlib
+import json
+import os
+
+import torch
+
+from utils.utils import compute_rouge_scores
+
+# Hyper-parameters that change the generated summary for the same weights
+DECODE_PARAMS = ('autocast_dtype', 'beam_size', 'blook_trigram', 'decoder_cache_dtype', 'encoder_attention_window',
+                 'encoder_global_tokens', 'gen_max_length', 'hierarchical_top_k_turns', 'max_length',
+                 'min_length', 'use_pos', 'use_role')
+
+
+def state_dict_hash(model):
+    """SHA-1 of the parameter and buffer names and bytes of a model, the same for a
+    ``.pth`` checkpoint and its ``.weights`` export."""
+    digest = hashlib.sha1()
+    state_dict = model.state_dict()
+    for name in sorted(state_dict):
+        tensor = state_dict[name].detach().cpu().contiguous()
+        digest.update(name.encode('utf-8'))
+        digest.update(str(tensor.dtype).encode('utf-8'))
+        digest.update(tensor.view(-1).view(torch.uint8).numpy().tobytes())
+    return digest.hexdigest()
+
+
+def decode_config(hparams):
+    """The fields of hparams in DECODE_PARAMS, as a dict."""
+    return {name: getattr(hparams, name) for name in DECODE_PARAMS}
+
+
+def decode_config_key(config):
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+class ResultsStore(object):
+    """Generated summaries keyed by (checkpoint hash, meeting id, decode config key).
+
+    Entries are appended and flushed one by one, a line left incomplete by an
+    interrupted write is ignored when the file is loaded again.
+
+    Parameters
+    ----------
+    path: str
+        JSONL file, created if it does not exist.
+
+    Example
+    --------
+    >>> store = ResultsStore('checkpoints/results.jsonl')
+    >>> key = decode_config_key(decode_config(hparams))
+    >>> if store.get(checkpoint, meeting_id, key) is None:
+    ...     store.add(checkpoint, meeting_id, decode_config(hparams), summary, reference)
+    >>> store.rouge(checkpoint, key)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+
+        dirpath = os.path.dirname(path)
+        if dirpath and not os.path.exists(dirpath):
+            os.makedirs(dirpath)
+        if os.path.exists(path):
+            with open(path) as store_handle:
+                for line in store_handle:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.entries[(entry['checkpoint'], entry['meeting_id'], entry['decode_key'])] = entry
+        self._file = open(path, 'a')
+        # Terminate a line left incomplete by an interrupted write
+        if self._file.tell() > 0:
+            with open(path, 'rb') as store_handle:
+                store_handle.seek(-1, os.SEEK_END)
+                if store_handle.read(1) != b'\n':
+                    self._file.write('\n')
+
+    def get(self, checkpoint, meeting_id, decode_key):
+        return self.entries.get((checkpoint, meeting_id, decode_key))
+
+    def add(self, checkpoint, meeting_id, config, summary, reference, **fields):
+        entry = dict(fields, checkpoint=checkpoint, meeting_id=meeting_id, decode_key=decode_config_key(config),
+                     decode=config, summary=summary, reference=reference)
+        self.entries[(checkpoint, meeting_id, entry['decode_key'])] = entry
+        self._file.write(json.dumps(entry) + '\n')
+        self._file.flush()
+        return entry
+
+    def runs(self):
+        """(checkpoint, decode_key) -> list of entries, in the order they were decoded."""
+        runs = {}
+        for (checkpoint, _, decode_key), entry in self.entries.items():
+            runs.setdefault((checkpoint, decode_key), []).append(entry)
+        return runs
+
+    def rouge(self, checkpoint, decode_key):
+        """ROUGE scores of the stored summaries of a checkpoint and decode config."""
+        entries = self.runs().get((checkpoint, decode_key), [])
+        if not entries:
+            raise KeyError('No results of checkpoint {} with decode config {}'.format(checkpoint, decode_key))
+        return compute_rouge_scores([e['summary'] for e in entries], [e['reference'] for e in entries])
+
+    def close(self):
+        self._file.close()
@@ -0,0 +1,157 @@
+"""
+Interval based training telemetry.
+
+Losses and gradient norms are accumulated on the device and only copied to
+the host every ``log_every`` optimizer steps, so logging does not force a
+synchronization per iteration. Time spent waiting on the DataLoader is
+measured around ``next()`` of the wrapped iterator and reported next to the
+total wall time of the interval, which tells whether the input pipeline or
+the model is the bottleneck.
+
+In multi-process training the meeting and token counts are summed over the
+ranks at every flush, so the throughput is the one of the whole job.
+"""
+import math
+import time
+
+import torch
+import torch.distributed as dist
+
+from utils.utils import peak_memory_mb
+
+
+class TrainingTelemetry(object):
+    """Collects throughput, data-loading stall and gradient-norm statistics.
+
+    Parameters
+    ----------
+    summary_writer: SummaryWriter
+        Metrics are written under ``train/``, nothing is written if None
+        (ranks other than 0).
+    device: torch.device
+        Device the model is trained on, used for the peak memory.
+    log_every: int, optional (default=50)
+        Flush interval in optimizer steps.
+    world_size: int, optional (default=1)
+        Number of training processes, every rank must flush at the same steps.
+    loader_stats: callable, optional (default=None)
+        Returns the input pipeline statistics since its last call (e.g.
+        ``PrefetchLoader.pop_stats``), logged as ``train/data_<name>``.
+
+    Example
+    --------
+    >>> telemetry = TrainingTelemetry(summary_writer, device, log_every=50)
+    >>> for batch in telemetry.iterate(dataloader):
+    ...     telemetry.add_batch(batch)
+    ...     loss = ...
+    ...     telemetry.add_loss(loss)
+    ...     grad_norm = nn.utils.clip_grad_norm_(...)
+    ...     step += 1
+    ...     telemetry.optimizer_step(step, grad_norm, lr)
+    """
+
+    def __init__(self, summary_writer, device, log_every=50, world_size=1, loader_stats=None):
+        self.summary_writer = summary_writer
+        self.device = device
+        self.log_every = max(1, log_every)
+        self.world_size = world_size
+        self.loader_stats = loader_stats
+        self.lr = 0.
+        self.reset()
+
+    def reset(self):
+        self.interval_begin = time.time()
+        self.data_wait = 0.
+        self.meetings = 0
+        self.source_tokens = 0
+        self.target_tokens = 0
+        self.steps = 0
+        self.losses = 0
+        self.optimizer_time = 0.
+        self.optimizer_bytes = 0
+        # On-device accumulators, copied to the host in flush()
+        self.loss_sum = torch.zeros((), device=self.device)
+        self.grad_norm_sum = torch.zeros((), device=self.device)
+        self.grad_norm_sq_sum = torch.zeros((), device=self.device)
+        self.grad_norm_max = torch.zeros((), device=self.device)
+
+    def iterate(self, iterable):
+        """Yields from iterable and adds the time blocked in next() to the data wait."""
+        iterator = iter(iterable)
+        while True:
+            begin = time.time()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            self.data_wait += time.time() - begin
+            yield batch
+
+    def add_batch(self, data):
+        # Counted from the host-side batch, before it is moved to the device
+        self.meetings += data['dialogues_ids'].size(0)
+        self.source_tokens += int(data['dialogues_lens'].sum())
+        self.target_tokens += data['labels_ids'].numel() - data['labels_ids'].size(0)
+
+    def add_loss(self, loss):
+        self.loss_sum += loss.detach().float()
+        self.losses += 1
+
+    def optimizer_step(self, global_step, grad_norm, lr, optimizer_time=0., optimizer_bytes=0):
+        """Records an optimizer step (with the wall time of optimizer.step() and the bytes it reads and writes),
+        returns the flushed metrics every log_every steps and None otherwise."""
+        self.optimizer_time += optimizer_time
+        self.optimizer_bytes += optimizer_bytes
+        grad_norm = torch.as_tensor(grad_norm, device=self.device).detach().float()
+        self.grad_norm_sum += grad_norm
+        self.grad_norm_sq_sum += grad_norm * grad_norm
+        self.grad_norm_max = torch.max(self.grad_norm_max, grad_norm)
+        self.steps += 1
+        self.lr = lr
+
+        if global_step % self.log_every == 0:
+            return self.flush(global_step)
+        return None
+
+    def flush(self, global_step):
+        if self.steps == 0:
+            return None
+
+        # Single device-to-host copy per interval
+        loss_sum, norm_sum, norm_sq_sum, norm_max = torch.stack(
+            [self.loss_sum, self.grad_norm_sum, self.grad_norm_sq_sum, self.grad_norm_max]).tolist()
+        elapsed = max(time.time() - self.interval_begin, 1e-9)
+        norm_mean = norm_sum / self.steps
+
+        counts = [self.meetings, self.source_tokens, self.target_tokens]
+        if self.world_size > 1:
+            counts = torch.tensor(counts, dtype=torch.float64)
+            dist.all_reduce(counts)
+            counts = counts.tolist()
+        meetings, source_tokens, target_tokens = counts
+
+        metrics = {
+            'loss': loss_sum / max(1, self.losses),
+            'meetings_per_sec': meetings / elapsed,
+            'source_tokens_per_sec': source_tokens / elapsed,
+            'target_tokens_per_sec': target_tokens / elapsed,
+            'step_time': elapsed / self.steps,
+            'data_wait_time': self.data_wait / self.steps,
+            'compute_time': (elapsed - self.data_wait) / self.steps,
+            'data_wait_fraction': self.data_wait / elapsed,
+            'grad_norm_mean': norm_mean,
+            'grad_norm_std': math.sqrt(max(0., norm_sq_sum / self.steps - norm_mean ** 2)),
+            'grad_norm_max': norm_max,
+            'optimizer_time': self.optimizer_time / self.steps,
+            'optimizer_mb_per_step': self.optimizer_bytes / self.steps / 1024 ** 2,
+            'lr': self.lr,
+            'peak_memory_mb': peak_memory_mb(self.device),
+        }
+        if self.loader_stats is not None:
+            metrics.update(('data_' + name, value) for name, value in self.loader_stats().items())
+        if self.summary_writer is not None:
+            for name, value in metrics.items():
+                self.summary_writer.add_scalar('train/' + name, value, global_step)
+
+        self.reset()
+        return metrics
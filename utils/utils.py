@@ -1,12 +1,14 @@
 import numpy as np
 import torch
+import resource
+from contextlib import contextmanager
 from tqdm import tqdm
 from data.dataset import *
 from rouge import Rouge
 
 
 def load_spacy_glove_embedding(spacy_nlp, vocab):
-    vocab_size = len(vocab.token2id)
+    vocab_size = len(vocab)
     # print('vocab_size in function: ', vocab_size)
     word_vec_size = spacy_nlp.vocab.vectors_length
     embedding = np.zeros((vocab_size, word_vec_size))
@@ -16,10 +18,10 @@ def load_spacy_glove_embedding(spacy_nlp, vocab):
     print('Loading spacy glove embedding:')
     print('- Vocabulary size: {}'.format(vocab_size))
     print('- Word vector size: {}'.format(word_vec_size))
-    for token, index in tqdm(vocab.token2id.items()):
-        if token == vocab.id2token[PAD]:
+    for index, token in enumerate(tqdm(vocab.decode(range(vocab_size)))):
+        if index == PAD:
             continue
-        elif token in [vocab.id2token[BOS], vocab.id2token[EOS], vocab.id2token[UNK], vocab.id2token[BEGIN]]:
+        elif index in [BOS, EOS, UNK, BEGIN]:
             vector = np.random.rand(word_vec_size, )
         elif spacy_nlp.vocab[token].has_vector:
             vector = spacy_nlp.vocab[token].vector
@@ -117,3 +119,32 @@ def compare_models(model_1, model_2):
                 raise Exception
     if models_differ == 0:
         print('Models match perfectly! :)')
+
+
+@contextmanager
+def autocast(hparams, enabled=True):
+    """
+    Runs the enclosed region under torch autocast with hparams.autocast_dtype (e.g. 'bfloat16').
+    Does nothing if autocast_dtype is empty or enabled is False.
+    """
+    if not enabled or not hparams.autocast_dtype:
+        yield
+        return
+
+    if not hasattr(torch, 'autocast'):
+        raise ValueError('autocast_dtype={} requires a PyTorch version with torch.autocast'.format(
+            hparams.autocast_dtype))
+
+    device_type = 'cuda' if hparams.device == 'cuda' else 'cpu'
+    with torch.autocast(device_type=device_type, dtype=getattr(torch, hparams.autocast_dtype)):
+        yield
+
+
+def peak_memory_mb(device):
+    """
+    Peak memory of the process in MB: max allocated CUDA memory on cuda, max RSS otherwise.
+    """
+    if torch.device(device).type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 1024 ** 2
+    # ru_maxrss is reported in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
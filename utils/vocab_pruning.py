@@ -0,0 +1,112 @@
+"""
+Vocabulary pruning of trained checkpoints.
+
+``build_vocab`` keeps up to ``max_vocab_size`` words of train+dev, most of
+them rare, and every word has a row in ``embedding_word`` and in
+``final_linear``, so the vocabulary size drives the size of a checkpoint and
+the cost of the output projection and the beam search at every decoding
+step. ``select_token_ids`` picks the words to keep by minimum count, by the
+fraction of the corpus tokens they cover or by number, and
+``prune_checkpoint`` writes a copy of a checkpoint with only their rows
+(and the matching rows of the Adam moments) and the new ``vocab_word``.
+Dropped words are encoded as ``<UNK>``, whose row is kept.
+
+The special tokens keep their ids and the kept words keep their order (by
+frequency), so the new id of a word is its rank among the kept ids.
+"""
+import os
+
+import numpy as np
+import torch
+
+from data.vocab import Vocab
+from utils.checkpointing import dump_vocab
+
+# Parameters with a row per word of vocab_word
+VOCAB_PARAMS = ('embedding_word.weight', 'final_linear.weight', 'final_linear.bias')
+# <PAD>, <BOS>, <EOS>, <UNK>, <BEGIN>, <END> (data/dataset.py)
+NUM_SPECIAL_TOKENS = 6
+
+
+def select_token_ids(counts, min_count=0, coverage=1.0, max_size=0):
+    """Ids of the tokens to keep, in increasing order.
+
+    Parameters
+    ----------
+    counts: array of int
+        Count of every token of the vocabulary in the corpora, in id order.
+    min_count: int, optional (default=0)
+        Drop the words seen fewer times.
+    coverage: float, optional (default=1.0)
+        Keep the most frequent words until they cover this fraction of the word occurrences.
+    max_size: int, optional (default=0)
+        Maximum size of the pruned vocabulary, special tokens included (0: no limit).
+
+    The special tokens are always kept.
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    word_ids = np.arange(NUM_SPECIAL_TOKENS, len(counts))
+    # Most frequent first, ties keep the id order
+    word_ids = word_ids[np.argsort(-counts[word_ids], kind='stable')]
+    word_counts = counts[word_ids]
+
+    keep = word_counts >= max(min_count, 1)
+    if coverage < 1.0:
+        covered = np.cumsum(word_counts) / max(int(word_counts.sum()), 1)
+        # Words before the one that reaches the target, and that one
+        keep &= np.arange(len(word_ids)) <= np.searchsorted(covered, coverage)
+    word_ids = word_ids[keep]
+    if max_size > 0:
+        word_ids = word_ids[:max(max_size - NUM_SPECIAL_TOKENS, 0)]
+    return np.concatenate([np.arange(NUM_SPECIAL_TOKENS), np.sort(word_ids)]).astype(np.int64)
+
+
+def prune_vocab(vocab, keep_ids):
+    return Vocab(vocab.decode(keep_ids), unk_token=vocab.unk_token)
+
+
+def prune_state_dict(model_state_dict, keep_ids):
+    """Model state dict with the rows of keep_ids of the vocabulary-sized parameters."""
+    index = torch.as_tensor(keep_ids, dtype=torch.long)
+    return {name: tensor.index_select(0, index) if name in VOCAB_PARAMS else tensor
+            for name, tensor in model_state_dict.items()}
+
+
+def prune_optimizer_state_dict(optimizer_state_dict, keep_ids, vocab_size):
+    """Optimizer state dict with the rows of keep_ids of the per-parameter state tensors with
+    vocab_size rows (the Adam moments of the word embedding and output projection)."""
+    index = torch.as_tensor(keep_ids, dtype=torch.long)
+    state = {}
+    for param_id, param_state in optimizer_state_dict['state'].items():
+        state[param_id] = {key: value.index_select(0, index)
+                           if torch.is_tensor(value) and value.dim() > 0 and value.size(0) == vocab_size else value
+                           for key, value in param_state.items()}
+    return dict(optimizer_state_dict, state=state)
+
+
+def vocab_coverage(counts, keep_ids, total=None):
+    """Fraction of the word occurrences covered by the kept ids, of the vocabulary words by default
+    or of total occurrences (e.g. including the words left out of the vocabulary)."""
+    counts = np.asarray(counts, dtype=np.int64)
+    keep_ids = np.asarray(keep_ids, dtype=np.int64)
+    if total is None:
+        total = int(counts[NUM_SPECIAL_TOKENS:].sum())
+    kept = int(counts[keep_ids[keep_ids >= NUM_SPECIAL_TOKENS]].sum())
+    return kept / max(total, 1)
+
+
+def prune_checkpoint(model_state_dict, optimizer_state_dict, vocab, keep_ids, output_path):
+    """Writes the pruned checkpoint to output_path and the pruned vocabulary to vocab_word next to
+    it. Returns the pruned vocabulary."""
+    output_dirpath = os.path.dirname(output_path)
+    if output_dirpath and not os.path.exists(output_dirpath):
+        os.makedirs(output_dirpath)
+
+    components = {'model': prune_state_dict(model_state_dict, keep_ids), 'optimizer': optimizer_state_dict}
+    if optimizer_state_dict is not None:
+        components['optimizer'] = prune_optimizer_state_dict(optimizer_state_dict, keep_ids, len(vocab))
+    torch.save(components, output_path)
+
+    pruned_vocab = prune_vocab(vocab, keep_ids)
+    dump_vocab(os.path.join(output_dirpath, 'vocab_word'), pruned_vocab)
+    return pruned_vocab